@@ -0,0 +1,229 @@
+"""
+Analytics of the trajectories of the players (see trajectory.py), computed with NumPy
+
+For each player of a test or of a world (all the tests played in it):
+    * number_points, duration: number of points and time between the first and the last point
+    * path_length: distance travelled (sum of the distances between consecutive points)
+    * average_speed: path_length / duration
+    * speed_median, speed_p95, speed_max: speed profile (distance / time between consecutive points)
+    * idle_time: time spent moving less than idle_distance between two points
+And the occupancy heatmap of the players on the (x, z) plane: time spent in each cell of the world.
+
+The metrics of all the players are computed at once on the concatenated trajectories.
+The decoded trajectories and the metrics are cached by (test_id, player_id), the cache is invalidated
+by the ingestion when the stat of the player is written.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from database import db_session
+from models import Test, Stat, Trajectory
+import ingest
+import trajectory
+
+
+# Distance (in blocks) under which a player is considered idle between two points
+IDLE_DISTANCE = 0.1
+
+# Maximum number of cells of a heatmap
+MAX_CELLS = 4000000
+
+# Maximum number of points kept in the cache (8 bytes per coordinate)
+CACHE_MAX_POINTS = 2000000
+
+
+class AnalyticsCache(object):
+    """
+    Least recently used cache of the trajectories and metrics of the players, by (test_id, player_id)
+    Each key has a version incremented when it is invalidated: a value computed from data read before
+    the invalidation is not stored
+    """
+
+    def __init__(self, max_points=CACHE_MAX_POINTS):
+        self.max_points = max_points
+        self.points = 0
+        # {key: (number of points, value)}
+        self.values = OrderedDict()
+        self.versions = {}
+        self.lock = Lock()
+        self.enabled = True
+
+    def version(self, key):
+        with self.lock:
+            return self.versions.get(key, 0)
+
+    def get(self, key):
+        """Returns the value of a key, None if it is not cached"""
+        with self.lock:
+            if key not in self.values:
+                return None
+            self.values.move_to_end(key)
+            return self.values[key][1]
+
+    def put(self, key, value, points, version):
+        """Caches the value of a key, computed from data read when the key had the given version"""
+        with self.lock:
+            if not self.enabled or self.versions.get(key, 0) != version or points > self.max_points:
+                return
+            if key in self.values:
+                self.points -= self.values.pop(key)[0]
+            self.values[key] = (points, value)
+            self.points += points
+            while self.points > self.max_points:
+                self.points -= self.values.popitem(last=False)[1][0]
+
+    def invalidate(self, keys):
+        """Removes the values of keys [(test_id, player_id)], called once the new stats are committed"""
+        with self.lock:
+            for key in keys:
+                self.versions[key] = self.versions.get(key, 0) + 1
+                if key in self.values:
+                    self.points -= self.values.pop(key)[0]
+
+
+cache = AnalyticsCache()
+ingest.listeners.append(cache.invalidate)
+
+
+def decode(data):
+    """Decodes the blob of a trajectory to NumPy arrays, returns (times, positions)"""
+    (data, length, column_decimals, offset) = trajectory.read_blob(data)
+    columns = np.empty((len(column_decimals), length))
+    for (i, n) in enumerate(column_decimals):
+        if n == trajectory.FLOAT_COLUMN:
+            columns[i] = np.frombuffer(data, dtype="<f8", count=length, offset=offset)
+        else:
+            columns[i] = np.cumsum(np.frombuffer(data, dtype="<i8", count=length, offset=offset)) / 10 ** n
+        offset += 8 * length
+    return columns[0], columns[1:].T
+
+
+def steps(trajectories):
+    """
+    Concatenates trajectories [(times, positions)], returns for each step between two consecutive points
+    of the same trajectory: the index of the trajectory, its duration and its length
+    """
+    lengths = np.array([len(times) for (times, positions) in trajectories])
+    owner = np.repeat(np.arange(len(trajectories)), lengths)
+    times = np.concatenate([times for (times, positions) in trajectories])
+    positions = np.concatenate([positions for (times, positions) in trajectories])
+    same = owner[1:] == owner[:-1]
+    durations = np.diff(times)[same]
+    distances = np.sqrt((np.diff(positions, axis=0) ** 2).sum(axis=1))[same]
+    return owner[1:][same], durations, distances
+
+
+def compute_metrics(trajectories, idle_distance=IDLE_DISTANCE):
+    """Computes the metrics of a list of trajectories [(times, positions)], returns a list of dictionaries"""
+    n = len(trajectories)
+    (index, durations, distances) = steps(trajectories)
+    path_length = np.bincount(index, weights=distances, minlength=n)
+    duration = np.bincount(index, weights=durations, minlength=n)
+    idle_time = np.bincount(index, weights=durations * (distances < idle_distance), minlength=n)
+
+    # Speed profile: speeds sorted by trajectory, the percentiles are read at the position of each trajectory
+    moving = durations > 0
+    speeds = distances[moving] / durations[moving]
+    speed_index = index[moving]
+    order = np.lexsort((speeds, speed_index))
+    speeds = speeds[order]
+    counts = np.bincount(speed_index, minlength=n)
+    starts = np.cumsum(counts) - counts
+    has_speed = counts > 0
+    def percentile(p):
+        values = np.zeros(n)
+        values[has_speed] = speeds[starts[has_speed] + np.floor(p * (counts[has_speed] - 1)).astype(int)]
+        return values
+
+    (median, p95, maximum) = (percentile(0.5), percentile(0.95), percentile(1))
+    metrics = []
+    for i in range(n):
+        metrics.append({
+            "number_points": len(trajectories[i][0]),
+            "duration": duration[i],
+            "path_length": path_length[i],
+            "average_speed": path_length[i] / duration[i] if duration[i] > 0 else 0.0,
+            "speed_median": median[i],
+            "speed_p95": p95[i],
+            "speed_max": maximum[i],
+            "idle_time": idle_time[i],
+        })
+    return metrics
+
+
+def load(test_id=None, world=None):
+    """
+    Returns the trajectories and metrics of the players of a test or of a world:
+    [(test_id, player_id, {"times", "positions", "metrics"})], read from the cache when possible
+    """
+    q = db_session.query(Stat.id, Stat.test_id, Stat.player_id)
+    if test_id is not None:
+        q = q.filter(Stat.test_id == test_id)
+    else:
+        q = q.join(Test, Stat.test_id == Test.id).filter(Test.world == world)
+    stats = q.order_by(Stat.test_id, Stat.player_id).all()
+
+    results = OrderedDict()
+    missing = {}
+    for (stat_id, stat_test_id, player_id) in stats:
+        key = (stat_test_id, player_id)
+        results[key] = cache.get(key)
+        if results[key] is None:
+            missing[stat_id] = (key, cache.version(key))
+
+    # The trajectories not cached are decoded and their metrics computed at once
+    decoded = []
+    for stat_ids in ingest.chunks(missing.keys()):
+        for (stat_id, data) in db_session.query(Trajectory.stat_id, Trajectory.data).filter(Trajectory.stat_id.in_(stat_ids)):
+            decoded.append((missing[stat_id], decode(data)))
+    if decoded:
+        metrics = compute_metrics([points for (key, points) in decoded])
+        for (((key, version), (times, positions)), player_metrics) in zip(decoded, metrics):
+            results[key] = {"times": times, "positions": positions, "metrics": player_metrics}
+            cache.put(key, results[key], times.size, version)
+
+    return [(key[0], key[1], value) for (key, value) in results.items() if value is not None]
+
+
+def heatmap(players, cell_size=1.0):
+    """
+    Computes the occupancy heatmap of players (returned by load) on the (x, z) plane
+    Each point counts for the time until the next point of the trajectory
+    Returns {"cell_size", "x_min", "z_min", "shape", "cells": [[i, j, time]]} with only the non empty cells,
+    the cell (i, j) starts at (x_min + i * cell_size, z_min + j * cell_size)
+    """
+    trajectories = [(value["times"], value["positions"]) for (test_id, player_id, value) in players if len(value["times"])]
+    if not trajectories:
+        return {"cell_size": cell_size, "x_min": 0, "z_min": 0, "shape": [0, 0], "cells": []}
+    times = np.concatenate([times for (times, positions) in trajectories])
+    positions = np.concatenate([positions for (times, positions) in trajectories])
+    # x and z (y is the height) for 3D positions
+    plane = positions[:, [0, 2]] if positions.shape[1] >= 3 else positions[:, :2]
+
+    # Time spent at each point, 0 for the last point of each trajectory
+    weights = np.zeros(len(times))
+    lengths = np.array([len(t) for (t, p) in trajectories])
+    last = np.cumsum(lengths) - 1
+    weights[:-1] = np.diff(times)
+    weights[last] = 0
+
+    origin = np.floor(plane.min(axis=0) / cell_size) * cell_size
+    cells = np.floor((plane - origin) / cell_size).astype(np.int64)
+    shape = cells.max(axis=0) + 1
+    if shape[0] * shape[1] > MAX_CELLS:
+        raise ValueError("The heatmap would have {} cells, use a larger cell size".format(shape[0] * shape[1]))
+    occupancy = np.bincount(cells[:, 0] * shape[1] + cells[:, 1], weights=weights, minlength=shape[0] * shape[1])
+    nonzero = np.nonzero(occupancy)[0]
+    return {
+        "cell_size": cell_size,
+        "x_min": float(origin[0]),
+        "z_min": float(origin[1]),
+        "shape": shape.tolist(),
+        "cells": list(zip((nonzero // shape[1]).tolist(), (nonzero % shape[1]).tolist(), occupancy[nonzero].tolist())),
+    }
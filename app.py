@@ -12,23 +12,36 @@ In a second step, the client makes himself available for connection ("connect" f
 """
 
 from flask import Flask
-from flask import request, render_template, redirect, url_for, flash, make_response
+from flask import request, render_template, redirect, url_for, flash, make_response, Response, stream_with_context, send_file
 from flask import json, jsonify
 
 import sqlite3
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
-from sqlalchemy import func, desc
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import func, String
 
-import re
+import os
+import math
 import time
-from random import randint
-from threading import Thread, Lock
+import tempfile
 
 # for py2exe to correctly import jinja2
 import jinja2.ext
 
-from database import db_session
-from models import Session, Test, Stat, Item, Connection, Player
+from database import db_session, engine
+from models import Session, Test, Stat, Item, Connection, Player, Trajectory
+from matchmaking import Matchmaker, DatabaseMatchmaker, BucketLocks
+from journal import IngestJournal
+import ingest
+import export
+import pagination
+import trajectory
+import analytics
+import cache
+import catalog
+import metrics
+import registration
+import uploads
 import utils
 
 # We load the general settings
@@ -39,10 +52,42 @@ app.secret_key = settings["flask"]["secret_key"]
 app.debug = settings["flask"]["debug"]
 app.ext = settings["flask"]["ext"]
 
-# Lock used in the identification phase
-app.lock_players = Lock()
-# Lock used in the connection phase
-app.lock_connections = Lock()
+# Latency of the requests, SQL statements, waits on the locks and size of the uploads, exposed at /metrics
+if settings.get("metrics", {}).get("enabled", True):
+    metrics.init_app(app, engine)
+
+# Number of processes of the server (see serve.py) and number of this process
+app.workers = int(os.environ.get("IDP_WORKERS", settings["server"].get("workers", 1)))
+app.worker = int(os.environ.get("IDP_WORKER", 0))
+
+# Players waiting for connection, by session and pair
+if app.workers > 1:
+    # The players are paired with conditional updates of the database, whatever the process handling them
+    app.matchmaker = DatabaseMatchmaker()
+else:
+    # The players are paired in memory, with one lock per session and pair
+    app.matchmaker = Matchmaker(BucketLocks(metrics.lock_factory("connections")))
+
+# Journal of the statistics in write-behind mode, the statistics are added to the database in the background
+app.journal = None
+if settings.get("ingest", {}).get("write_behind"):
+    journal = settings["ingest"].get("journal", "ingest.journal")
+    if app.workers > 1:
+        # One journal per process
+        journal = "{}.{}".format(journal, app.worker)
+    app.journal = IngestJournal(journal, settings["ingest"].get("batch_size", 500))
+    app.journal.start()
+
+# Payloads uploaded in chunks, kept in files shared by the processes until they are complete
+# The maximum size applies to the decompressed payloads of /upload_json/ and to the payloads sent in chunks
+app.uploads = uploads.ChunkStore(settings.get("ingest", {}).get("chunks", "upload_chunks"),
+                                 settings.get("ingest", {}).get("max_payload_size", 64) * 1024 * 1024)
+
+# Responses of the monitoring pages and exports are cached until the tables they read are modified
+# The caches are disabled with several processes: a process does not see the modifications made by the others
+cache.responses.enabled = settings.get("cache", {}).get("enabled", True) and app.workers == 1
+analytics.cache.enabled = app.workers == 1
+cache.responses.max_size = settings.get("cache", {}).get("max_size", 64) * 1024 * 1024
 
 
 
@@ -61,32 +106,30 @@ def indentification():
     # We first check if the required field is sent
     if "key" in request.form:
         key = request.form["key"]
-        print("    [ {} waiting for the players lock... ]".format(key))
-        # We wait for the connection lock
-        # This lock is used to ensure that no 2 client can connect with the same key
-        app.lock_connections.acquire()
-        print("    [ {} has acquired the players lock... ]".format(key))
         # We check if the key exists and is not already used
         try:
             player = db_session.query(Player).filter_by(key=key).one()
-            if player.in_use == 0:
-                # The key is now used
-                player.in_use = 1
-                db_session.commit()
+        except NoResultFound as e:
+            return jsonify(status=0, text="You entered a wrong key! Try again...")
+        except Exception as e:
+            print(e)
+            return jsonify(status=-1, text="Server error, try again please."), 500
+
+        # The key is claimed with a conditional update: only one request can change in_use from 0 to 1,
+        # even if the requests are handled by different processes
+        try:
+            claimed = db_session.query(Player).filter(Player.id == player.id, Player.in_use == 0).update({"in_use": 1}, synchronize_session=False)
+            db_session.commit()
+            if claimed == 1:
+                cache.bump("players")
                 return jsonify(status=1, data={"player_id": player.id}, text="Identification successful...")
             else:
                 # The key is already used
                 return jsonify(status=-1, data={"player_id": player.id}, text="Key already in use!\nPlease enter another key...")
-
-        except NoResultFound as e:
-            return jsonify(status=0, text="You entered a wrong key! Try again...")
         except Exception as e:
             print(e)
+            db_session.rollback()
             return jsonify(status=-1, text="Server error, try again please."), 500
-        finally:
-            # Once the database interaction is over, we release the connection lock
-            print("    [ {} has released the connections lock ]".format(key))
-            app.lock_connections.release()
     else:
         # The required field was not sent
         key = None
@@ -99,101 +142,33 @@ def indentification():
 def connect():
     """
     A client makes himself available for connetion giving his player id in the POST request
-    If he is successfuly added to available players, the connection id is returned and  a thread is launched to find another available player
+    If he is successfuly added to available players, the connection id is returned
+    If another player of the same session and pair is waiting, both players are connected right away (see matchmaking.py)
     """
     player_id = int(request.form["id"])
-    print("    [ {} waiting for the connections lock... ]".format(player_id))
-    # We wait for the connection lock
-    # The lock is used for integrity, to ensure the connection by pair
-    app.lock_connections.acquire()
-    print("    [ {} has acquired the connections lock... ]".format(player_id))
     try:
-        # We add the player to the players available for connection
         player = Player.query.get(player_id)
+        if player is None:
+            raise NoResultFound()
+        if player.connection is not None:
+            # The client sends /connect/ again when it did not get the answer
+            return jsonify(status=1, data=player.connection.id, text="Added to available players...")
+        # We add the player to the players available for connection
+        # and connect him with a waiting player, or he waits for the next one
         conn = Connection(player_id)
-        conn_id = None
-        print("Adding to db...")
-        db_session.add(conn)
-        db_session.commit()
+        conn_with = app.matchmaker.connect(player, conn)
+        cache.bump("connections")
         conn_id = conn.id
-        print("Added to db...")
-        # We launch a new thread to connect the player with another available player
-        thread = Thread(target=connect_player, args=(player_id,), name="Connect-Player-{}".format(player_id))
-        thread.start()
+        if conn_with is not None:
+            print("Connected {} with {}".format(conn_with.player_id, player_id))
         return jsonify(status=1, data=conn_id, text="Added to available players...")
     except NoResultFound:
         # The player does not exists
-        return jsonify(satus=0, data=None, text="This player does not exists!")
+        return jsonify(status=0, data=None, text="This player does not exists!")
     except Exception as e:
         # Server error
         print(e)
-        return jsonify(satus=-1, data=None, text="Server error...")
-    finally:
-        # Finally we release the connection lock
-        app.lock_connections.release()
-        print("    [ {} has released the connections lock ]".format(player_id))
-
-
-
-def connect_player(player_id):
-    """
-    For a specific player, looks for another available player and connects to him
-    In this setting, only players with same session number and pair can be connected, but this can be removed
-    """
-
-    # We get the corresponding player
-    try:
-        player = Player.query.get(player_id)
-    except:
-        # if the player does not exist, we stop
-        return 0
-
-    connected = False
-
-    while not connected:
-        # We loop until we find an available player
-        print("    [ {} waiting for connections the lock... ]".format(player_id))
-        # We wait for the connection lock
-        app.lock_connections.acquire()
-        print("    [ {} has acquired the connections lock... ]".format(player_id))
-
-        # We refresh the player values to see if it has been connected already
-        player = Player.query.get(player_id)
-        conn = player.connection
-
-        if conn.connected_player_id is not None:
-            # The player has already been connected
-            connected = True
-            app.lock_connections.release()
-        else:
-            # We look for the other player
-            q = db_session.query(Connection).join(Connection.players).filter(Connection.player_id!=player_id, Connection.status==0, Player.session_nr==player.session_nr, Player.pair==player.pair)
-            try:
-                conn_with = q.first()
-                # We connect the 2 players and assign the roles
-                conn.status = 1
-                conn.connected_player_id = conn_with.players.id
-                conn.role = 0
-                conn_with.status = 1
-                conn_with.connected_player_id = conn.players.id
-                conn_with.role = 1
-                db_session.commit()
-                connected = True
-                print("Connected {} with {}".format(conn.player_id, conn_with.player_id))
-            except Exception as e:
-                # No player was found, we cancel any database modification
-                db_session.rollback()
-                print("No other player available... New attempt...")
-            finally:
-                # We release the lock
-                app.lock_connections.release()
-
-        print("    [ {} has released the connections lock ]".format(player_id))
-        if not connected:
-            # We wait before attempting again
-            time.sleep(1)
-
-    return 0
+        return jsonify(status=-1, data=None, text="Server error...")
 
 
 
@@ -201,12 +176,50 @@ def connect_player(player_id):
 def connected_with(player_id):
     """
     For a specific player, returns the connected player if it is connected
+    With the wait argument (in seconds), the request is held until the player is connected or the time is over (long polling)
+    """
+    wait = 0
+    if player_id.isdigit():
+        wait = request.args.get("wait", 0, type=float)
+        if math.isnan(wait):
+            return jsonify(status=0, data=None, text="wait must be a number of seconds!"), 400
+        wait = min(max(wait, 0), settings["server"].get("long_poll", 25))
+    deadline = time.time() + wait
+    # The event is only created for a player waiting for a connection, the events are removed on disconnection
+    event = None
+
+    while True:
+        if event is not None:
+            event.clear()
+        response, connected = connection_status(player_id)
+        remaining = deadline - time.time()
+        if connected is not False or remaining <= 0:
+            return response
+        if event is None:
+            # The connection is read again once the event exists, so that a change in the meantime is not missed
+            event = app.matchmaker.event(int(player_id))
+            db_session.rollback()
+            continue
+        # We wait until the connection of the player changes
+        # With several processes, the connection may be changed by another process and the database is polled,
+        # the player is matched again in case his partner connected at the same time in another process
+        if app.matchmaker.poll_interval is not None:
+            if app.matchmaker.rematch(int(player_id)):
+                continue
+            remaining = min(remaining, app.matchmaker.poll_interval)
+        event.wait(remaining)
+        # We end the transaction to read the new connection state
+        db_session.rollback()
+
+
+
+def connection_status(player_id):
+    """
+    Returns the response of connected_with for a player and whether the player is connected
+    None is returned instead of a boolean when waiting is pointless (no connection or error)
+    Only reads are done, so no lock is needed
     """
 
-    print("    [ {} waiting for connections the lock... ]".format(player_id))
-    # We wait for the connection lock
-    app.lock_connections.acquire()
-    print("    [ {} has acquired the connections lock... ]".format(player_id))
     # We look if the player is connected and with whom
     try:
         player = Player.query.get(player_id)
@@ -214,27 +227,23 @@ def connected_with(player_id):
 
         if conn is None:
             # The player is not available for connection
-            return jsonify(status=0, data=None, text="Player not available for connection!")
+            return jsonify(status=0, data=None, text="Player not available for connection!"), None
         if conn.connected_player_id is None:
             # The player has not been connected
-            return jsonify(status=0, data=None, text="Not connected yet...")
+            return jsonify(status=0, data=None, text="Not connected yet..."), False
         # We return as connection_id the connection id of the player with role 1 in the pair
         if conn.role == 1:
             connection_id = conn.id
         else:
             connection_id = conn.connected_player.connection.id
 
-        return jsonify(status=1, data={"connection_id":connection_id, "connected_player_name": conn.connected_player.name, "connected_player_id": conn.connected_player.id, "role":conn.role}, text="OK")
+        return jsonify(status=1, data={"connection_id":connection_id, "connected_player_name": conn.connected_player.name, "connected_player_id": conn.connected_player.id, "role":conn.role}, text="OK"), True
     except NoResultFound as e:
         # The player does not exist
-        return jsonify(status=0, data=None, text="This player does not exist!")
+        return jsonify(status=0, data=None, text="This player does not exist!"), None
     except Exception as e:
         # Server error
-        return jsonify(status=-1, data=None, text="Server error..."), 500
-    finally:
-        # Finally we release the lock
-        app.lock_connections.release()
-        print("    [ {} has released the connections lock ]".format(player_id))
+        return (jsonify(status=-1, data=None, text="Server error..."), 500), None
 
 
 
@@ -244,58 +253,45 @@ def disconnect(player_id):
     Disconnects a player and the connected player
     """
 
-    print("    [ {} waiting for connections the lock... ]".format(player_id))
-    # We wait for the connection lock
-    app.lock_connections.acquire()
-    print("    [ {} has acquired the connections lock... ]".format(player_id))
     # We look for the player and disconnect him and the connected player
     try:
         player = Player.query.get(player_id)
-        conn = player.connection
-        player.in_use = 0
-        if conn is None:
+        if player is None:
+            raise NoResultFound()
+        # The matchmaker disconnects the player, the connected player is available again for connection
+        if not app.matchmaker.disconnect(player):
             # The player is not connected
+            cache.bump("players")
             return jsonify(status=1, data=None, text="Player not connected.")
-        else:
-            # We disconnect the player and the connected player
-            db_session.delete(conn)
-            if player.connection_other:
-                connected_player_conn = player.connection_other
-                connected_player_conn.connected_player_id = None
-                connected_player_conn.role = None
-                connected_player_conn.status = 0
-            db_session.commit()
-            return jsonify(status=1, data=None, text="Player disconnected.")
+        cache.bump("connections", "players")
+        return jsonify(status=1, data=None, text="Player disconnected.")
     except NoResultFound as e:
         # Either the player does not exist or it has already been disconnected
         return jsonify(status=0, data=None, text="Player not found in connections!\nEither it does not exists or it has already been disconnected.")
     except Exception as e:
         # Server error
+        print(e)
+        db_session.rollback()
         return jsonify(status=-1, data=None, text="Server error..."), 500
-    finally:
-        # Finally we realease the lock
-        app.lock_connections.release()
-        print("    [ {} has released the connections lock ]".format(player_id))
 
 
 
 @app.route('/upload_json/', methods=['GET', 'POST'])
 def upload_json():
     """
-    Handles the JSON coming from Minecraft client containing statistics
+    Handles the JSON coming from Minecraft client containing statistics, compressed or not (Content-Encoding gzip or deflate)
     """
     if request.method == 'POST':
+        metrics.observe_payload("upload_json")
         # We get the JSON
-        data = request.get_json(silent=True)
+        try:
+            data = read_upload()
+        except uploads.PayloadTooLarge as e:
+            return str(e), 413
+        except ValueError as e:
+            return "Invalid JSON data: {}".format(e), 400
         if data:
-            # We add the statistics to the database
-            try:
-                add_stats_to_db(data)
-                return "Stats added to db.", 200
-            except Exception as e:
-                # Exception when adding statistics
-                print("Problem adding stats to db: {}".format(e))
-                return "Problem adding stats to db: {}".format(e), 400
+            return ingest_upload(data)
         else:
             # No JSON was sent
             return "No JSON data was sent!", 400
@@ -304,26 +300,130 @@ def upload_json():
 
 
 
-def add_stats_to_db(data):
-    """Add data statistics to the database"""
-    # Expected parameters
-    session_uuid = data['session_id']
-    world = data['world']
-    round = data['round']
-    player_id = data['player']
-    stats = json.loads(data['stats'])
+def read_upload():
+    """Returns the JSON of the request, decompressed according to its Content-Encoding (see uploads.py)"""
+    if request.content_length is not None and request.content_length > app.uploads.max_size:
+        raise uploads.PayloadTooLarge("The payload is larger than {} bytes".format(app.uploads.max_size))
+    body = request.get_data(cache=False)
+    if not body:
+        return None
+    return uploads.read_json(body, request.headers.get("Content-Encoding"), app.uploads.max_size)
+
+
+
+def ingest_upload(data):
+    """Adds the statistics of a payload to the database (or to the journal), returns the text and status code of the response"""
+    if app.journal is not None:
+        # Write-behind mode: the statistics are checked and journaled, they are added to the database in the background
+        try:
+            ingest.parse_payload(data)
+            app.journal.append(data)
+            return "Stats accepted.", 202
+        except Exception as e:
+            print("Problem adding stats to db: {}".format(e))
+            return "Problem adding stats to db: {}".format(e), 400
+    # We add the statistics to the database
     try:
-        position_over_time = data['position_over_time']
+        try:
+            add_stats_to_db(data)
+        except IntegrityError:
+            # The session, test or stat was created by another upload in the meantime
+            db_session.rollback()
+            add_stats_to_db(data)
+        return "Stats added to db.", 200
     except Exception as e:
-        print(e)
-        position_over_time = None
+        # Exception when adding statistics
+        print("Problem adding stats to db: {}".format(e))
+        return "Problem adding stats to db: {}".format(e), 400
+
+
+
+@app.route('/upload_json/chunks/', methods=['GET', 'PUT'])
+def upload_json_chunk():
+    """
+    Handles a payload of /upload_json/ sent in chunks, identified by the session_id, world, round and player arguments
+    GET gives the number of bytes received. PUT adds the chunk (body) starting at byte offset of the payload of total bytes
+    (offset and total arguments), the Content-Encoding of the payload is given with the last chunk.
+    The payload is added to the database once all its bytes are received, complete is true in data once it is added.
+    """
+    try:
+        key = uploads.payload_key(request.args["session_id"], request.args["world"], request.args["round"], request.args["player"])
+    except (KeyError, ValueError):
+        return jsonify(status=0, data=None, text="session_id, world, round and player are required!"), 400
+    if request.method == 'GET':
+        return jsonify(status=1, data={"received": app.uploads.received(key), "complete": app.uploads.is_complete(key)}, text="OK")
+
+    metrics.observe_payload("upload_json_chunk")
+    offset = request.args.get("offset", type=int)
+    total = request.args.get("total", type=int)
+    if offset is None or total is None:
+        return jsonify(status=0, data=None, text="offset and total are required!"), 400
+    chunk = request.get_data(cache=False)
+    try:
+        (received, body) = app.uploads.append(key, offset, chunk, total)
+    except (uploads.OffsetMismatch, uploads.UploadInProgress) as e:
+        return jsonify(status=0, data={"received": e.received, "complete": False}, text=str(e)), 409
+    except uploads.PayloadTooLarge as e:
+        return jsonify(status=0, data=None, text=str(e)), 413
+    except ValueError as e:
+        return jsonify(status=0, data=None, text=str(e)), 400
+    if received < total:
+        return jsonify(status=1, data={"received": received, "complete": False}, text="Chunk received.")
+    if body is None:
+        # The last chunk was sent again, the payload was already added
+        return jsonify(status=1, data={"received": received, "complete": True}, text="Upload already complete.")
+
+    # The payload is complete, it is removed if it is not valid (sent again from the start)
     try:
-        solution = data['solution']
+        data = uploads.read_json(body, request.headers.get("Content-Encoding"), app.uploads.max_size)
+        values = ingest.parse_payload(data)
+        if (values["session_uuid"], values["world"], values["round"], values["player_id"]) != key:
+            raise ValueError("The payload does not match session_id, world, round and player")
+    except uploads.PayloadTooLarge as e:
+        app.uploads.release(key, keep=False)
+        return jsonify(status=0, data={"received": 0, "complete": False}, text=str(e)), 413
     except Exception as e:
-        solution = "Not implemented"
+        app.uploads.release(key, keep=False)
+        return jsonify(status=0, data={"received": 0, "complete": False}, text="Invalid payload: {}".format(e)), 400
+    (text, code) = ingest_upload(data)
+    if code >= 300:
+        # The payload is kept, it is added again when its last chunk is sent again
+        app.uploads.release(key)
+        return jsonify(status=0, data={"received": total, "complete": False}, text=text), code
+    app.uploads.finish(key, offset, chunk, total)
+    return jsonify(status=1, data={"received": total, "complete": True}, text=text), code
+
+
+
+@app.route('/upload_json/batch', methods=['POST'])
+def upload_json_batch():
+    """
+    Handles a list of JSON statistics (same format as /upload_json/), added to the database in one transaction
+    The result of each element is returned in data, in the same order
+    """
+    metrics.observe_payload("upload_json_batch")
+    try:
+        data = read_upload()
+    except uploads.PayloadTooLarge as e:
+        return jsonify(status=0, text=str(e)), 413
+    except ValueError:
+        data = None
+    if not isinstance(data, list):
+        return jsonify(status=0, text="A JSON array of statistics was expected!"), 400
+    results = ingest.add_stats_batch(data)
+    added = len([result for result in results if result["status"] == 1])
+    return jsonify(status=1 if added == len(results) else 0, data=results, text="{} of {} stats added to db.".format(added, len(results)))
+
 
-    checkpoints = data['checkpoints']
-    score = int(data['score'])
+
+def add_stats_to_db(data):
+    """Add data statistics to the database"""
+    # Expected parameters
+    values = ingest.parse_payload(data)
+    session_uuid = values["session_uuid"]
+    world = values["world"]
+    round = values["round"]
+    player_id = values["player_id"]
 
     # try to find if the session has already been created
     # if not: create a new one
@@ -349,64 +449,34 @@ def add_stats_to_db(data):
         stat = Stat(test.id, player_id)
         test.stats.append(stat)
 
-    items = []
-
-    try:
-        stat.position_over_time = json.dumps(position_over_time)
-    except Exception as e:
-        print(e)
+    stat_values, items = ingest.parse_stats(values["stats"])
+    trajectory_values = ingest.apply_stat_values(stat, values, stat_values)
 
-    stat.checkpoints = json.dumps(checkpoints)
-    stat.solution = solution
-    stat.score = score
-
-    items = {}
-
-    for (k,v) in stats.items():
-        k = k.split('.')
-        attr = k[0]
-        if attr == 'stat':
-            # changes columnName into column_name
-            column = re.sub("([A-Z])","_\g<1>", k[1]).lower()
-            if len(k) == 3:
-                update = False
-                item_id = k[2]
-                # try to find an already existing item in db
-                # if exists: update it
-                # else: create it
-                if not item_id in items:
-                    items[item_id] = {}
-                items[item_id][column] = v
-            else:
-                # only adds statistics defined in db
-                try:
-                    setattr(stat, column, v)
-                except:
-                    pass
-        elif attr == 'achievement':
-            achiev = k[1]
-            if achiev == 'exploreAllBiomes':
-                try:
-                    setattr(stat, 'number_biomes', len(v['progress']))
-                except:
-                    pass
-        else:
-            pass
+    # We get all the already existing items of the player in one query
+    existing_items = {}
+    if test.id is not None:
+        existing_items = dict((item.item_item, item) for item in db_session.query(Item).filter_by(test_id=test.id, player_id=player_id))
 
     for (item_id, item_values) in items.items():
-        try:
-            item = db_session.query(Item).filter_by(test_id=test.id, player_id=player_id, item_item=item_id).one()
-
-        except:
+        # if the item exists: update it
+        # else: create it
+        item = existing_items.get(item_id)
+        if item is None:
             item = Item(test.id, player_id)
-            test.items.append(item)
-            setattr(item, 'item_item', item_id)
+            item.test = test
+            item.item_item = item_id
+            db_session.add(item)
 
         for (action, n) in item_values.items():
             setattr(item, action, n)
 
     db_session.add(session)
+    db_session.flush()
+    ingest.save_trajectories({stat.id: trajectory_values})
+    # The team scores of all the players of the test change
+    ingest.update_players_score([player_id for (player_id,) in db_session.query(Stat.player_id).filter_by(test_id=test.id)])
     db_session.commit()
+    ingest.notify_written([(test.id, player_id)])
 
 
 
@@ -436,31 +506,40 @@ def view_index():
 
 
 @app.route("/view/connections/")
+@cache.cached("connections")
 def view_connections():
     """Shows the current connections"""
 
     columns = [c.name for c in Connection.__table__.columns]
-    connections = db_session.query(Connection).all()
-    return render_template("view_data.djhtml", title="Connections", columns=columns, data=connections)
+    try:
+        page = pagination.paginate(db_session.query(Connection), Connection, request.args)
+    except ValueError as e:
+        return str(e), 400
+    return pagination.render_page(page, columns, title="Connections")
 
 
 
 @app.route("/view/sessions/")
+@cache.cached("sessions")
 def view_sessions():
     """Shows the saved sessions in the database"""
 
     columns = [c.name for c in Session.__table__.columns]
     # We add the link to the tests of the session
     columns.append("view_tests")
-    sessions = db_session.query(Session).all()
+    try:
+        page = pagination.paginate(db_session.query(Session), Session, request.args)
+    except ValueError as e:
+        return str(e), 400
     # For each tests in the session we get the corresponding id
-    [setattr(session, "view_tests", "/view/tests/{}".format(session.id)) for session in sessions]
+    [setattr(session, "view_tests", "/view/tests/{}".format(session.id)) for session in page.rows]
 
-    return render_template("view_data.djhtml", title="Sessions", columns=columns, data=sessions)
+    return pagination.render_page(page, columns, title="Sessions")
 
 
 
 @app.route("/view/tests/<int:session_id>")
+@cache.cached("tests")
 def view_tests(session_id):
     """Show the tests of a specific session"""
 
@@ -468,35 +547,44 @@ def view_tests(session_id):
     # We add the link to the stats and items of the test
     columns.append("view_stats")
     columns.append("view_items")
-    tests = db_session.query(Test).filter_by(session_id=session_id).all()
+    try:
+        page = pagination.paginate(db_session.query(Test).filter_by(session_id=session_id), Test, request.args)
+    except ValueError as e:
+        return str(e), 400
     # For each stats and items in the test we get the corresponding id
-    [setattr(test, "view_stats", "/view/stats/{}".format(test.id)) for test in tests]
-    [setattr(test, "view_items", "/view/items/{}".format(test.id)) for test in tests]
+    [setattr(test, "view_stats", "/view/stats/{}".format(test.id)) for test in page.rows]
+    [setattr(test, "view_items", "/view/items/{}".format(test.id)) for test in page.rows]
 
-    return render_template("view_data.djhtml", title="Tests for session {}".format(session_id), columns=columns, data=tests, back="/view/sessions/")
+    return pagination.render_page(page, columns, title="Tests for session {}".format(session_id), back="/view/sessions/")
 
 
 
 @app.route("/view/stats/<int:test_id>")
+@cache.cached("stats", "tests")
 def view_stats(test_id):
     """Show the stats for a specific test"""
 
     columns = [c.name for c in Stat.__table__.columns]
     # We remove columns we do not want to show
     columns.remove("position_over_time")
-    stats = db_session.query(Stat).filter_by(test_id=test_id).all()
-    # pretty print for the position_over_time field
-    # for stat in stats:
-    #     stat.position_over_time = {k: json.loads(v) for (k,v) in json.loads(stat.position_over_time).items()}
+    # We add the link to the trajectory of the player
+    columns.append("view_trajectory")
+    try:
+        page = pagination.paginate(db_session.query(Stat).filter_by(test_id=test_id), Stat, request.args)
+    except ValueError as e:
+        return str(e), 400
+    # For each stat we link its trajectory
+    [setattr(stat, "view_trajectory", "/trajectory/{}".format(stat.id)) for stat in page.rows]
 
     # Link to go back to the tests
     session_id = db_session.query(Test).get(test_id).session_id
 
-    return render_template("view_data.djhtml", title="Stats for test {}".format(test_id), columns=columns, data=stats, back="/view/tests/{}".format(session_id))
+    return pagination.render_page(page, columns, title="Stats for test {}".format(test_id), back="/view/tests/{}".format(session_id))
 
 
 
 @app.route("/view/items/<int:test_id>")
+@cache.cached("items", "item_names", "tests")
 def view_items(test_id):
     """Show the items for a specific test"""
 
@@ -508,15 +596,73 @@ def view_items(test_id):
     # We add the id and name of the item
     columns.insert(1, "item_id")
     columns.insert(2, "name")
-    items = db_session.query(Item).filter_by(test_id=test_id).all()
-    # We link the id and name of the item
-    [setattr(item, "item_id", item.item.item) for item in items]
-    [setattr(item, "name", item.item.name) for item in items]
+    try:
+        page = pagination.paginate(db_session.query(Item).filter_by(test_id=test_id), Item, request.args)
+    except ValueError as e:
+        return str(e), 400
+    # We link the id and name of the item, the names are read from the catalog
+    item_names = catalog.names()
+    [setattr(item, "item_id", item.item_item) for item in page.rows]
+    [setattr(item, "name", item_names.get(item.item_item)) for item in page.rows]
 
     # Link to go back to the tests
     session_id = db_session.query(Test).get(test_id).session_id
 
-    return render_template("view_data.djhtml", title="Items for test {}".format(test_id), columns=columns, data=items, back="/view/tests/{}".format(session_id))
+    return pagination.render_page(page, columns, title="Items for test {}".format(test_id), back="/view/tests/{}".format(session_id))
+
+
+
+@app.route("/trajectory/<int:stat_id>")
+@cache.cached("trajectories")
+def view_trajectory(stat_id):
+    """
+    Sends the trajectory of a player as JSON: {"time": [t1, t2...], "position": [[x1, y1, z1], [x2, y2, z2]...]}
+    Optional parameters start and end: only the points with start <= time <= end
+    """
+    start = request.args.get("start", type=float)
+    end = request.args.get("end", type=float)
+    row = db_session.query(Trajectory).filter_by(stat_id=stat_id).first()
+    if row is None:
+        return jsonify(status=0, text="No trajectory for stat {}".format(stat_id)), 404
+    (times, positions) = trajectory.time_slice(*trajectory.decode(row.data), start=start, end=end)
+    return jsonify(status=1, text="{} points".format(len(times)), data={"stat_id": stat_id, "time": times, "position": positions})
+
+
+
+#############################
+# Analytics of trajectories #
+#############################
+
+@app.route("/analytics/metrics/test/<int:test_id>")
+@app.route("/analytics/metrics/world/<string:world>")
+def analytics_metrics(test_id=None, world=None):
+    """Sends the metrics of the trajectories of the players of a test or a world as JSON, see analytics.py"""
+    if analytics.np is None:
+        return jsonify(status=-1, text="NumPy is needed for the analytics"), 501
+    players = analytics.load(test_id=test_id, world=world)
+    data = [dict(value["metrics"], test_id=player_test_id, player_id=player_id) for (player_test_id, player_id, value) in players]
+    return jsonify(status=1, text="{} players".format(len(data)), data=data)
+
+
+
+@app.route("/analytics/heatmap/test/<int:test_id>")
+@app.route("/analytics/heatmap/world/<string:world>")
+def analytics_heatmap(test_id=None, world=None):
+    """
+    Sends the occupancy heatmap of the players of a test or a world as JSON, see analytics.py
+    Optional parameter cell: size of the cells in blocks (default 1)
+    """
+    if analytics.np is None:
+        return jsonify(status=-1, text="NumPy is needed for the analytics"), 501
+    cell_size = request.args.get("cell", 1.0, type=float)
+    if cell_size <= 0:
+        return jsonify(status=0, text="The cell size must be positive"), 400
+    players = analytics.load(test_id=test_id, world=world)
+    try:
+        data = analytics.heatmap(players, cell_size)
+    except ValueError as e:
+        return jsonify(status=0, text=str(e)), 400
+    return jsonify(status=1, text="{} players".format(len(players)), data=data)
 
 
 
@@ -525,100 +671,89 @@ def view_items(test_id):
 ##########################
 
 @app.route("/view/sessions/csv/")
+@cache.cached("sessions", "tests", "stats", "items", "item_names")
 def view_sessions_csv():
-    """Exports the statistics data to a CSV file"""
-    response = make_response(utils.stats_to_csv().getvalue())
+    """Exports the statistics data to a CSV file, sent while it is generated"""
+    response = Response(stream_with_context(utils.stats_to_csv()))
     response.headers["Content-Disposition"] = "attachment; filename=stats.csv"
     response.headers["Content-type"] = "text/csv"
     return response
 
 
+@app.route("/view/sessions/npz/")
+@cache.cached("sessions", "tests", "stats", "items")
+def view_sessions_npz():
+    """Exports the statistics data as NumPy arrays (one per column) in a npz file, see export.py"""
+    # The temporary file is removed once the response is sent
+    f = tempfile.TemporaryFile()
+    try:
+        export.export(f, "npz")
+    except RuntimeError as e:
+        f.close()
+        return str(e), 501
+    f.seek(0)
+    return send_file(f, mimetype="application/octet-stream", as_attachment=True, attachment_filename="stats.npz")
+
+
 
 ######################
 # Players management #
 ######################
 
+# Columns of the players which can be modified from the web interface
+PLAYER_MODIFIABLE_COLUMNS = ["name", "condition", "player_condition"]
 
 
 @app.route("/players/")
+@cache.cached("players")
 def players():
     """Interface for managing players"""
-    update_players_score()
     sessions = [s for s in db_session.query(Player.session_nr, func.count(Player.pair)).group_by(Player.session_nr).all()]
     return render_template("players.djhtml", title="Manage players", sessions=sessions)
 
 
 
 @app.route("/players/<int:session_nr>")
+@cache.cached("players")
 def view_players(session_nr):
     """
     Shows the players of a specific session
     Several fields can be modified
     """
-    update_players_score()
     columns = [c.name for c in Player.__table__.columns]
     # Specificies the modifiable fields
-    modifiable = ["name", "condition", "player_condition"]
+    modifiable = PLAYER_MODIFIABLE_COLUMNS
     # Link to the target of the AJAX POST request for modifiying fields
     action = "/players/update/"
-    players = db_session.query(Player).filter_by(session_nr=session_nr).all()
-    return render_template("view_data.djhtml", title="Players for session {}".format(session_nr), id=session_nr, columns=columns, data=players, modifiable=modifiable, action=action, back="/players/")
-
-
-def update_players_score():
-    """Updates the score for each player"""
-    for player in db_session.query(Player).all():
-        try:
-            last_test = db_session.query(Test).join(Stat).filter(Stat.player_id==player.id).order_by(desc(Test.timestamp)).one()
-            score = 0
-            team_score_avg = []
-            team_score_max = 0
-            for stat in last_test.stats:
-                team_score_avg.append(stat.score)
-                if stat.score > team_score_max:
-                    team_score_max = stat.score
-                if stat.player_id == player.id:
-                    score = stat.score
-            player.score = score
-            player.team_score_avg = float(sum(team_score_avg)) / len(team_score_avg)
-            player.team_score_max = team_score_max
-            db_session.commit()
-        except Exception as e:
-            pass
+    try:
+        page = pagination.paginate(db_session.query(Player).filter_by(session_nr=session_nr), Player, request.args)
+    except ValueError as e:
+        return str(e), 400
+    return pagination.render_page(page, columns, title="Players for session {}".format(session_nr), id=session_nr, modifiable=modifiable, action=action, back="/players/")
 
 
 @app.route("/players/create/", methods=["POST"])
 def create_players():
-    """Creates a session of number_players players"""
+    """Creates number_sessions (default 1) sessions of number_players players"""
     if "number_players" in request.form:
         try:
-            # We check if the parameter is an even int
+            # We check if the parameters are ints
             number_players = int(request.form["number_players"])
-            if number_players % 2 != 0:
-                flash("Odd number of players!")
-            else:
-                try:
-                    # We compute the session number
-                    last_session_nr = db_session.query(func.max(Player.session_nr)).one()[0]
-                    last_session_nr = last_session_nr if last_session_nr else 0
-                    session_nr = last_session_nr + 1
-                    for i in range(number_players):
-                        added = False
-                        # For each player we generate a random key
-                        while not added:
-                            try:
-                                key = '{0:06}'.format(randint(1, 1000000))
-                                db_session.add(Player(key, key, session_nr, int(i/2) + 1, 0, i%2 + 1))
-                                db_session.commit()
-                                # The key did not exist and has been added
-                                added = True
-                            except Exception as e:
-                                # The key already exists
-                                db_session.rollback()
-                    flash("The players were created! The session number is {}.".format(session_nr))
-                except Exception as e:
-                    # Unknown exception
-                    flash("An exception has occured!<br />Exception message: {}".format(e))
+            number_sessions = int(request.form.get("number_sessions") or 1)
+            try:
+                sessions = registration.create_sessions([number_players] * number_sessions)
+                cache.bump("players")
+                if len(sessions) == 1:
+                    flash("The players were created! The session number is {}.".format(sessions[0][0]))
+                else:
+                    flash("The players were created! The session numbers are {} to {}.".format(sessions[0][0], sessions[-1][0]))
+            except ValueError as e:
+                # Invalid number of players (ex. odd number)
+                flash(str(e))
+            except Exception as e:
+                # Unknown exception
+                db_session.rollback()
+                flash("An exception has occured!<br />Exception message: {}".format(e))
 
         except ValueError as e:
             # The parameter was not an int
@@ -630,29 +765,92 @@ def create_players():
 
 
 
+@app.route("/players/create/sessions/", methods=["POST"])
+def create_sessions():
+    """
+    Creates several sessions of players at once (JSON API), the JSON sent is {"sessions": [number of players of each session]}
+    Returns in data the sessions created: [{"session_nr": session number, "keys": keys of the players, in pair order}]
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("sessions"), list):
+        return jsonify(status=0, text="A JSON object {\"sessions\": [number of players of each session]} was expected!"), 400
+    try:
+        sessions = registration.create_sessions(data["sessions"])
+    except ValueError as e:
+        return jsonify(status=0, text=str(e)), 400
+    except Exception as e:
+        print(e)
+        db_session.rollback()
+        return jsonify(status=-1, text="Server error..."), 500
+    cache.bump("players")
+    data = [{"session_nr": session_nr, "keys": keys} for (session_nr, keys) in sessions]
+    return jsonify(status=1, text="{} sessions created".format(len(data)), data=data)
+
+
+
 @app.route("/players/update/", methods=["POST"])
 def update_player():
-    """Updates players' information (AJAX call)"""
+    """
+    Updates players' information (AJAX call), the JSON sent is {"update_players": [{"id": player id, column: value...}]}
+    The players are read with one query, only the values which changed are written, in one bulk update
+    Returns in data the ids of the players which changed
+    """
     data = request.get_json(silent=True)
     if data:
         try:
+            updates = {}
             for update_player in data["update_players"]:
-                player_id = update_player.pop("id")
-                player = db_session.query(Player).get(player_id)
-                for (attr, value) in update_player.items():
-                    setattr(player, attr, value)
-                    db_session.add(player)
-            db_session.commit()
-            return jsonify(status=1, text="Update successful")
+                update_player = dict(update_player)
+                updates[int(update_player.pop("id"))] = update_player
+            players = {}
+            for ids in ingest.chunks(updates.keys()):
+                players.update((player.id, player) for player in db_session.query(Player).filter(Player.id.in_(ids)))
+            unknown = sorted(set(updates) - set(players))
+            if unknown:
+                return jsonify(status=0, data=unknown, text="Unknown players: {}".format(", ".join(map(str, unknown))))
+
+            changes = []
+            for (player_id, values) in updates.items():
+                changed = {}
+                for (column, value) in values.items():
+                    if column not in PLAYER_MODIFIABLE_COLUMNS:
+                        return jsonify(status=0, data=column, text="The column {} can not be modified!".format(column))
+                    value = coerce_player_value(column, value)
+                    if value != getattr(players[player_id], column):
+                        changed[column] = value
+                if changed:
+                    changes.append(dict(changed, id=player_id))
+            if changes:
+                db_session.bulk_update_mappings(Player, changes)
+                db_session.commit()
+                cache.bump("players")
+            changed_ids = sorted(change["id"] for change in changes)
+            return jsonify(status=1, data={"changed": changed_ids}, text="Update successful, {} players changed".format(len(changed_ids)))
+        except ValueError as e:
+            # A value does not match the type of its column
+            return jsonify(status=0, data=str(e), text="Invalid value!")
         except Exception as e:
+            db_session.rollback()
             return jsonify(status=-1, data=str(e), text="Exception!")
     else:
         return jsonify(status=0, text="No JSON provided!")
 
 
 
+def coerce_player_value(column, value):
+    """Converts a value sent for a column of the players (ex. the text of an input) to the type of the column"""
+    column = Player.__table__.c[column]
+    if value is None or (value == "" and not isinstance(column.type, String)):
+        return None
+    if not isinstance(value, str):
+        value = str(value)
+    return pagination.coerce(column, value)
+
+
+
 
 @app.route("/players/export/csv/<int:session_number>", methods=["GET"])
+@cache.cached("players")
 def export_csv_players(session_number):
     """Exports the players as CSV"""
     try:
@@ -670,6 +868,7 @@ def export_csv_players(session_number):
 # Special file Allocation.txt needed for the intermediate game
 # (Minecraft independent feature)
 @app.route("/players/export/allocation/<int:session_number>", methods=["GET"])
+@cache.cached("players")
 def export_allocation_players(session_number):
     """Exports the Allocation.txt file"""
     try:
@@ -683,6 +882,15 @@ def export_allocation_players(session_number):
 
 
 
+@app.route("/metrics")
+def view_metrics():
+    """Metrics of the server in the Prometheus text format, see metrics.py"""
+    if not metrics.enabled:
+        return "The metrics are disabled.", 404
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     db_session.remove()
@@ -0,0 +1,1323 @@
+"""
+Benchmarks of the server, to compare implementations and detect regressions
+
+Each benchmark runs against a temporary SQLite database, the database defined in settings.yml is never used.
+Usage:
+    python benchmark.py <benchmark> [arguments]
+Available benchmarks:
+    * pairing [number_pairs]: time to pair players, matchmaking engine against the former polling threads
+    * locking [max_pairs] [cycles]: concurrency stress test of the identification/connection endpoints
+    * ingest [number_payloads] [batch_size]: statistics ingestion, one request per payload against /upload_json/batch
+    * ingest_queries: checks that the number of SELECT per upload does not depend on the number of items
+    * indexes [max_payloads]: upload latency against the size of the tables, without and with the indexes
+    * stat_keys [repeat]: parsing of the statistics of stats.json, regular expressions against the stat key resolver
+    * burst [number_uploads]: latency of simultaneous uploads at the end of a round, direct writes against write-behind
+    * export [number_payloads]: CSV export against the columnar export, time to export and to load the statistics
+    * players [number_pairs]: players pages, scores recomputed on each view against scores maintained by the ingestion
+    * pages [max_stats]: latency of the stats listing of a test while it grows, whole listing against keyset pages
+    * trajectories [number_payloads] [number_points]: database size and load of the stats, JSON trajectories against compressed ones
+    * uploads [number_uploads] [number_points] [chunk_size]: uploads of long trajectories, plain JSON against gzip and gzip in chunks
+    * analytics [number_payloads] [number_points]: metrics and heatmap of a world, Python loops against analytics.py
+    * cache [number_payloads] [refreshes]: refresh of the monitoring pages, without cache, with the response cache and with ETags
+    * metrics [cycles]: overhead of the metrics on the client lifecycle and on the locks, metrics disabled against enabled
+    * workers [number_pairs] [cycles]: cross-process stress test of serve.py, no key used twice and no wrong pairing with 1, 2 and 4 processes
+    * database [duration] [readers] [writers]: mixed load of page refreshes and uploads under each database profile
+    * player_creation [number_players] [existing_players]: creation of a session, one commit per player against registration.py
+    * player_update [number_players]: save of the players page after one cell is edited, query per player against bulk update
+    * item_names [players_per_test]: items page and CSV export, names loaded from the ItemName of each item against the catalog
+    * catalog [repeat]: filling of the item_names table, items_list.html and one add per item against the catalog file and a bulk upsert
+    * backoff [clients] [outage]: simulated clients retrying while the server is down, fixed delay against client.py backoff
+"""
+
+import os
+import sys
+import re
+import json
+import signal
+import sqlite3
+import time
+import random
+import tempfile
+from threading import Thread, Barrier, RLock, Lock
+
+from sqlalchemy import event, func
+
+from database import Base, db_session, create_database_engine, PROFILES
+from models import Connection, Player, Trajectory
+from matchmaking import Matchmaker, DatabaseMatchmaker, BucketLocks
+
+
+def use_temporary_database(options=None):
+    """
+    Binds the database session to a new temporary SQLite database and returns the engine
+    options: database options (see database.py), defaults of SQLite if not given
+    """
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    engine = create_database_engine("sqlite:///{}".format(path), options or {})
+    Base.metadata.create_all(bind=engine)
+    db_session.remove()
+    db_session.configure(bind=engine)
+    return engine
+
+
+def count_statements(engine):
+    """Counts the SQL statements executed on the engine, the counter is returned as a one element list"""
+    counter = [0]
+    def before_cursor_execute(*args):
+        counter[0] += 1
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    return counter
+
+
+def create_pairs(number_pairs, session_nr=1):
+    """Creates number_pairs pairs of players and returns the list of (player_id, player_id)"""
+    players = []
+    for pair in range(1, number_pairs + 1):
+        for i in range(2):
+            key = "{}-{}-{}".format(session_nr, pair, i)
+            player = Player(key, key, session_nr, pair)
+            db_session.add(player)
+            players.append(player)
+    db_session.commit()
+    ids = [player.id for player in players]
+    db_session.remove()
+    return list(zip(ids[0::2], ids[1::2]))
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of a list of values"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def print_timings(name, timings):
+    """Prints a summary of timings given in seconds"""
+    print("{:<30} n={:<5} mean={:8.2f} ms  p50={:8.2f} ms  p95={:8.2f} ms  max={:8.2f} ms".format(
+        name, len(timings), 1000 * sum(timings) / max(len(timings), 1), 1000 * percentile(timings, 50),
+        1000 * percentile(timings, 95), 1000 * max(timings or [0])))
+
+
+
+###########
+# Pairing #
+###########
+
+
+
+# Former global lock of the connections
+legacy_lock = RLock()
+
+
+def legacy_connect(app, player_id):
+    """Reference implementation of the former /connect/: one polling thread per player"""
+    with legacy_lock:
+        db_session.add(Connection(player_id))
+        db_session.commit()
+    thread = Thread(target=legacy_connect_player, args=(app, player_id))
+    thread.start()
+    return thread
+
+
+def legacy_connect_player(app, player_id):
+    """Reference implementation of the former connect_player thread: polls the database every second"""
+    connected = False
+    while not connected:
+        with legacy_lock:
+            player = Player.query.get(player_id)
+            conn = player.connection
+            if conn.connected_player_id is not None:
+                connected = True
+            else:
+                q = db_session.query(Connection).join(Connection.players).filter(Connection.player_id!=player_id, Connection.status==0, Player.session_nr==player.session_nr, Player.pair==player.pair)
+                try:
+                    conn_with = q.first()
+                    conn.status = 1
+                    conn.connected_player_id = conn_with.players.id
+                    conn.role = 0
+                    conn_with.status = 1
+                    conn_with.connected_player_id = conn.players.id
+                    conn_with.role = 1
+                    db_session.commit()
+                    connected = True
+                except Exception as e:
+                    db_session.rollback()
+        if not connected:
+            time.sleep(1)
+    db_session.remove()
+
+
+def wait_connected(engine, player_id, timeout=60):
+    """
+    Polls the database until the player is connected, returns the time at which the connection was seen
+    A raw sqlite3 connection is used so that the polling is not counted in the statements of the engine
+    """
+    db = sqlite3.connect(engine.url.database)
+    limit = time.time() + timeout
+    while time.time() < limit:
+        row = db.execute("SELECT connected_player_id FROM connections WHERE player_id = ?", (player_id,)).fetchone()
+        if row is not None and row[0] is not None:
+            db.close()
+            return time.time()
+        time.sleep(0.001)
+    db.close()
+    raise RuntimeError("Player {} was not connected after {} s".format(player_id, timeout))
+
+
+def benchmark_pairing(number_pairs=20):
+    """
+    Simulates the start of a lab session: the first player of each pair connects, then all the second players connect at once
+    The time to pair is measured from the connection of the second player until both players are connected
+    """
+    from app import app
+    client = app.test_client()
+
+    def run(name, connect):
+        engine = use_temporary_database()
+        app.matchmaker = Matchmaker()
+        pairs = create_pairs(number_pairs)
+        statements = count_statements(engine)
+        [connect(first) for (first, second) in pairs]
+        # We let the first players wait for their partner
+        start_statements = statements[0]
+        time.sleep(2)
+        waiting_statements = statements[0] - start_statements
+        start_statements = statements[0]
+        timings = []
+        def second_player(first, second):
+            start = time.time()
+            connect(second)
+            timings.append(max(wait_connected(engine, first), wait_connected(engine, second)) - start)
+        threads = [Thread(target=second_player, args=pair) for pair in pairs]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        print_timings(name, timings)
+        print("{:<30} {} SQL statements while waiting 2 s, {} while pairing".format("", waiting_statements, statements[0] - start_statements))
+
+    def engine_connect(player_id):
+        client.post("/connect/", data={"id": player_id})
+
+    run("polling threads", lambda player_id: legacy_connect(app, player_id))
+    run("matchmaking engine", engine_connect)
+
+
+
+class GlobalLock(BucketLocks):
+    """Same lock for all the buckets, to compare with the former global locks"""
+
+    def __init__(self):
+        BucketLocks.__init__(self)
+        self.global_lock = RLock()
+
+    def __getitem__(self, bucket):
+        return self.global_lock
+
+
+def benchmark_locking(max_pairs=16, cycles=20):
+    """
+    Concurrency stress test of identification/connect/connected_with/disconnect
+    Each player runs cycles of the client lifecycle, the throughput and the p95 latency of the requests holding a lock
+    are measured for an increasing number of independent pairs, with one lock per bucket and with a global lock
+    Every connection is checked: a player must always be connected with his partner
+    """
+    from app import app
+    client = app.test_client()
+
+    def run(number_pairs, locks):
+        use_temporary_database()
+        app.matchmaker = Matchmaker(locks())
+        pairs = create_pairs(number_pairs)
+        keys = dict((player.id, player.key) for player in db_session.query(Player).all())
+        db_session.remove()
+        errors = []
+
+        timings = []
+
+        def request(method, url, data=None):
+            start = time.time()
+            d = method(url, data=data).get_json()
+            timings.append(time.time() - start)
+            assert d["status"] == 1, d["text"]
+            return d
+
+        def player_lifecycle(player_id, partner_id, barrier):
+            for i in range(cycles):
+                try:
+                    request(client.post, "/identification/", {"key": keys[player_id]})
+                    request(client.post, "/connect/", {"id": player_id})
+                    # Not timed, the request waits for the other player
+                    d = client.get("/connected_with/{}?wait=10".format(player_id)).get_json()
+                    assert d["status"] == 1, d["text"]
+                    assert d["data"]["connected_player_id"] == partner_id, "connected with another player"
+                    barrier.wait()
+                    request(client.get, "/disconnect/{}".format(player_id))
+                    barrier.wait()
+                except Exception as e:
+                    errors.append(e)
+                    barrier.abort()
+                    return
+
+        threads = []
+        for (first, second) in pairs:
+            barrier = Barrier(2)
+            threads.append(Thread(target=player_lifecycle, args=(first, second, barrier)))
+            threads.append(Thread(target=player_lifecycle, args=(second, first, barrier)))
+        start = time.time()
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        duration = time.time() - start
+        for e in errors[:3]:
+            print("    {!r}".format(e))
+        return 2 * number_pairs * cycles / duration, 1000 * percentile(timings, 95), len(errors)
+
+    print("{:>6} {:>40} {:>40}".format("pairs", "global lock", "lock per bucket"))
+    number_pairs = 1
+    while number_pairs <= max_pairs:
+        results = [run(number_pairs, locks) for locks in (GlobalLock, BucketLocks)]
+        print("{:>6} {}".format(number_pairs, " ".join("{:>8.1f} cycles/s p95={:>6.1f} ms ({} err)".format(*result) for result in results)))
+        number_pairs *= 2
+
+
+##########
+# Ingest #
+##########
+
+
+
+def make_payloads(number_payloads, players_per_test=20, session_uuid="benchmark"):
+    """Creates payloads like the ones sent by the Minecraft mod, using the statistics of stats.json"""
+    with open("stats.json", "r") as f:
+        stats = json.loads(f.read())
+    payloads = []
+    for i in range(number_payloads):
+        player_stats = dict((k, v + i % 7 if isinstance(v, int) else v) for (k, v) in stats.items())
+        payloads.append({
+            "session_id": session_uuid,
+            "world": "Volcano_TEST",
+            "round": i // players_per_test + 1,
+            "player": i % players_per_test + 1,
+            "checkpoints": "test",
+            "position_over_time": "test",
+            "solution": "solution 1",
+            "score": i % 100,
+            "stats": json.dumps(player_stats)
+        })
+    return payloads
+
+
+def benchmark_ingest(number_payloads=2000, batch_size=500):
+    """Measures the number of payloads ingested per second, one request per payload and by batch"""
+    from app import app
+    client = app.test_client()
+    payloads = make_payloads(number_payloads)
+
+    use_temporary_database()
+    start = time.time()
+    for payload in payloads:
+        r = client.post("/upload_json/", data=json.dumps(payload), content_type="application/json")
+        assert r.status_code == 200, r.data
+    duration = time.time() - start
+    print("{:<30} {:8.1f} payloads/s".format("/upload_json/", number_payloads / duration))
+
+    use_temporary_database()
+    start = time.time()
+    for i in range(0, number_payloads, batch_size):
+        r = client.post("/upload_json/batch", data=json.dumps(payloads[i:i + batch_size]), content_type="application/json")
+        assert json.loads(r.data.decode("utf-8"))["status"] == 1, r.data
+    duration = time.time() - start
+    print("{:<30} {:8.1f} payloads/s".format("/upload_json/batch ({})".format(batch_size), number_payloads / duration))
+
+
+
+def benchmark_ingest_queries():
+    """
+    Counts the SELECT statements of an upload to /upload_json/, for a new and an updated stat, with few and many items
+    Fails if the count depends on the number of items
+    """
+    from app import app
+    client = app.test_client()
+    engine = use_temporary_database()
+    selects = [0]
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith("SELECT"):
+            selects[0] += 1
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+
+    counts = {}
+    for number_items in (5, 200):
+        stats = {"stat.walkOneCm": 100, "stat.jump": 3}
+        stats.update(("stat.mineBlock.{}".format(i), i) for i in range(number_items))
+        payload = make_payloads(1, session_uuid="queries-{}".format(number_items))[0]
+        payload["stats"] = json.dumps(stats)
+        for upload in ("new", "update"):
+            selects[0] = 0
+            r = client.post("/upload_json/", data=json.dumps(payload), content_type="application/json")
+            assert r.status_code == 200, r.data
+            counts[(upload, number_items)] = selects[0]
+            print("{:<8} stat, {:>3} items: {} SELECT".format(upload, number_items, selects[0]))
+
+    for upload in ("new", "update"):
+        assert counts[(upload, 5)] == counts[(upload, 200)], "the number of SELECT depends on the number of items"
+    print("OK")
+
+
+
+def benchmark_indexes(max_payloads=16000):
+    """
+    Measures the latency of /upload_json/ while the tables grow, without the indexes of the models and with them
+    The tables are filled through /upload_json/batch, each session containing 10 rounds of 20 players
+    """
+    from app import app
+    client = app.test_client()
+
+    def run(indexes):
+        engine = use_temporary_database()
+        if not indexes:
+            for table in Base.metadata.sorted_tables:
+                [index.drop(bind=engine) for index in table.indexes]
+        timings = {}
+        size = 0
+        target = 1000
+        while target <= max_payloads:
+            # We fill the tables up to target payloads
+            while size < target:
+                payloads = make_payloads(200, session_uuid="fill-{}".format(size))
+                client.post("/upload_json/batch", data=json.dumps(payloads), content_type="application/json")
+                size += len(payloads)
+            uploads = []
+            for payload in make_payloads(20, session_uuid="measure-{}".format(size)):
+                start = time.time()
+                client.post("/upload_json/", data=json.dumps(payload), content_type="application/json")
+                uploads.append(time.time() - start)
+            timings[size] = uploads
+            target *= 2
+        return timings
+
+    without_indexes = run(False)
+    with_indexes = run(True)
+    print("{:>10} {:>20} {:>20}".format("payloads", "without indexes", "with indexes"))
+    for size in sorted(with_indexes):
+        print("{:>10} {:>17.2f} ms {:>17.2f} ms".format(size, 1000 * percentile(without_indexes[size], 50), 1000 * percentile(with_indexes[size], 50)))
+
+
+
+def legacy_parse_stats(stats):
+    """Reference implementation of the former parsing of the statistics in add_stats_to_db"""
+    stat_values = {}
+    items = {}
+    for (k,v) in stats.items():
+        k = k.split('.')
+        attr = k[0]
+        if attr == 'stat':
+            column = re.sub("([A-Z])","_\g<1>", k[1]).lower()
+            if len(k) == 3:
+                item_id = k[2]
+                if not item_id in items:
+                    items[item_id] = {}
+                items[item_id][column] = v
+            else:
+                stat_values[column] = v
+        elif attr == 'achievement':
+            if k[1] == 'exploreAllBiomes':
+                try:
+                    stat_values['number_biomes'] = len(v['progress'])
+                except:
+                    pass
+    return stat_values, items
+
+
+def benchmark_stat_keys(repeat=20000):
+    """Measures the time to parse the statistics of stats.json"""
+    import ingest
+    with open("stats.json", "r") as f:
+        stats = json.loads(f.read())
+    assert legacy_parse_stats(stats) == ingest.parse_stats(stats)
+
+    for (name, parse) in (("regular expressions", legacy_parse_stats), ("stat key resolver", ingest.parse_stats)):
+        start = time.time()
+        for i in range(repeat):
+            parse(stats)
+        duration = time.time() - start
+        print("{:<30} {:8.2f} us per payload, {:6.3f} us per key".format(name, 1e6 * duration / repeat, 1e6 * duration / repeat / len(stats)))
+
+
+
+def benchmark_burst(number_uploads=50):
+    """
+    Measures the latency of number_uploads simultaneous uploads (all the players at the end of a round),
+    when the statistics are written directly and in write-behind mode
+    """
+    from app import app
+    from journal import IngestJournal
+    client = app.test_client()
+    payloads = make_payloads(number_uploads, players_per_test=number_uploads)
+
+    def run(name):
+        timings = []
+        def upload(payload):
+            start = time.time()
+            r = client.post("/upload_json/", data=json.dumps(payload), content_type="application/json")
+            timings.append(time.time() - start)
+            assert r.status_code in (200, 202), r.data
+        threads = [Thread(target=upload, args=(payload,)) for payload in payloads]
+        start = time.time()
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        accepted = time.time() - start
+        if app.journal is not None:
+            app.journal.wait_applied(app.journal.last)
+        print_timings(name, timings)
+        print("{:<30} all accepted in {:.2f} s, in database after {:.2f} s".format("", accepted, time.time() - start))
+
+    use_temporary_database()
+    app.journal = None
+    run("direct writes")
+
+    engine = use_temporary_database()
+    app.journal = IngestJournal(os.path.join(os.path.dirname(engine.url.database), "ingest.journal"))
+    app.journal.start()
+    run("write-behind")
+    app.journal.stop()
+    app.journal = None
+
+
+def benchmark_export(number_payloads=20000):
+    """
+    Measures the time to export the statistics of number_payloads players and to load them,
+    from the CSV export and from the columnar export opened memory-mapped
+    """
+    import csv
+    import ingest
+    import export
+    import utils
+    engine = use_temporary_database()
+    for payloads in ingest.chunks(make_payloads(number_payloads), 1000):
+        ingest.add_stats_batch(payloads)
+    directory = os.path.dirname(engine.url.database)
+
+    start = time.time()
+    with open(os.path.join(directory, "stats.csv"), "w") as f:
+        for block in utils.stats_to_csv():
+            f.write(block)
+    print("{:<30} {:.2f} s".format("CSV export", time.time() - start))
+    start = time.time()
+    with open(os.path.join(directory, "stats.csv")) as f:
+        rows = list(csv.reader(f))
+    print("{:<30} {:.3f} s ({} rows)".format("CSV load", time.time() - start, len(rows)))
+
+    path = os.path.join(directory, "export")
+    start = time.time()
+    export.export(path)
+    print("{:<30} {:.2f} s".format("columnar export", time.time() - start))
+    start = time.time()
+    data = export.load(path)
+    print("{:<30} {:.3f} s ({} stats, {} items)".format("columnar load (mmap)", time.time() - start, len(data["stats"]["id"]), len(data["items"]["test_id"])))
+    start = time.time()
+    total = sum(int(data["items"][column].sum()) for column in ("use_item", "mine_block", "craft_item", "break_item"))
+    print("{:<30} {:.3f} s (sum of the item columns: {})".format("columnar full scan", time.time() - start, total))
+
+
+def legacy_update_players_score():
+    """Reference implementation of the former update_players_score, run by each players page"""
+    from sqlalchemy import desc
+    from models import Test, Stat
+    for player in db_session.query(Player).all():
+        try:
+            last_test = db_session.query(Test).join(Stat).filter(Stat.player_id==player.id).order_by(desc(Test.timestamp)).one()
+            score = 0
+            team_score_avg = []
+            team_score_max = 0
+            for stat in last_test.stats:
+                team_score_avg.append(stat.score)
+                if stat.score > team_score_max:
+                    team_score_max = stat.score
+                if stat.player_id == player.id:
+                    score = stat.score
+            player.score = score
+            player.team_score_avg = float(sum(team_score_avg)) / len(team_score_avg)
+            player.team_score_max = team_score_max
+            db_session.commit()
+        except Exception as e:
+            pass
+
+
+def benchmark_players(number_pairs=1000):
+    """
+    Measures the time to display the players pages when number_pairs pairs of players have statistics,
+    with the former recomputation of the scores on each view and with the scores maintained by the ingestion
+    """
+    import ingest
+    from app import app
+    client = app.test_client()
+    use_temporary_database()
+    pairs = create_pairs(number_pairs)
+    payloads = make_payloads(2 * number_pairs, players_per_test=2)
+    for (payload, player_id) in zip(payloads, [player_id for pair in pairs for player_id in pair]):
+        payload["player"] = player_id
+    start = time.time()
+    for batch in ingest.chunks(payloads, 500):
+        ingest.add_stats_batch(batch)
+    db_session.remove()
+    print("{:<30} {:.2f} s for {} payloads".format("ingestion with scores", time.time() - start, len(payloads)))
+
+    for (name, update) in (("recomputed on view", legacy_update_players_score), ("maintained by ingestion", None)):
+        timings = []
+        for i in range(3):
+            start = time.time()
+            if update is not None:
+                update()
+            assert client.get("/players/").status_code == 200
+            assert client.get("/players/1").status_code == 200
+            timings.append(time.time() - start)
+            db_session.remove()
+        print_timings(name, timings)
+
+
+def benchmark_pages(max_stats=16000):
+    """
+    Measures the latency of the stats listing of a test while the test grows up to max_stats stats:
+    whole listing (former view), first page and last page of the keyset pagination
+    """
+    import ingest
+    from flask import render_template
+    from models import Stat, Test
+    from app import app
+    client = app.test_client()
+    use_temporary_database()
+    number_stats = 0
+    size = 1000
+    while size <= max_stats:
+        payloads = make_payloads(size - number_stats, players_per_test=max_stats)
+        for (i, payload) in enumerate(payloads):
+            payload["player"] = number_stats + i + 1
+        for batch in ingest.chunks(payloads, 1000):
+            ingest.add_stats_batch(batch)
+        number_stats = size
+        test_id = db_session.query(Test.id).scalar()
+        last_id = db_session.query(func.max(Stat.id)).scalar()
+        db_session.remove()
+
+        def whole():
+            with app.test_request_context():
+                columns = [c.name for c in Stat.__table__.columns if c.name != "position_over_time"]
+                render_template("view_data.djhtml", columns=columns, data=db_session.query(Stat).filter_by(test_id=test_id).all())
+        def page(after):
+            url = "/view/stats/{}?sort=-score".format(test_id) + ("&after={}".format(after) if after else "")
+            assert client.get(url).status_code == 200
+
+        print("{} stats".format(size))
+        for (name, view) in (("whole listing", whole), ("first page", lambda: page(None)), ("last page", lambda: page(last_id))):
+            timings = []
+            for i in range(5):
+                start = time.time()
+                view()
+                timings.append(time.time() - start)
+                db_session.remove()
+            print_timings("    " + name, timings)
+        size *= 2
+
+
+def make_trajectory(number_points):
+    """Creates a position_over_time like the ones sent by the Minecraft mod: {time: position as JSON}"""
+    (x, z) = (0.0, 0.0)
+    position_over_time = {}
+    for i in range(number_points):
+        x = round(x + random.uniform(-1, 1), 2)
+        z = round(z + random.uniform(-1, 1), 2)
+        position_over_time[str(50 * i)] = json.dumps({"x": x, "y": round(64 + random.uniform(-1, 1), 2), "z": z})
+    return position_over_time
+
+
+def benchmark_trajectories(number_payloads=2000, number_points=1000):
+    """
+    Compares the size of the database and the time to load the stats when the trajectories are stored
+    as JSON in stats.position_over_time and compressed in the trajectories table
+    """
+    import ingest
+    from sqlalchemy.orm import undefer
+    from models import Test, Stat
+    payloads = make_payloads(number_payloads)
+    for payload in payloads:
+        payload["position_over_time"] = make_trajectory(number_points)
+
+    for name in ("JSON in stats", "trajectories table"):
+        engine = use_temporary_database()
+        start = time.time()
+        for batch in ingest.chunks(payloads, 500):
+            ingest.add_stats_batch(batch)
+        if name == "JSON in stats":
+            # Former storage
+            db_session.execute(Trajectory.__table__.delete())
+            tests = dict((test.round, test.id) for test in db_session.query(Test))
+            for payload in payloads:
+                db_session.execute(Stat.__table__.update().where(Stat.player_id == payload["player"]).where(Stat.test_id == tests[str(payload["round"])]),
+                                   {"position_over_time": json.dumps(payload["position_over_time"])})
+            db_session.commit()
+        else:
+            print("{:<30} {:.2f} s".format("ingestion", time.time() - start))
+        db_session.remove()
+        engine.execute("VACUUM")
+        print("{:<30} {:.1f} MB".format(name, os.path.getsize(engine.url.database) / 1e6))
+
+        timings = []
+        for i in range(3):
+            start = time.time()
+            q = db_session.query(Stat)
+            if name == "JSON in stats":
+                q = q.options(undefer("position_over_time"))
+            q.all()
+            timings.append(time.time() - start)
+            db_session.remove()
+        print_timings("    load of the stats", timings)
+
+
+def benchmark_uploads(number_uploads=20, number_points=50000, chunk_size=256):
+    """
+    Measures the uploads of long trajectories: bytes sent, time to compress and time of the requests
+    (test client, no network), plain JSON against gzip and against gzip in chunks of chunk_size KB.
+    The transfer time is estimated for a 100 Mbit/s network
+    """
+    import gzip
+    from app import app
+    client = app.test_client()
+    use_temporary_database()
+    fill_item_names()
+    payloads = make_payloads(number_uploads)
+    for payload in payloads:
+        payload["position_over_time"] = make_trajectory(number_points)
+
+    for name in ("plain JSON", "gzip", "gzip, chunks"):
+        timings = []
+        compression = []
+        sent = 0
+        for payload in payloads:
+            start = time.time()
+            body = json.dumps(payload).encode("utf-8")
+            headers = {}
+            if name != "plain JSON":
+                body = gzip.compress(body, 6)
+                headers["Content-Encoding"] = "gzip"
+            compression.append(time.time() - start)
+            sent += len(body)
+            if name == "gzip, chunks":
+                url = "/upload_json/chunks/?session_id={}&world={}&round={}&player={}&total={}".format(
+                    payload["session_id"], payload["world"], payload["round"], payload["player"], len(body))
+                for offset in range(0, len(body), chunk_size * 1024):
+                    r = client.put(url + "&offset={}".format(offset), data=body[offset:offset + chunk_size * 1024], headers=headers)
+            else:
+                r = client.post("/upload_json/", data=body, headers=headers, content_type="application/json")
+            assert r.status_code == 200, r.data
+            timings.append(time.time() - start)
+        print_timings(name, timings)
+        print("{:<30} {:.2f} MB sent, {:.0f} ms to encode, {:.0f} ms to transfer at 100 Mbit/s (per upload)".format(
+            "", sent / 1e6, 1000 * sum(compression) / len(payloads), 1000 * sent * 8 / 1e8 / len(payloads)))
+
+
+
+def legacy_path_metrics(position_over_time):
+    """Reference computation of the path length and idle time of a position_over_time with Python loops"""
+    points = sorted((float(t), json.loads(position)) for (t, position) in position_over_time.items())
+    path_length = 0
+    idle_time = 0
+    for ((t1, p1), (t2, p2)) in zip(points, points[1:]):
+        distance = ((p2["x"] - p1["x"]) ** 2 + (p2["y"] - p1["y"]) ** 2 + (p2["z"] - p1["z"]) ** 2) ** 0.5
+        path_length += distance
+        if distance < 0.1:
+            idle_time += t2 - t1
+    return path_length, idle_time
+
+
+def benchmark_analytics(number_payloads=2000, number_points=1000):
+    """
+    Measures the time to compute the metrics and the heatmap of the trajectories of a whole world,
+    with Python loops over the JSON trajectories and with analytics.py (without and with its cache)
+    """
+    import ingest
+    import analytics
+    from app import app
+    client = app.test_client()
+    use_temporary_database()
+    payloads = make_payloads(number_payloads)
+    for payload in payloads:
+        payload["position_over_time"] = make_trajectory(number_points)
+    for batch in ingest.chunks(payloads, 500):
+        ingest.add_stats_batch(batch)
+    db_session.remove()
+
+    start = time.time()
+    expected = [legacy_path_metrics(payload["position_over_time"]) for payload in payloads]
+    print("{:<30} {:8.1f} ms".format("Python loops (metrics)", 1000 * (time.time() - start)))
+
+    for name in ("metrics (cold cache)", "metrics (warm cache)"):
+        start = time.time()
+        r = client.get("/analytics/metrics/world/Volcano_TEST")
+        print("{:<30} {:8.1f} ms".format(name, 1000 * (time.time() - start)))
+    data = json.loads(r.data.decode("utf-8"))["data"]
+    results = dict(((d["test_id"], d["player_id"]), (d["path_length"], d["idle_time"])) for d in data)
+    assert len(results) == len(payloads)
+    for (payload, (path_length, idle_time)) in zip(payloads, expected):
+        (test_id, player_id) = (int(payload["round"]), payload["player"])
+        assert abs(results[(test_id, player_id)][0] - path_length) < 1e-6 * max(path_length, 1)
+        assert abs(results[(test_id, player_id)][1] - idle_time) < 1e-6 * max(idle_time, 1)
+
+    for cell_size in (1, 0.25):
+        start = time.time()
+        r = client.get("/analytics/heatmap/world/Volcano_TEST?cell={}".format(cell_size))
+        assert r.status_code == 200
+        cells = len(json.loads(r.data.decode("utf-8"))["data"]["cells"])
+        print("{:<30} {:8.1f} ms ({} cells)".format("heatmap (cell {})".format(cell_size), 1000 * (time.time() - start), cells))
+
+    # A new upload invalidates the cache of the player
+    ingest.add_stats_batch(payloads[:1])
+    assert analytics.cache.get((1, payloads[0]["player"])) is None
+
+
+def benchmark_cache(number_payloads=5000, refreshes=20):
+    """
+    Measures the time to refresh the monitoring pages: built for each request, sent from the response cache,
+    and answered with 304 Not Modified when the browser sends the ETag of its copy
+    """
+    import ingest
+    import cache
+    from app import app
+    client = app.test_client()
+    use_temporary_database()
+    for batch in ingest.chunks(make_payloads(number_payloads, players_per_test=500), 500):
+        ingest.add_stats_batch(batch)
+    # The CSV export is streamed: it is not kept in the response cache, only its ETag is checked
+    pages = {"pages": ["/view/sessions/", "/view/tests/1", "/view/stats/1", "/players/"], "CSV export": ["/view/sessions/csv/"]}
+
+    for (group, urls) in sorted(pages.items(), reverse=True):
+        for name in ("no cache", "response cache", "ETag (304)"):
+            cache.responses.enabled = name != "no cache"
+            etags = dict((url, client.get(url).headers.get("ETag")) for url in urls)
+            timings = []
+            for i in range(refreshes):
+                start = time.time()
+                for url in urls:
+                    headers = {"If-None-Match": etags[url]} if name == "ETag (304)" else {}
+                    r = client.get(url, headers=headers)
+                    assert r.status_code in (200, 304)
+                    r.data
+                timings.append(time.time() - start)
+            print_timings("{}, {}".format(group, name), timings)
+    cache.responses.enabled = True
+
+
+
+def benchmark_workers(number_pairs=8, cycles=10):
+    """
+    Cross-process stress test of serve.py: the server runs with 1, 2 and 4 worker processes and each player runs cycles
+    of the client lifecycle over HTTP. At each cycle, two clients send the key of the player at the same time: only one
+    of them must be identified. Both players of a pair must be connected with each other, with the same connection id
+    and different roles. The throughput and the p95 latency of the requests are measured.
+    Then the players of a last pair have connections inserted without being paired, as when both connect at the same
+    time in two processes of an MVCC database (each transaction does not see the other connection): polling
+    /connected_with/ must connect them
+    """
+    import requests
+    from werkzeug.serving import make_server
+    import serve
+    import cache
+    import analytics
+    from app import app
+
+    def run(workers):
+        engine = use_temporary_database()
+        pairs = create_pairs(number_pairs + 1)
+        (missed_first, missed_second) = pairs.pop()
+        keys = dict((player.id, player.key) for player in db_session.query(Player).all())
+        db_session.remove()
+        engine.dispose()
+        app.matchmaker = DatabaseMatchmaker()
+        cache.responses.enabled = False
+        analytics.cache.enabled = False
+
+        server = make_server("127.0.0.1", 0, None, threaded=True)
+        url = "http://127.0.0.1:{}/".format(server.server_port)
+        pid = os.fork()
+        if pid == 0:
+            # The workers do not share the connections to the database of the parent process
+            serve.serve(server, workers, lambda worker: engine.dispose() or app)
+            os._exit(0)
+        server.server_close()
+
+        errors = []
+        timings = []
+        # {(pair, cycle): [(role, connection_id)]}
+        connections = {}
+        lock = Lock()
+
+        def request(session, method, path, **kwargs):
+            start = time.time()
+            d = session.request(method, url + path, timeout=30, **kwargs).json()
+            with lock:
+                timings.append(time.time() - start)
+            return d
+
+        def player_lifecycle(player_id, partner_id, pair, barrier):
+            session = requests.Session()
+            for cycle in range(cycles):
+                try:
+                    # A second client sends the same key
+                    results = []
+                    other = Thread(target=lambda: results.append(request(requests, "POST", "identification/", data={"key": keys[player_id]})))
+                    other.start()
+                    results.append(request(session, "POST", "identification/", data={"key": keys[player_id]}))
+                    other.join()
+                    identified = len([d for d in results if d["status"] == 1])
+                    assert identified == 1, "key used by {} clients".format(identified)
+                    d = request(session, "POST", "connect/", data={"id": player_id})
+                    assert d["status"] == 1, d["text"]
+                    limit = time.time() + 30
+                    d = {"status": 0}
+                    while d["status"] != 1:
+                        assert time.time() < limit, "not connected"
+                        d = session.get(url + "connected_with/{}?wait=10".format(player_id), timeout=30).json()
+                    assert d["data"]["connected_player_id"] == partner_id, "connected with another player"
+                    with lock:
+                        connections.setdefault((pair, cycle), []).append((d["data"]["role"], d["data"]["connection_id"]))
+                    barrier.wait()
+                    d = request(session, "GET", "disconnect/{}".format(player_id))
+                    assert d["status"] == 1, d["text"]
+                    barrier.wait()
+                except Exception as e:
+                    errors.append(e)
+                    barrier.abort()
+                    return
+
+        threads = []
+        for (pair, (first, second)) in enumerate(pairs):
+            barrier = Barrier(2)
+            threads.append(Thread(target=player_lifecycle, args=(first, second, pair, barrier)))
+            threads.append(Thread(target=player_lifecycle, args=(second, first, pair, barrier)))
+        start = time.time()
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        duration = time.time() - start
+
+        # Both connections waiting, none of the connect requests paired them
+        for player_id in (missed_first, missed_second):
+            db_session.query(Player).filter(Player.id == player_id).update({"in_use": 1}, synchronize_session=False)
+            db_session.add(Connection(player_id))
+        db_session.commit()
+        db_session.remove()
+        engine.dispose()
+        for (player_id, partner_id) in ((missed_first, missed_second), (missed_second, missed_first)):
+            try:
+                d = requests.get(url + "connected_with/{}?wait=5".format(player_id), timeout=30).json()
+                assert d["status"] == 1 and d["data"]["connected_player_id"] == partner_id, d["text"]
+            except Exception as e:
+                errors.append(AssertionError("simultaneous connections of player {} not paired: {!r}".format(player_id, e)))
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+        for (key, values) in connections.items():
+            if len(values) == 2 and (sorted(role for (role, conn_id) in values) != [0, 1] or values[0][1] != values[1][1]):
+                errors.append(AssertionError("pair {} cycle {}: roles and connections {}".format(key[0], key[1], values)))
+        for e in errors[:3]:
+            print("    {!r}".format(e))
+        return 2 * number_pairs * cycles / duration, 1000 * percentile(timings, 95), len(errors)
+
+    print("{:>8} {:>12} {:>12} {:>8}".format("workers", "cycles/s", "p95 ms", "errors"))
+    for workers in (1, 2, 4):
+        print("{:>8} {:>12.1f} {:>12.1f} {:>8}".format(workers, *run(workers)))
+
+
+def benchmark_database(duration=10, readers=2, writers=1):
+    """
+    Mixed load under each database profile (see database.py): reader processes refresh the stats and players pages
+    while writer processes upload statistics, during duration seconds (processes as with serve.py, so that they
+    only wait for each other in the database). The pages are not cached
+    Measures the uploads and pages per second, their latency, and the failed requests
+    """
+    import multiprocessing
+    import ingest
+    import cache
+    from app import app
+    cache.responses.enabled = False
+    payloads = make_payloads(5000)
+
+    def load(engine, kind, i, end, queue):
+        # The processes do not share the connections to the database
+        engine.dispose()
+        client = app.test_client()
+        timings = []
+        errors = []
+        n = i
+        while time.time() < end:
+            start = time.time()
+            if kind == "page":
+                r = client.get(["/view/stats/{}".format(1 + n % 10), "/players/1"][n % 2])
+                n += 1
+            else:
+                payload = dict(payloads[n % len(payloads)], session_id="mixed")
+                r = client.post("/upload_json/", data=json.dumps(payload), content_type="application/json")
+                n += writers
+            timings.append(time.time() - start)
+            if r.status_code != 200:
+                errors.append(r.get_data(as_text=True)[:80])
+        queue.put((kind, timings, errors))
+
+    def run(profile):
+        engine = use_temporary_database(PROFILES[profile])
+        # The pages read tables already filled
+        for batch in ingest.chunks(payloads, 500):
+            ingest.add_stats_batch(batch)
+        create_pairs(250)
+        db_session.remove()
+        engine.dispose()
+
+        queue = multiprocessing.Queue()
+        end = time.time() + duration
+        processes = [multiprocessing.Process(target=load, args=(engine, "page", i, end, queue)) for i in range(readers)]
+        processes += [multiprocessing.Process(target=load, args=(engine, "upload", i, end, queue)) for i in range(writers)]
+        [process.start() for process in processes]
+        timings = {"page": [], "upload": []}
+        errors = []
+        for process in processes:
+            (kind, process_timings, process_errors) = queue.get()
+            timings[kind].extend(process_timings)
+            errors.extend(process_errors)
+        [process.join() for process in processes]
+
+        print("{}: {:.1f} uploads/s, {:.1f} pages/s, {} failed requests".format(profile, len(timings["upload"]) / duration, len(timings["page"]) / duration, len(errors)))
+        print_timings("    upload", timings["upload"])
+        print_timings("    page", timings["page"])
+        for e in sorted(set(errors))[:3]:
+            print("    {}".format(e))
+
+    for profile in sorted(PROFILES):
+        run(profile)
+    cache.responses.enabled = True
+
+
+
+def legacy_create_players(number_players):
+    """Reference implementation of the former /players/create/: one commit per player, random keys retried on collision"""
+    last_session_nr = db_session.query(func.max(Player.session_nr)).one()[0] or 0
+    session_nr = last_session_nr + 1
+    commits = 0
+    for i in range(number_players):
+        added = False
+        while not added:
+            try:
+                key = "{0:06}".format(random.randint(1, 1000000))
+                db_session.add(Player(key, key, session_nr, int(i / 2) + 1, 0, i % 2 + 1))
+                commits += 1
+                db_session.commit()
+                added = True
+            except Exception:
+                db_session.rollback()
+    return commits
+
+
+def benchmark_player_creation(number_players=200, existing_players=500000):
+    """
+    Measures the time to create a session of number_players players when existing_players keys are already used,
+    with one commit per player and random keys retried on collision, against registration.py.
+    Then the creation of 30 sessions at once through the JSON API
+    """
+    import registration
+    from app import app
+    client = app.test_client()
+
+    for (name, create) in (("one commit per player", legacy_create_players), ("registration.py", None)):
+        engine = use_temporary_database()
+        statements = count_statements(engine)
+        # The existing keys are the first numbers, the new keys collide with the probability existing / key space
+        rows = [{"key": registration.format_key(n), "name": "", "session_nr": 0, "pair": 0, "in_use": 0} for n in range(1, existing_players + 1)]
+        engine.execute(Player.__table__.insert(), rows)
+        start_statements = statements[0]
+        start = time.time()
+        if create is not None:
+            commits = create(number_players)
+        else:
+            registration.create_sessions([number_players])
+            commits = 1
+        duration = time.time() - start
+        keys = [key for (key,) in db_session.query(Player.key).filter(Player.session_nr == 1)]
+        assert len(keys) == len(set(keys)) == number_players
+        print("{:<25} {:8.1f} ms  {:>5} commits {:>6} SQL statements".format(name, 1000 * duration, commits, statements[0] - start_statements))
+
+    start = time.time()
+    d = client.post("/players/create/sessions/", data=json.dumps({"sessions": [20] * 30}), content_type="application/json").get_json()
+    assert d["status"] == 1, d["text"]
+    print("{:<25} {:8.1f} ms  30 sessions of 20 players (JSON API)".format("registration.py", 1000 * (time.time() - start)))
+
+
+def legacy_update_players(update_players):
+    """Reference implementation of the former /players/update/: one query per player, every value written"""
+    for update_player in update_players:
+        update_player = dict(update_player)
+        player_id = update_player.pop("id")
+        player = db_session.query(Player).get(player_id)
+        for (attr, value) in update_player.items():
+            setattr(player, attr, value)
+            db_session.add(player)
+    db_session.commit()
+
+
+def benchmark_player_update(number_players=200, repeat=20):
+    """
+    Measures the save of the players page of a session (all the rows are sent by static/js/app.js)
+    after one cell is edited: one query per player and every value written, against /players/update/
+    """
+    import registration
+    from app import app
+    client = app.test_client()
+
+    for name in ("query per player", "bulk update"):
+        engine = use_temporary_database()
+        registration.create_sessions([number_players])
+        rows = [{"id": player.id, "name": player.name, "condition": str(player.condition), "player_condition": str(player.player_condition)}
+                for player in db_session.query(Player).order_by(Player.id)]
+        db_session.remove()
+        statements = count_statements(engine)
+        timings = []
+        start_statements = statements[0]
+        for i in range(repeat):
+            rows[i % len(rows)]["name"] = "edited {}".format(i)
+            start = time.time()
+            if name == "query per player":
+                legacy_update_players(rows)
+            else:
+                d = client.post("/players/update/", data=json.dumps({"session_nr": 1, "update_players": rows}), content_type="application/json").get_json()
+                assert d["status"] == 1 and d["data"]["changed"] == [rows[i % len(rows)]["id"]], d
+            timings.append(time.time() - start)
+            db_session.remove()
+        print_timings(name, timings)
+        print("{:<30} {:.0f} SQL statements per save".format("", (statements[0] - start_statements) / repeat))
+
+
+def fill_item_names():
+    """Fills the item_names table from the catalog file, as setup_db.py"""
+    import catalog
+    catalog.upsert(catalog.read_file())
+
+
+def legacy_fill_item_names():
+    """Former setup_db.py: parses items_list.html and adds the items one by one"""
+    from bs4 import BeautifulSoup
+    from models import ItemName
+    with open("items_list.html", "r") as f:
+        soup = BeautifulSoup(f.read(), "html.parser")
+    for item in soup.find_all("tr"):
+        id_, img, name = item.find_all("td")
+        db_session.add(ItemName(id_.string, name.a.string))
+    db_session.commit()
+
+
+def benchmark_catalog(repeat=10):
+    """
+    Measures the filling of the item_names table of a new database, items_list.html parsed with BeautifulSoup
+    and one add per item (former setup_db.py) against the catalog file and a bulk upsert (catalog.py),
+    then the upsert on a database already filled, and with new and renamed items
+    """
+    import catalog
+    from sqlalchemy.exc import IntegrityError
+    for (name, function) in (("new database, items_list.html", legacy_fill_item_names),
+                             ("new database, catalog file", fill_item_names)):
+        timings = []
+        for i in range(repeat):
+            engine = use_temporary_database()
+            statements = count_statements(engine)
+            start = time.time()
+            function()
+            timings.append(time.time() - start)
+        print_timings(name, timings)
+        print("{:<30} {} SQL statements".format("", statements[0]))
+
+    try:
+        legacy_fill_item_names()
+        print("filled database, items_list.html: no error")
+    except IntegrityError:
+        db_session.rollback()
+        print("filled database, items_list.html: IntegrityError (items already in the table)")
+
+    items = catalog.read_file()
+    changed = [(item, name + " (renamed)") for (item, name) in items[:10]] + [("9999:{}".format(i), "New item") for i in range(5)]
+    for (name, new_items) in (("filled database, catalog file", items), ("10 renamed and 5 new items", items + changed)):
+        timings = []
+        results = []
+        for i in range(repeat):
+            start = time.time()
+            results.append(catalog.upsert(new_items))
+            timings.append(time.time() - start)
+        print_timings(name, timings)
+        print("{:<30} first run: {} added, {} updated".format("", *results[0]))
+    db_session.remove()
+
+
+def benchmark_item_names(players_per_test=200, repeat=10):
+    """
+    Measures the items page of a test (all the rows on one page) and the CSV export, with the name of each item
+    loaded from its ItemName (relationship, as before) against read from the catalog (catalog.py)
+    """
+    import ingest
+    import cache
+    import catalog
+    import utils
+    from models import Item
+    from app import app
+    client = app.test_client()
+    cache.responses.enabled = False
+
+    engine = use_temporary_database()
+    fill_item_names()
+    for batch in ingest.chunks(make_payloads(players_per_test, players_per_test=players_per_test), 500):
+        ingest.add_stats_batch(batch)
+    number_items = db_session.query(Item).filter_by(test_id=1).count()
+    db_session.remove()
+    catalog.refresh()
+    statements = count_statements(engine)
+    print("{} items in the test".format(number_items))
+
+    def relationship_page():
+        rows = db_session.query(Item).filter_by(test_id=1).order_by(Item.id).limit(1000).all()
+        return [(item.item.item, item.item.name) for item in rows]
+
+    def catalog_page():
+        rows = db_session.query(Item).filter_by(test_id=1).order_by(Item.id).limit(1000).all()
+        item_names = catalog.names()
+        return [(item.item_item, item_names.get(item.item_item)) for item in rows]
+
+    for (name, function) in (("page, relationship", relationship_page), ("page, catalog", catalog_page),
+                             ("page, /view/items/", lambda: client.get("/view/items/1?limit=1000").data),
+                             ("CSV export", lambda: "".join(utils.stats_to_csv()))):
+        timings = []
+        start_statements = statements[0]
+        for i in range(repeat):
+            start = time.time()
+            function()
+            timings.append(time.time() - start)
+            db_session.remove()
+        print_timings(name, timings)
+        print("{:<30} {:.0f} SQL statements".format("", (statements[0] - start_statements) / repeat))
+    cache.responses.enabled = True
+
+
+def benchmark_backoff(clients=40, outage=60):
+    """
+    Simulates clients waiting for their connection while the server is down for outage seconds: requests sent during
+    the outage and requests arriving at once when it is back, former fixed 2 s delay against the backoff of client.py
+    """
+    import client
+    max_backoff = client.Application.settings["server"].get("max_backoff", 30)
+
+    def fixed_delay(failures):
+        return 2
+
+    def backoff(failures):
+        return client.backoff_delay(failures, max_backoff)
+
+    for (name, delay) in (("fixed 2 s delay", fixed_delay), ("exponential backoff", backoff)):
+        # All the clients fail their request at the same time, when the server goes down
+        times = []
+        returns = []
+        for i in range(clients):
+            t = 0.0
+            failures = 0
+            while t < outage:
+                times.append(t)
+                t += delay(failures)
+                failures += 1
+            returns.append(t)
+        per_second = [0] * (outage + 1)
+        for t in times:
+            per_second[int(t)] += 1
+        print("{:<30} {:>5} requests during the outage, max {:>3}/s, max {:>3} clients back in the same second".format(
+            name, len(times), max(per_second[1:]), max(sum(1 for r in returns if s <= r < s + 1) for s in returns)))
+        print("{:<30} last client back {:.1f} s after the server".format("", max(returns) - outage))
+
+
+###########
+# Metrics #
+###########
+
+
+
+def benchmark_metrics(cycles=200):
+    """
+    Measures the overhead of the metrics (metrics.py): time of the client lifecycle of a pair (identification, connection,
+    upload, disconnection) and of the acquisition of a lock, with the metrics disabled and enabled
+    """
+    import metrics
+    from app import app
+    client = app.test_client()
+    engine = use_temporary_database()
+    metrics.listen(engine)
+    (first, second) = create_pairs(1)[0]
+    keys = dict((player.id, player.key) for player in db_session.query(Player).all())
+    db_session.remove()
+    payload = make_payloads(1)[0]
+
+    def lifecycle():
+        for player_id in (first, second):
+            assert client.post("/identification/", data={"key": keys[player_id]}).get_json()["status"] == 1
+            assert client.post("/connect/", data={"id": player_id}).get_json()["status"] == 1
+        assert client.get("/connected_with/{}".format(first)).get_json()["status"] == 1
+        payload["player"] = first
+        assert client.post("/upload_json/", data=json.dumps(payload), content_type="application/json").status_code == 200
+        for player_id in (first, second):
+            assert client.get("/disconnect/{}".format(player_id)).get_json()["status"] == 1
+
+    for enabled in (False, True, False, True):
+        metrics.enabled = enabled
+        app.matchmaker = Matchmaker(BucketLocks(metrics.lock_factory("connections")))
+        timings = []
+        for i in range(cycles):
+            start = time.time()
+            lifecycle()
+            timings.append(time.time() - start)
+        print_timings("lifecycle, metrics {}".format("enabled" if enabled else "disabled"), timings)
+
+    for enabled in (False, True):
+        metrics.enabled = enabled
+        lock = metrics.lock_factory("benchmark")()
+        start = time.time()
+        for i in range(100000):
+            with lock:
+                pass
+        print("lock, metrics {:<10} {:8.2f} us per acquisition".format("enabled" if enabled else "disabled", 10 * (time.time() - start)))
+
+    metrics.enabled = True
+    start = time.time()
+    page = client.get("/metrics").get_data(as_text=True)
+    print("/metrics: {} lines in {:.2f} ms".format(len(page.splitlines()), 1000 * (time.time() - start)))
+    for line in page.splitlines():
+        if line.startswith(("idp_lock_wait_seconds_count", "idp_lock_hold_seconds_sum", "idp_request_sql_statements_sum", "idp_ingest_payload_bytes_count")):
+            print("    " + line)
+
+
+
+if __name__ == "__main__":
+    benchmarks = {
+        "pairing": benchmark_pairing,
+        "locking": benchmark_locking,
+        "ingest": benchmark_ingest,
+        "ingest_queries": benchmark_ingest_queries,
+        "indexes": benchmark_indexes,
+        "stat_keys": benchmark_stat_keys,
+        "burst": benchmark_burst,
+        "export": benchmark_export,
+        "players": benchmark_players,
+        "pages": benchmark_pages,
+        "trajectories": benchmark_trajectories,
+        "uploads": benchmark_uploads,
+        "analytics": benchmark_analytics,
+        "cache": benchmark_cache,
+        "metrics": benchmark_metrics,
+        "workers": benchmark_workers,
+        "database": benchmark_database,
+        "player_creation": benchmark_player_creation,
+        "player_update": benchmark_player_update,
+        "item_names": benchmark_item_names,
+        "catalog": benchmark_catalog,
+        "backoff": benchmark_backoff,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print(__doc__)
+        sys.exit(1)
+    benchmarks[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
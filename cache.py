@@ -0,0 +1,136 @@
+"""
+Cache of the responses of the read-only views (monitoring pages and exports)
+
+Each table has a generation counter, incremented (bump) each time the table is modified.
+A view decorated with cached(tables) is cached by route and arguments, with the generations of the tables it reads:
+    * the cached response is sent again as long as the generations did not change
+    * the ETag of a response is built from the generations, a request with a matching If-None-Match
+      is answered with 304 Not Modified without reading the database
+Streamed responses (exports) are not kept in memory but still get an ETag.
+The counters must be bumped after the modification is committed.
+"""
+
+import uuid
+import hashlib
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+
+from flask import current_app, request, session, Response
+
+import ingest
+import catalog
+
+
+# Tables modified by the ingestion of the statistics (the scores of the players are updated)
+INGEST_TABLES = ("sessions", "tests", "stats", "items", "trajectories", "players")
+
+
+class Generations(object):
+    """Generation counters of the tables"""
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = Lock()
+        # The ETags of a previous run of the server must not match
+        self.instance = uuid.uuid4().hex
+
+    def bump(self, *tables):
+        """Increments the counters of tables, called once their modification is committed"""
+        with self.lock:
+            for table in tables:
+                self.counters[table] = self.counters.get(table, 0) + 1
+
+    def get(self, tables):
+        """Returns the counters of tables"""
+        with self.lock:
+            return tuple(self.counters.get(table, 0) for table in tables)
+
+
+class ResponseCache(object):
+    """Least recently used cache of responses, limited by the total size of their bodies"""
+
+    def __init__(self, max_size=64 * 1024 * 1024, max_body_size=8 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_body_size = max_body_size
+        self.size = 0
+        # {key: (generations, body, status, headers)}
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.enabled = True
+
+    def get(self, key, generations):
+        """Returns the cached entry of key if it was built with the same generations"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != generations:
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, generations, body, status, headers):
+        with self.lock:
+            if len(body) > self.max_body_size:
+                return
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[1])
+            self.entries[key] = (generations, body, status, headers)
+            self.size += len(body)
+            while self.size > self.max_size:
+                self.size -= len(self.entries.popitem(last=False)[1][1])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+generations = Generations()
+responses = ResponseCache()
+
+
+def bump(*tables):
+    """Invalidates the responses reading tables"""
+    generations.bump(*tables)
+
+
+# Statistics written by the ingestion
+ingest.listeners.append(lambda keys: bump(*INGEST_TABLES))
+# Names of the items read again
+catalog.listeners.append(lambda: bump("item_names"))
+
+
+def cached(*tables):
+    """Decorator caching the responses of a view reading tables, with ETag support"""
+    def decorator(view):
+        @wraps(view)
+        def cached_view(*args, **kwargs):
+            # Flashed messages are shown once, the page is not cached
+            if not responses.enabled or session.get("_flashes"):
+                return view(*args, **kwargs)
+
+            key = (request.endpoint, tuple(sorted(request.view_args.items())), request.query_string)
+            if "item_names" in tables:
+                # The catalog is read again if it is old, its generation is bumped if it changed
+                catalog.names()
+            current = generations.get(tables)
+            etag = hashlib.sha1(repr((generations.instance, key, current)).encode("utf-8")).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                entry = responses.get(key, current)
+                if entry is not None:
+                    response = Response(entry[1], status=entry[2], headers=entry[3])
+                else:
+                    response = current_app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if not response.is_streamed and not response.direct_passthrough:
+                        headers = [(k, v) for (k, v) in response.headers if k.lower() != "content-length"]
+                        responses.put(key, current, response.get_data(), response.status_code, headers)
+            response.set_etag(etag)
+            # The browser checks the ETag before using its copy
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        return cached_view
+    return decorator
@@ -0,0 +1,119 @@
+"""
+Catalog of the names of the items: {Minecraft item id: name}, read from the item_names table (filled by setup_db.py)
+
+The table is reference data: it is read once and kept in memory as an immutable mapping shared by the threads,
+so that the pages and exports do not load the ItemName of each item.
+The table is read again at most every REFRESH_INTERVAL seconds (or by refresh()), the mapping is replaced and
+the listeners are called only if the table changed.
+
+The table is filled from CATALOG_FILE (one "item id<TAB>name" per line), built once from the items list of
+the Minecraft wiki with:
+    python catalog.py [items_list.html]
+"""
+
+import sys
+
+import time
+from threading import Lock
+from types import MappingProxyType
+
+from database import db_session
+from models import ItemName
+
+
+# Pre-parsed catalog shipped with the project, and the page it is built from
+CATALOG_FILE = "items.tsv"
+HTML_FILE = "items_list.html"
+
+# Maximum time in seconds before a modification of the table (ex. by setup_db.py) is seen
+REFRESH_INTERVAL = 60
+
+# Functions called without arguments when the catalog changes
+listeners = []
+
+catalog = None
+loaded = 0
+lock = Lock()
+
+
+def refresh(force=True):
+    """Reads the table again (if force or if the catalog is older than REFRESH_INTERVAL), returns the catalog"""
+    global catalog, loaded
+    changed = False
+    with lock:
+        if force or catalog is None or time.time() - loaded > REFRESH_INTERVAL:
+            names = dict(db_session.query(ItemName.item, ItemName.name))
+            if catalog is None or names != catalog:
+                catalog = MappingProxyType(names)
+                changed = True
+            loaded = time.time()
+        current = catalog
+    if changed:
+        for listener in listeners:
+            listener()
+    return current
+
+
+def names():
+    """Returns the catalog {item id: name}"""
+    if catalog is None or time.time() - loaded > REFRESH_INTERVAL:
+        return refresh(force=False)
+    return catalog
+
+
+def name(item_id):
+    """Returns the name of an item, None if it is not in the catalog"""
+    return names().get(item_id)
+
+
+def parse_html(path=HTML_FILE):
+    """Returns the items [(item id, name)] of the items list page (requires BeautifulSoup)"""
+    from bs4 import BeautifulSoup
+    with open(path, "r", encoding="utf-8") as f:
+        soup = BeautifulSoup(f.read(), "html.parser")
+    items = []
+    for row in soup.find_all("tr"):
+        id_, img, name = row.find_all("td")
+        items.append((id_.string.strip(), name.a.string.strip()))
+    return items
+
+
+def write_file(items, path=CATALOG_FILE):
+    """Writes the items [(item id, name)] to the catalog file, raises ValueError if an item cannot be written"""
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        for (item, name) in items:
+            if "\t" in item + name or "\n" in item + name:
+                raise ValueError("Invalid item {}: {}".format(item, name))
+            f.write("{}\t{}\n".format(item, name))
+
+
+def read_file(path=CATALOG_FILE):
+    """Returns the items [(item id, name)] of the catalog file"""
+    with open(path, "r", encoding="utf-8") as f:
+        return [tuple(line.rstrip("\n").split("\t", 1)) for line in f if line.strip()]
+
+
+def upsert(items):
+    """
+    Adds the new items [(item id, name)] to the table and updates the names which changed, with one query,
+    one bulk insert, one bulk update and one commit. Returns (number of items added, number of items updated)
+    """
+    items = dict(items)
+    existing = dict((item, (id_, name)) for (id_, item, name) in db_session.query(ItemName.id, ItemName.item, ItemName.name))
+    added = [{"item": item, "name": name} for (item, name) in items.items() if item not in existing]
+    updated = [{"id": existing[item][0], "name": name} for (item, name) in items.items()
+               if item in existing and existing[item][1] != name]
+    if added:
+        db_session.bulk_insert_mappings(ItemName, added)
+    if updated:
+        db_session.bulk_update_mappings(ItemName, updated)
+    db_session.commit()
+    if added or updated:
+        refresh()
+    return len(added), len(updated)
+
+
+if __name__ == "__main__":
+    items = parse_html(sys.argv[1] if len(sys.argv) > 1 else HTML_FILE)
+    write_file(items)
+    print("{} items written to {}".format(len(items), CATALOG_FILE))
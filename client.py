@@ -2,18 +2,97 @@
 Client used for connecting to another player and launching Minecraft
 The interface is using TkInter
 Settings for the server and Minecraft are located in the settings.yml file
+
+The requests to the server are sent by a background thread (Worker) with one keep-alive HTTP session,
+so that the interface is never blocked: the results are given back to the interface, which polls them with after().
+When the server cannot be reached, the requests are sent again after a random delay growing exponentially,
+so that the clients do not all come back at the same time after a problem of the server.
 """
 
 
 
 import tkinter as tk
+import queue
+import random
+import threading
 import time
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException, ConnectionError
 import subprocess
 from utils import read_settings
 
 
+# Interval in milliseconds at which the interface reads the results of the worker
+POLL_INTERVAL = 50
+
+# Delay before the first retry in seconds, doubled on each failure up to the maximum delay (server/max_backoff)
+BACKOFF_BASE = 1
+
+# Attempts to disconnect the player when the client is closed, within DISCONNECT_TIME seconds
+DISCONNECT_ATTEMPTS = 4
+DISCONNECT_TIME = 5
+
+
+def backoff_delay(attempt, maximum):
+    """Returns the time to wait before the retry following the attempt-th failure (full jitter)"""
+    return random.uniform(0, min(maximum, BACKOFF_BASE * 2 ** attempt))
+
+
+class Worker(threading.Thread):
+    """
+    Thread sending the requests to the server with one HTTP session (connections kept alive)
+    A task is a function called in the thread, its result is given to a callback called in the thread of the interface
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.session = requests.Session()
+        # One connection, the tasks are sent one after the other
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()
+        # Set when the client is closed, the tasks waiting for the server stop
+        self.stopping = threading.Event()
+
+    def submit(self, function, callback, *args):
+        """Calls function(*args) in the thread, then callback(result) in the thread of the interface"""
+        self.tasks.put((function, callback, args))
+
+    def notify(self, callback, result):
+        """Calls callback(result) in the thread of the interface"""
+        self.results.put((callback, result))
+
+    def run(self):
+        while not self.stopping.is_set():
+            task = self.tasks.get()
+            if task is None:
+                break
+            function, callback, args = task
+            try:
+                result = function(*args)
+            except Exception as e:
+                result = {"status": -1, "text": "An exception has occured!"}
+            self.notify(callback, result)
+
+    def poll(self):
+        """Calls the callbacks of the finished tasks, from the thread of the interface"""
+        while True:
+            try:
+                callback, result = self.results.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                callback(result)
+            except Exception as e:
+                # The next results must still be handled
+                print("Error in {}: {!r}".format(callback.__name__, e))
+
+    def stop(self):
+        self.stopping.set()
+        self.tasks.put(None)
 
 
 class Application(tk.Frame):
@@ -29,16 +108,45 @@ class Application(tk.Frame):
         self.grid()
         self.createWidgets()
         self.server_root = "http://{}:{}/".format(self.settings["server"]["address"], self.settings["server"]["port"])
+        # Time in seconds to connect to the server and to receive a response, maximum delay between two attempts
+        self.timeout = self.settings["server"].get("timeout", 10)
+        self.max_backoff = self.settings["server"].get("max_backoff", 30)
+        self.worker = Worker()
+        self.worker.start()
+        self.poll_worker()
+
+    def poll_worker(self):
+        """Gives the results of the requests to the interface"""
+        try:
+            self.worker.poll()
+        finally:
+            self.master.after(POLL_INTERVAL, self.poll_worker)
 
     def destroy(self):
         """Overrides the destroy method to disconnect the players first"""
+        self.worker.stop()
         if self.player_id is not None:
-            status = -1
-            while status == -1:
-                d = self.get_data("disconnect/{}".format(self.player_id))
-                status = d["status"]
+            # The worker may still be waiting for the server (long poll): the player is disconnected in another thread,
+            # with its own session, while the window is hidden. The client closes after DISCONNECT_TIME seconds at most
+            self.master.withdraw()
+            disconnection = threading.Thread(target=self.disconnect_player, daemon=True)
+            disconnection.start()
+            disconnection.join(DISCONNECT_TIME)
         tk.Frame.destroy(self)
-        
+
+    def disconnect_player(self):
+        """Disconnects the player when the client is closed, a few attempts only within DISCONNECT_TIME seconds"""
+        deadline = time.time() + DISCONNECT_TIME
+        with requests.Session() as session:
+            for attempt in range(DISCONNECT_ATTEMPTS):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                d = self.get_data("disconnect/{}".format(self.player_id), timeout=min(self.timeout, remaining), session=session)
+                if d.get("status") != -1:
+                    return
+                time.sleep(max(0, min(backoff_delay(attempt, 2), deadline - time.time())))
+
     def createWidgets(self):
         """Creates the interface"""
         self.field_label = tk.Label(self, text="Enter your key:")
@@ -57,47 +165,80 @@ class Application(tk.Frame):
         self.button_connect["state"] = tk.DISABLED
         self.field_connect["text"] = "Checking identification..."
         print(self.field_connect["text"])
-        self.master.after(100, self.callback_identification)
-
-    def callback_identification(self):
-        """"Sends the key to the server for identification and calls the connection method"""
         self.key = self.var_key.get()
-        d = self.get_data("identification/", method="POST", data={"key":self.key})
+        self.worker.submit(self.get_data, self.callback_identification, "identification/", "POST", {"key":self.key})
 
-        if d["status"] == 1:
+    def callback_identification(self, d):
+        """"Receives the identification of the key by the server and calls the connection method"""
+        if d.get("status") == 1:
             # Identification went fine
             self.field_connect["text"] = d["text"]
             self.field_connect["text"] += "\nConnecting to server..."
             self.player_id = d["data"]["player_id"]
             print(self.player_id)
             print(self.field_connect["text"])
-            self.master.after(100, self.callback_connection)
+            self.worker.submit(self.connect_player, self.callback_connection)
         else:
             # Identification problem
-            self.field_connect["text"] = d["text"]
+            self.field_connect["text"] = d.get("text", "An exception has occured!")
             self.button_connect["state"] = tk.NORMAL
             print(self.field_connect["text"])
 
-    def callback_connection(self):
-        """Sets the player available for connection"""
-        d = self.get_data("connect/", method="POST", data={"id":self.player_id})
+    def connect_player(self):
+        """Sets the player available for connection (in the worker), returns the answer or None if the client is closed"""
+        failures = 0
+        while not self.worker.stopping.is_set():
+            d = self.get_data("connect/", method="POST", data={"id":self.player_id})
+            if d.get("status") != -1:
+                return d
+            # The key is already in use on the server, so we try again rather than asking for it again
+            self.worker.notify(self.show_text, d.get("text", "An exception has occured!"))
+            self.worker.stopping.wait(backoff_delay(failures, self.max_backoff))
+            failures += 1
+        return None
 
-        if d["status"] == 1:
+    def callback_connection(self, d):
+        """Receives the availability of the player for connection and waits for the connection"""
+        if d is None:
+            return
+        if d.get("status") == 1:
             self.field_connect["text"] = "Searching for other player..."
-            self.master.after(100, self.callback_wait_for_connection)
-        
-    def callback_wait_for_connection(self):
-        """Wait until the player is connected"""
-        connected = False
-        while not connected:
-            d = self.get_data("connected_with/{}".format(self.player_id))
-            if d["status"] == 1:
-                connected = True
-                d = d["data"]
+            self.worker.submit(self.wait_for_connection, self.callback_wait_for_connection)
+        else:
+            # The player does not exist anymore, another key can be entered
+            self.player_id = None
+            self.field_connect["text"] = d.get("text", "An exception has occured!")
+            self.button_connect["state"] = tk.NORMAL
+            print(self.field_connect["text"])
+
+    def wait_for_connection(self):
+        """Waits until the player is connected (in the worker), returns the connection or None if the client is closed"""
+        # The server holds the request until the player is connected or the long poll time is over
+        long_poll = self.settings["server"].get("long_poll", 25)
+        failures = 0
+        while not self.worker.stopping.is_set():
+            start = time.time()
+            d = self.get_data("connected_with/{}".format(self.player_id), params={"wait": long_poll},
+                              timeout=(self.timeout, long_poll + self.timeout))
+            if d.get("status") == 1:
+                return d["data"]
+            self.worker.notify(self.show_text, d.get("text", "An exception has occured!"))
+            # The server answers right away when the player is not available for connection
+            if d.get("status") == -1 or time.time() - start < 1:
+                # We wait before attempting again if the server has a problem, longer after each failure
+                self.worker.stopping.wait(backoff_delay(failures, self.max_backoff))
+                failures += 1
             else:
-                time.sleep(2)
-                self.field_connect["text"] = d["text"]
+                failures = 0
+        return None
+
+    def show_text(self, text):
+        self.field_connect["text"] = text
 
+    def callback_wait_for_connection(self, d):
+        """Writes the Minecraft connection files once the player is connected"""
+        if d is None:
+            return
         if d["role"] == 0:
             role = "Client"
         elif d["role"] == 1:
@@ -116,17 +257,22 @@ class Application(tk.Frame):
         self.button_connect["command"] = self.play
         self.button_connect["state"] = tk.NORMAL
 
-    def get_data(self, url, method = "GET", data = None):
-        """Generic method to reach the server"""
+    def get_data(self, url, method = "GET", data = None, params = None, timeout = None, session = None):
+        """
+        Generic method to reach the server, timeout is the time to connect and to receive the response
+        The session of the worker is used by default, only from the thread of the worker
+        """
         url = self.server_root + url
+        timeout = timeout or self.timeout
+        session = session or self.worker.session
         d = {}
         d["status"] = -1
         try:
             if method == "GET":
-                r = requests.get(url)
+                r = session.get(url, params=params, timeout=timeout)
                 d = r.json()
             elif method == "POST":
-                r = requests.post(url, data=data)
+                r = session.post(url, data=data, params=params, timeout=timeout)
                 d = r.json()
         except ConnectionError as e:
             d["text"] = "Server is not reachable.\n Please wait and try again..."
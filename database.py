@@ -1,16 +1,92 @@
 """
 Creates the necessary variables for database interaction
-Database settings are defined in settings.yml
+Database settings are defined in settings.yml, either the connection URI or a section:
+    * uri: connection URI
+    * profile: values of the options below, default or high_throughput (see PROFILES), the options given override them
+    * journal_mode, synchronous, cache_size, mmap_size, busy_timeout: SQLite PRAGMA set on each new connection
+    * pool_size, max_overflow, pool_recycle: pool of connections. By default SQLite opens a new connection for each
+      session, with pool_size its connections are kept open (with their page cache) and shared by the threads
 """
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from utils import read_settings
 
-db = read_settings()["database"]
 
-engine = create_engine(db, convert_unicode=True)
+PROFILES = {
+    # Defaults of SQLite and SQLAlchemy: rollback journal, a writer blocks the readers during its commit
+    "default": {},
+    # Readers and writer do not block each other (WAL), commits are not synced to disk: a power loss can lose
+    # the last transactions but does not corrupt the database. Larger page cache, database file read with mmap
+    "high_throughput": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "busy_timeout": 10000,
+        "pool_size": 20,
+        "max_overflow": 20,
+        "pool_recycle": 3600,
+    },
+}
+
+# Accepted values of the options
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA")
+SQLITE_OPTIONS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "busy_timeout")
+POOL_OPTIONS = ("pool_size", "max_overflow", "pool_recycle")
+
+
+def database_options(value):
+    """Reads the database settings (URI or section), returns (uri, options), raises ValueError if an option is not valid"""
+    if isinstance(value, str):
+        return value, {}
+    options = dict(value)
+    uri = options.pop("uri")
+    profile = options.pop("profile", "default")
+    if profile not in PROFILES:
+        raise ValueError("Unknown database profile {}".format(profile))
+    options = dict(PROFILES[profile], **options)
+
+    for (name, option) in options.items():
+        if name in ("journal_mode", "synchronous"):
+            options[name] = str(option).upper()
+            if options[name] not in (JOURNAL_MODES if name == "journal_mode" else SYNCHRONOUS):
+                raise ValueError("Invalid value for {}: {}".format(name, option))
+        elif name in SQLITE_OPTIONS or name in POOL_OPTIONS:
+            options[name] = int(option)
+        else:
+            raise ValueError("Unknown database option {}".format(name))
+    return uri, options
+
+
+def create_database_engine(uri, options):
+    """Creates the engine of the database, the SQLite options are set on each new connection"""
+    kwargs = dict((name, options[name]) for name in POOL_OPTIONS if name in options)
+    pragmas = []
+    if uri.startswith("sqlite"):
+        pragmas = [(name, options[name]) for name in SQLITE_OPTIONS if name in options]
+        if "pool_size" in options:
+            # A connection is used by one thread at a time, but not always by the thread which opened it
+            kwargs.update(poolclass=QueuePool, connect_args={"check_same_thread": False})
+        else:
+            kwargs.pop("max_overflow", None)
+    engine = create_engine(uri, convert_unicode=True, **kwargs)
+
+    if pragmas:
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for (name, value) in pragmas:
+                # The values are checked by database_options
+                cursor.execute("PRAGMA {} = {}".format(name, value))
+            cursor.close()
+    return engine
+
+
+engine = create_database_engine(*database_options(read_settings()["database"]))
 Base = declarative_base(engine)
 db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
 Base.query = db_session.query_property()
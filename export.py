@@ -0,0 +1,166 @@
+"""
+Columnar export of the statistics for analysis pipelines (NumPy, pandas...)
+
+Three tables are exported, each column being a typed array:
+    * tests: test_id, session_id, session_uuid, world, round, timestamp
+    * stats: the columns of the stats table, except checkpoints and position_over_time
+    * items: long format (test_id, player_id, item_item, use_item, mine_block, craft_item, break_item)
+NULL values are exported as 0, NaN, NaT or empty strings depending on the type of the column.
+
+Formats:
+    * npy: a directory with one <table>.<column>.npy file per column, see load() to open it memory-mapped
+    * npz: the same arrays in one uncompressed archive (numpy.load opens the arrays on access)
+    * arrow: one Arrow IPC file per table (<table>.arrow), if pyarrow is installed
+
+The database is read by chunks of rows, the npy files are filled in place so that the memory used
+does not depend on the size of the database.
+
+Usage: python export.py <path> [npy|npz|arrow]
+"""
+
+import os
+import sys
+import glob
+import shutil
+import zipfile
+import tempfile
+
+from sqlalchemy import select, func, Integer, Float, Boolean, DateTime, String
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from database import db_session
+from models import Session, Test, Stat, Item
+
+
+FORMATS = ("npy", "npz", "arrow")
+
+# Number of rows read from the database at once
+CHUNK_SIZE = 10000
+
+
+def tables():
+    """Returns the exported tables: [(name, key column, [(column name, column)], from clause)]"""
+    sessions, tests, stats, items = Session.__table__, Test.__table__, Stat.__table__, Item.__table__
+    return [
+        ("tests", tests.c.id, [("test_id", tests.c.id), ("session_id", tests.c.session_id), ("session_uuid", sessions.c.session_uuid),
+                               ("world", tests.c.world), ("round", tests.c.round), ("timestamp", tests.c.timestamp)], tests.outerjoin(sessions)),
+        ("stats", stats.c.id, [(c.name, c) for c in stats.columns if c.name not in ("checkpoints", "position_over_time")], stats),
+        ("items", items.c.id, [(c.name, c) for c in items.columns if c.name != "id"], items),
+    ]
+
+
+def column_type(column):
+    """Returns the NumPy dtype of a column and the value replacing NULL"""
+    if isinstance(column.type, Boolean):
+        return "?", False
+    if isinstance(column.type, Integer):
+        return "i8", 0
+    if isinstance(column.type, Float):
+        return "f8", float("nan")
+    if isinstance(column.type, DateTime):
+        return "M8[us]", None
+    if isinstance(column.type, String):
+        return "U{}".format(column.type.length or 100), ""
+    raise TypeError("Column {} cannot be exported".format(column))
+
+
+def read_chunks(key, columns, from_clause, last_key, chunk_size=CHUNK_SIZE):
+    """Reads the rows up to last_key by chunks, yields for each chunk the list of the column arrays"""
+    types = [column_type(column) for (name, column) in columns]
+    start = None
+    while True:
+        q = select([column for (name, column) in columns] + [key.label("export_key")]).select_from(from_clause).where(key <= last_key)
+        if start is not None:
+            q = q.where(key > start)
+        rows = db_session.execute(q.order_by(key).limit(chunk_size)).fetchall()
+        if not rows:
+            return
+        start = rows[-1][-1]
+        arrays = []
+        for (i, (dtype, null)) in enumerate(types):
+            arrays.append(np.array([null if row[i] is None else row[i] for row in rows], dtype=dtype))
+        yield arrays
+
+
+def export(path, format="npy", chunk_size=CHUNK_SIZE):
+    """Exports the statistics to path (a directory for npy and arrow, a file or a file object for npz)"""
+    if np is None:
+        raise RuntimeError("NumPy is needed to export the statistics")
+    if format == "arrow" and pyarrow is None:
+        raise RuntimeError("pyarrow is needed to export the statistics in the Arrow format")
+    if format not in FORMATS:
+        raise ValueError("Unknown format {}".format(format))
+
+    if format == "npz":
+        # The npy files are written in a temporary directory and stored in the archive
+        directory = tempfile.mkdtemp()
+        try:
+            export(directory, "npy", chunk_size)
+            with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+                for filename in sorted(os.listdir(directory)):
+                    archive.write(os.path.join(directory, filename), filename)
+        finally:
+            shutil.rmtree(directory)
+        return
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for (table, key, columns, from_clause) in tables():
+        # Rows added during the export are ignored
+        (count, last_key) = db_session.execute(select([func.count(key), func.max(key)]).select_from(from_clause)).fetchone()
+        last_key = last_key or 0
+        chunks = read_chunks(key, columns, from_clause, last_key, chunk_size)
+
+        if format == "npy":
+            arrays = [np.lib.format.open_memmap(os.path.join(path, "{}.{}.npy".format(table, name)), mode="w+", dtype=column_type(column)[0], shape=(count,))
+                      for (name, column) in columns]
+            offset = 0
+            for chunk in chunks:
+                for (array, values) in zip(arrays, chunk):
+                    array[offset:offset + len(values)] = values
+                offset += len(chunk[0])
+            for array in arrays:
+                array.flush()
+            del arrays
+
+        elif format == "arrow":
+            writer = None
+            with pyarrow.OSFile(os.path.join(path, "{}.arrow".format(table)), "wb") as f:
+                for chunk in chunks:
+                    batch = pyarrow.RecordBatch.from_arrays([pyarrow.array(values) for values in chunk], [name for (name, column) in columns])
+                    if writer is None:
+                        writer = pyarrow.ipc.new_file(f, batch.schema)
+                    writer.write_batch(batch)
+                if writer is None:
+                    # Empty table
+                    arrays = [pyarrow.array(np.array([], dtype=column_type(column)[0])) for (name, column) in columns]
+                    batch = pyarrow.RecordBatch.from_arrays(arrays, [name for (name, column) in columns])
+                    writer = pyarrow.ipc.new_file(f, batch.schema)
+                writer.close()
+    db_session.remove()
+
+
+def load(path):
+    """Opens an export in the npy format, memory-mapped: returns {table: {column: array}}"""
+    data = {}
+    for filename in glob.glob(os.path.join(path, "*.npy")):
+        (table, column, extension) = os.path.basename(filename).split(".")
+        data.setdefault(table, {})[column] = np.load(filename, mmap_mode="r")
+    return data
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or (len(sys.argv) > 2 and sys.argv[2] not in FORMATS):
+        print(__doc__)
+        sys.exit(1)
+    export(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "npy")
+    print("Statistics exported to {}".format(sys.argv[1]))
@@ -0,0 +1,386 @@
+"""
+Ingestion of the statistics sent by the Minecraft mod at the end of each round
+
+A payload is the JSON sent to /upload_json/ (see post_json.py):
+    * session_id, world, round, player, checkpoints, score: required
+    * stats: JSON string containing the Minecraft statistics of the player
+    * position_over_time, solution: optional
+"""
+
+import re
+from collections import OrderedDict, Counter
+from threading import Lock
+
+from flask import json
+from sqlalchemy import func
+from sqlalchemy import exc
+
+from database import db_session
+from models import Session, Test, Stat, Item, Player, Trajectory
+import metrics
+import trajectory
+
+
+# Maximum number of values in an IN clause (SQLite accepts at most 999 parameters)
+IN_CHUNK_SIZE = 500
+
+# Errors meaning that the database is not available (the payloads can be written later), the other errors come from the payloads
+UNAVAILABLE_ERRORS = (exc.OperationalError, exc.DisconnectionError, exc.TimeoutError)
+
+# Functions called with the list of (test_id, player_id) whose stats were written, once they are committed
+listeners = []
+
+# Minecraft statistics that can be stored for a player and for an item
+STAT_COLUMNS = set(c.name for c in Stat.__table__.columns) - set(["id", "test_id", "player_id", "checkpoints", "position_over_time", "solution", "score", "number_biomes"])
+ITEM_COLUMNS = set(c.name for c in Item.__table__.columns) - set(["id", "test_id", "player_id", "item_item"])
+
+
+def chunks(values, size=IN_CHUNK_SIZE):
+    """Splits a list of values in lists of at most size values"""
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def notify_written(keys):
+    """Calls the listeners with the list of (test_id, player_id) whose stats were written"""
+    for listener in listeners:
+        listener(keys)
+
+
+def parse_payload(data):
+    """
+    Checks a payload and returns its values as a dictionary
+    Raises an exception if a required field is missing or invalid
+    """
+    values = {
+        "session_uuid": str(data['session_id']),
+        "world": data['world'],
+        "round": str(data['round']),
+        "player_id": int(data['player']),
+        "stats": json.loads(data['stats']),
+        "position_over_time": data.get('position_over_time'),
+        "solution": data.get('solution', "Not implemented"),
+        "checkpoints": data['checkpoints'],
+        "score": int(data['score'])
+    }
+    # The values stored as they are must have the type of their column, otherwise the payload could be accepted
+    # (write-behind mode) and fail when it is written
+    if not isinstance(values["world"], str):
+        raise ValueError("world must be a string")
+    if values["solution"] is not None and not isinstance(values["solution"], str):
+        raise ValueError("solution must be a string")
+    if not isinstance(values["stats"], dict):
+        raise ValueError("stats must be a JSON object")
+    for (key, value) in values["stats"].items():
+        if key.startswith("stat.") and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError("The value of {} must be a number".format(key))
+    return values
+
+
+class StatKeyResolver(object):
+    """
+    Resolves the keys of the Minecraft statistics (ex. stat.walkOneCm, stat.mineBlock.3) to the column storing them
+    The columns are read once from the models and each key is parsed only once:
+    known keys are kept in a dictionary of at most max_known keys (the item ids are sent by the clients, the keys
+    parsed afterwards are not kept), unknown keys in a cache of at most max_unknown keys
+    The unknown keys are counted in the unknown attribute and in the idp_unknown_stat_keys_total metric,
+    by key for the first max_unknown keys, the other ones under the OTHER key
+    """
+
+    # Targets of the keys
+    STAT = "stat"
+    ITEM = "item"
+    BIOMES = "biomes"
+
+    # Unknown keys counted once max_unknown keys are counted
+    OTHER = "other"
+
+    def __init__(self, max_unknown=1000, max_known=10000):
+        self.stat_columns = STAT_COLUMNS
+        self.item_columns = ITEM_COLUMNS
+        # {key: (target, column, item_id)}
+        self.known = {}
+        self.max_known = max_known
+        # Unknown keys, in order of last use
+        self.unknown_keys = OrderedDict()
+        self.max_unknown = max_unknown
+        # Number of times each unknown key was sent (limited to max_unknown keys)
+        self.unknown = Counter()
+        self.lock = Lock()
+
+    def parse(self, key):
+        """Parses a key, returns (target, column, item_id) or None if the key is not stored"""
+        k = key.split('.', 2)
+        if k[0] == 'stat' and len(k) > 1:
+            # changes columnName into column_name
+            column = re.sub("([A-Z])","_\g<1>", k[1]).lower()
+            if len(k) == 3:
+                if column in self.item_columns:
+                    return (self.ITEM, column, k[2])
+            elif column in self.stat_columns:
+                return (self.STAT, column, None)
+        elif key == 'achievement.exploreAllBiomes':
+            return (self.BIOMES, 'number_biomes', None)
+        return None
+
+    def resolve(self, key):
+        """Returns (target, column, item_id) for a key, or None if the key is not stored"""
+        target = self.known.get(key)
+        if target is not None:
+            return target
+        with self.lock:
+            if key in self.unknown_keys:
+                self.unknown_keys.move_to_end(key)
+                self.count_unknown(key)
+                return None
+            target = self.parse(key)
+            if target is not None:
+                if len(self.known) < self.max_known:
+                    self.known[key] = target
+                return target
+            self.unknown_keys[key] = True
+            if len(self.unknown_keys) > self.max_unknown:
+                self.unknown_keys.popitem(last=False)
+            self.count_unknown(key)
+            return None
+
+    def count_unknown(self, key):
+        """Counts an unknown key, exposed at /metrics (idp_unknown_stat_keys_total), at most max_unknown keys are counted"""
+        if key not in self.unknown and len(self.unknown) >= self.max_unknown:
+            key = self.OTHER
+        self.unknown[key] += 1
+        metrics.unknown_stat_keys.inc((key,))
+
+
+resolver = StatKeyResolver()
+
+
+def parse_stats(stats):
+    """
+    Splits the Minecraft statistics of a player
+    Returns the statistics of the player {column: value} and the statistics by item {item_id: {column: value}}
+    """
+    stat_values = {}
+    items = {}
+
+    for (k,v) in stats.items():
+        target = resolver.resolve(k)
+        if target is None:
+            continue
+        (table, column, item_id) = target
+        if table == StatKeyResolver.STAT:
+            stat_values[column] = v
+        elif table == StatKeyResolver.ITEM:
+            if not item_id in items:
+                items[item_id] = {}
+            items[item_id][column] = v
+        elif table == StatKeyResolver.BIOMES:
+            try:
+                stat_values[column] = len(v['progress'])
+            except:
+                pass
+
+    return stat_values, items
+
+
+def apply_stat_values(stat, values, stat_values):
+    """
+    Sets the values of a payload and the statistics of the player on his stat
+    Returns the values of the Trajectory of the stat (see save_trajectories), None if position_over_time is not a trajectory
+    """
+    trajectory_values = None
+    points = trajectory.parse(values["position_over_time"])
+    if points is not None:
+        trajectory_values = trajectory.encode(*points)
+        stat.position_over_time = None
+    else:
+        try:
+            stat.position_over_time = json.dumps(values["position_over_time"])
+        except Exception as e:
+            print(e)
+
+    stat.checkpoints = json.dumps(values["checkpoints"])
+    stat.solution = values["solution"]
+    stat.score = values["score"]
+
+    for (column, v) in stat_values.items():
+        setattr(stat, column, v)
+
+    return trajectory_values
+
+
+def save_trajectories(trajectories):
+    """
+    Saves the trajectories of stats {stat_id: values returned by apply_stat_values}
+    The trajectories are inserted or updated in bulk, the trajectory of a stat is removed if its values are None
+    """
+    existing = {}
+    for stat_ids in chunks(trajectories.keys()):
+        for (trajectory_id, stat_id) in db_session.query(Trajectory.id, Trajectory.stat_id).filter(Trajectory.stat_id.in_(stat_ids)):
+            existing[stat_id] = trajectory_id
+
+    new_trajectories = []
+    updated_trajectories = []
+    for (stat_id, values) in trajectories.items():
+        if values is None:
+            continue
+        if stat_id in existing:
+            updated_trajectories.append(dict(values, id=existing[stat_id]))
+        else:
+            new_trajectories.append(dict(values, stat_id=stat_id))
+    db_session.bulk_insert_mappings(Trajectory, new_trajectories)
+    db_session.bulk_update_mappings(Trajectory, updated_trajectories)
+
+    removed = [existing[stat_id] for (stat_id, values) in trajectories.items() if values is None and stat_id in existing]
+    for ids in chunks(removed):
+        db_session.query(Trajectory).filter(Trajectory.id.in_(ids)).delete(synchronize_session=False)
+
+
+def update_players_score(player_ids=None):
+    """
+    Recomputes the scores of players from their last test (the most recent test they have statistics in):
+    score of the player, average and maximum score of the players of this test
+    Called when statistics are added, for all the players of the tests concerned (their team scores change)
+    player_ids: players to update, all the players if None
+    The stats must be flushed, the changes are not committed
+    """
+    if player_ids is None:
+        player_ids = [player_id for (player_id,) in db_session.query(Player.id)]
+
+    # Last test of each player: {player_id: (timestamp, test_id, score)}
+    last_tests = {}
+    for ids in chunks(set(player_ids)):
+        players = set(player_id for (player_id,) in db_session.query(Player.id).filter(Player.id.in_(ids)))
+        q = db_session.query(Stat.player_id, Test.timestamp, Test.id, Stat.score).join(Test, Stat.test_id == Test.id).filter(Stat.player_id.in_(players))
+        for (player_id, timestamp, test_id, score) in q:
+            last = last_tests.get(player_id)
+            if last is None or (timestamp, test_id) > last[:2]:
+                last_tests[player_id] = (timestamp, test_id, score)
+
+    # Average and maximum score of each test
+    team_scores = {}
+    for test_ids in chunks(set(last[1] for last in last_tests.values())):
+        q = db_session.query(Stat.test_id, func.avg(Stat.score), func.max(Stat.score)).filter(Stat.test_id.in_(test_ids)).group_by(Stat.test_id)
+        for (test_id, team_score_avg, team_score_max) in q:
+            team_scores[test_id] = (team_score_avg, team_score_max)
+
+    mappings = []
+    for (player_id, (timestamp, test_id, score)) in last_tests.items():
+        (team_score_avg, team_score_max) = team_scores[test_id]
+        mappings.append({"id": player_id, "score": score or 0, "team_score_avg": float(team_score_avg or 0), "team_score_max": team_score_max or 0})
+    db_session.bulk_update_mappings(Player, mappings)
+    return len(mappings)
+
+
+
+def add_stats_batch(payloads):
+    """
+    Adds a list of payloads to the database in one transaction (split if some payloads cannot be written, see write_batch)
+    Sessions, tests, stats and items are looked up with one query per table (per chunk of IN values),
+    the items are inserted and updated in bulk
+    Returns the result of each payload: {"status": 1 if added, 0 if invalid, -1 if the database is not available, "text": message}
+    """
+    results = [None] * len(payloads)
+    parsed = []
+    for (i, data) in enumerate(payloads):
+        try:
+            values = parse_payload(data)
+            values["stat_values"], values["items"] = parse_stats(values["stats"])
+            parsed.append((i, values))
+        except Exception as e:
+            results[i] = {"status": 0, "text": "Invalid statistics: {!r}".format(e)}
+
+    write_batch(parsed, results)
+    return results
+
+
+def write_batch(parsed, results):
+    """
+    Writes the parsed payloads [(index, values)] in one transaction and sets their results
+    If the transaction fails because of the data, it is split in two halves written separately,
+    so that only the payloads which cannot be written fail (status 0).
+    If the database is not available (UNAVAILABLE_ERRORS), all the payloads fail with status -1
+    """
+    if not parsed:
+        return
+    try:
+        write_parsed(parsed)
+    except Exception as e:
+        db_session.rollback()
+        if len(parsed) > 1 and not isinstance(e, UNAVAILABLE_ERRORS):
+            half = len(parsed) // 2
+            write_batch(parsed[:half], results)
+            write_batch(parsed[half:], results)
+            return
+        print("Problem adding stats to db: {}".format(e))
+        status = -1 if isinstance(e, UNAVAILABLE_ERRORS) else 0
+        for (i, values) in parsed:
+            results[i] = {"status": status, "text": "Problem adding stats to db: {}".format(e)}
+        return
+    for (i, values) in parsed:
+        results[i] = {"status": 1, "text": "Stats added to db."}
+
+
+def write_parsed(parsed):
+    """Writes the parsed payloads [(index, values)] in one transaction, raises the exception of the database if it fails"""
+    # Sessions, by session_uuid
+    sessions = {}
+    for uuids in chunks(set(values["session_uuid"] for (i, values) in parsed)):
+        for session in db_session.query(Session).filter(Session.session_uuid.in_(uuids)):
+            sessions[session.session_uuid] = session
+    for (i, values) in parsed:
+        if values["session_uuid"] not in sessions:
+            session = sessions[values["session_uuid"]] = Session(values["session_uuid"])
+            db_session.add(session)
+    db_session.flush()
+
+    # Tests, by (session_id, world, round)
+    tests = {}
+    for session_ids in chunks(set(session.id for session in sessions.values())):
+        for test in db_session.query(Test).filter(Test.session_id.in_(session_ids)):
+            tests[(test.session_id, test.world, test.round)] = test
+    for (i, values) in parsed:
+        key = (sessions[values["session_uuid"]].id, values["world"], values["round"])
+        if key not in tests:
+            test = tests[key] = Test(*key)
+            db_session.add(test)
+        values["test"] = tests[key]
+    db_session.flush()
+
+    # Stats by (test_id, player_id) and items by (test_id, player_id, item_item)
+    stats = {}
+    items = {}
+    test_ids = set(test.id for test in tests.values())
+    for ids in chunks(test_ids):
+        for stat in db_session.query(Stat).filter(Stat.test_id.in_(ids)):
+            stats[(stat.test_id, stat.player_id)] = stat
+        q = db_session.query(Item.id, Item.test_id, Item.player_id, Item.item_item).filter(Item.test_id.in_(ids))
+        for (item_id, test_id, player_id, item_item) in q:
+            items[(test_id, player_id, item_item)] = {"id": item_id}
+
+    new_items = {}
+    trajectories = {}
+    for (i, values) in parsed:
+        test_id = values["test"].id
+        player_id = values["player_id"]
+        if (test_id, player_id) not in stats:
+            stat = stats[(test_id, player_id)] = Stat(test_id, player_id)
+            db_session.add(stat)
+        trajectories[(test_id, player_id)] = apply_stat_values(stats[(test_id, player_id)], values, values["stat_values"])
+
+        for (item_item, item_values) in values["items"].items():
+            key = (test_id, player_id, item_item)
+            if key in items:
+                item = items[key]
+            else:
+                item = new_items.setdefault(key, {"test_id": test_id, "player_id": player_id, "item_item": item_item})
+            item.update(item_values)
+
+    db_session.bulk_insert_mappings(Item, list(new_items.values()))
+    db_session.bulk_update_mappings(Item, [item for item in items.values() if len(item) > 1])
+    db_session.flush()
+    save_trajectories(dict((stats[key].id, values) for (key, values) in trajectories.items()))
+    update_players_score(set(player_id for (test_id, player_id) in stats))
+    db_session.commit()
+    notify_written(list(trajectories.keys()))
+
@@ -0,0 +1,148 @@
+"""
+Write-behind ingestion of the statistics, used when ingest.write_behind is set in settings.yml
+
+Each accepted payload is appended to a local journal file before the response is sent,
+a background writer then adds the journaled payloads to the database by batch (one transaction per batch).
+The journal is crash-safe:
+    * an entry is written on disk (flush and fsync) before the payload is accepted
+    * the sequence number of the last entry written in the database is kept in the <journal>.applied file
+    * on start, the entries not written in the database yet are replayed
+The journal is emptied each time all its entries have been written in the database.
+"""
+
+import os
+import time
+from collections import deque
+from threading import Thread, Condition
+
+from flask import json
+
+from database import db_session
+import ingest
+
+
+class IngestJournal(object):
+    """Append-only journal of the payloads waiting to be written in the database"""
+
+    def __init__(self, path, batch_size=500, fsync=True):
+        self.path = path
+        self.applied_path = path + ".applied"
+        self.batch_size = batch_size
+        self.fsync = fsync
+        # Entries waiting to be written in the database: (sequence number, payload)
+        self.pending = deque()
+        self.condition = Condition()
+        self.running = False
+        self.thread = None
+
+        # We replay the entries not written in the database yet
+        self.applied = self.read_applied()
+        self.last = self.applied
+        if os.path.exists(self.path):
+            with open(self.path, "rb+") as f:
+                content = f.read()
+                # An entry partially written before a crash was never accepted, it is removed
+                end = content.rfind(b"\n") + 1
+                if end < len(content):
+                    f.truncate(end)
+            for line in content[:end].splitlines():
+                entry = json.loads(line.decode("utf-8"))
+                if entry["seq"] > self.applied:
+                    self.pending.append((entry["seq"], entry["data"]))
+                self.last = max(self.last, entry["seq"])
+        if self.pending:
+            print("[ {} statistics to replay from {} ]".format(len(self.pending), self.path))
+        self.file = open(self.path, "a")
+
+    def read_applied(self):
+        """Returns the sequence number of the last entry written in the database"""
+        try:
+            with open(self.applied_path, "r") as f:
+                return int(f.read().strip() or 0)
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def write_applied(self, seq):
+        """Saves the sequence number of the last entry written in the database"""
+        tmp_path = self.applied_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(seq))
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.applied_path)
+        self.applied = seq
+
+    def append(self, data):
+        """Writes a payload in the journal, once it returns the payload will be written in the database"""
+        with self.condition:
+            self.last += 1
+            self.file.write(json.dumps({"seq": self.last, "data": data}) + "\n")
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.pending.append((self.last, data))
+            self.condition.notify()
+            return self.last
+
+    def start(self):
+        """Launches the writer in a background thread"""
+        self.running = True
+        self.thread = Thread(target=self.run, name="Ingest-Journal-Writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops the writer once the pending entries are written"""
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+
+    def wait_applied(self, seq, timeout=None):
+        """Waits until the entry seq is written in the database, returns True if it is"""
+        limit = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.applied < seq:
+                remaining = None if limit is None else limit - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def run(self):
+        """Writes the pending entries in the database, by batch of at most batch_size entries"""
+        retry_delay = 1
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch = [self.pending[i] for i in range(min(self.batch_size, len(self.pending)))]
+
+            try:
+                results = ingest.add_stats_batch([data for (seq, data) in batch])
+            finally:
+                db_session.remove()
+            # The entries which cannot be written have the status 0 (see ingest.write_batch), they are ignored
+            errors = [result["text"] for result in results if result["status"] == -1]
+            if errors:
+                # The database is not available, we try again later
+                print("[ journal: {}, new attempt in {} s ]".format(errors[0], retry_delay))
+                time.sleep(retry_delay)
+                retry_delay = min(2 * retry_delay, 60)
+                continue
+            retry_delay = 1
+            for ((seq, data), result) in zip(batch, results):
+                if result["status"] != 1:
+                    print("[ journal: entry {} ignored: {} ]".format(seq, result["text"]))
+
+            with self.condition:
+                for i in range(len(batch)):
+                    self.pending.popleft()
+                self.write_applied(batch[-1][0])
+                if not self.pending:
+                    # Everything is in the database, the journal can be emptied
+                    self.file.truncate(0)
+                self.condition.notify_all()
@@ -0,0 +1,292 @@
+"""
+Matchmaking engines used to connect players by pair
+
+Matchmaker: in-memory engine, for a server running in one process
+
+Players waiting for a partner are kept in a queue per (session_nr, pair) bucket:
+    * when a player becomes available and a player of his bucket is waiting, both are connected right away
+    * otherwise the player is queued and will be connected by the next player arriving in the bucket
+Pairing is done in the request of the second player, no thread is launched and no polling is done.
+An event is kept for each player so that requests waiting for his connection (long polling) are woken up.
+The queues only reference connections stored in the database, the database stays the reference.
+
+Each bucket has its own lock, so that players of different buckets never wait for each other.
+
+DatabaseMatchmaker: engine for a server running in several processes (see serve.py)
+Nothing is kept in memory, the players waiting in a bucket are read from the database. A connection is claimed
+with a conditional update (... WHERE status = 0) whose row count is checked: whatever the process handling them,
+two players can not claim the same connection. The requests waiting for a connection poll the database.
+"""
+
+from collections import OrderedDict
+from threading import Lock, RLock, Event
+
+from database import db_session
+from models import Connection, Player
+
+
+# Waiting connections of a bucket tried by DatabaseMatchmaker when the first ones are claimed by other processes
+MAX_CLAIMS = 10
+
+
+class BucketLocks(object):
+    """Gives one lock per (session_nr, pair) bucket, locks are reentrant (created by factory)"""
+
+    def __init__(self, factory=RLock):
+        self.factory = factory
+        self.locks = {}
+        # Lock protecting the creation of the bucket locks
+        self.lock = Lock()
+
+    def __getitem__(self, bucket):
+        with self.lock:
+            lock = self.locks.get(bucket)
+            if lock is None:
+                lock = self.locks[bucket] = self.factory()
+            return lock
+
+
+class ConnectionEvents(object):
+    """Events of the players, set when their connection changes (long polling)"""
+
+    # Time in seconds between two reads of the database by a request waiting for a connection,
+    # None if the events are set for all the connection changes
+    poll_interval = None
+
+    def __init__(self):
+        # Events set when the connection of a player changes: {player_id: Event}
+        self.events = {}
+        self.events_lock = Lock()
+
+    def event(self, player_id):
+        """Returns the event set when the connection of the player changes"""
+        with self.events_lock:
+            return self.events.setdefault(player_id, Event())
+
+    def _notify(self, *player_ids):
+        """Wakes up the requests waiting for the connection of the players"""
+        with self.events_lock:
+            for player_id in player_ids:
+                event = self.events.get(player_id)
+                if event is not None:
+                    event.set()
+
+    def _forget(self, player_id):
+        """Removes the event of a disconnected player"""
+        with self.events_lock:
+            self.events.pop(player_id, None)
+
+
+class Matchmaker(ConnectionEvents):
+    """Keeps the players waiting for connection and connects them by pair"""
+
+    def __init__(self, locks=None):
+        ConnectionEvents.__init__(self)
+        # Waiting players by bucket: {(session_nr, pair): OrderedDict(player_id -> connection_id)}
+        self.buckets = {}
+        # Bucket of each waiting player: {player_id: (session_nr, pair)}
+        self.waiting = {}
+        # Locks protecting the queue and the connections of each bucket
+        self.locks = locks if locks is not None else BucketLocks()
+        # The queues are filled from the database on first use
+        self.loaded = False
+        self.load_lock = Lock()
+
+    def load(self):
+        """Fills the queues with the connections waiting in the database (ex. after a server restart)"""
+        with self.load_lock:
+            if self.loaded:
+                return
+            q = db_session.query(Connection.id, Player.id, Player.session_nr, Player.pair).join(Connection.players).filter(Connection.status==0).order_by(Connection.id)
+            for (conn_id, player_id, session_nr, pair) in q.all():
+                self._enqueue((session_nr, pair), player_id, conn_id)
+            self.loaded = True
+
+    def _enqueue(self, bucket, player_id, conn_id):
+        """Adds a player at the end of the queue of his bucket"""
+        self.buckets.setdefault(bucket, OrderedDict())[player_id] = conn_id
+        self.waiting[player_id] = bucket
+
+    def _dequeue(self, player_id):
+        """Removes a player from the queue of his bucket, if he is waiting"""
+        bucket = self.waiting.pop(player_id, None)
+        if bucket is not None:
+            queue = self.buckets[bucket]
+            queue.pop(player_id, None)
+            if not queue:
+                del self.buckets[bucket]
+
+    def _match(self, bucket, player_id, conn):
+        """
+        Connects a player with the first player waiting in his bucket, or queues him if nobody is waiting
+        The pending changes of the session (ex. the new connection of the player) are committed in the same transaction
+        Must be called with the lock of the bucket acquired
+        """
+        queue = self.buckets.get(bucket)
+        conn_with = None
+        while queue:
+            other_id, other_conn_id = next(iter(queue.items()))
+            conn_with = db_session.query(Connection).get(other_conn_id)
+            if conn_with is not None and conn_with.status == 0:
+                break
+            # The other player has been disconnected in the meantime
+            conn_with = None
+            self._dequeue(other_id)
+            queue = self.buckets.get(bucket)
+
+        if conn_with is not None:
+            # We connect the 2 players and assign the roles
+            conn.status = 1
+            conn.connected_player_id = other_id
+            conn.role = 0
+            conn_with.status = 1
+            conn_with.connected_player_id = player_id
+            conn_with.role = 1
+        try:
+            db_session.commit()
+        except:
+            # Nothing changed, the other player keeps his place in the queue
+            db_session.rollback()
+            raise
+
+        if conn_with is not None:
+            self._dequeue(other_id)
+            self._notify(player_id, other_id)
+        else:
+            # No other player is available, the player waits in the queue
+            self._enqueue(bucket, player_id, conn.id)
+        return conn_with
+
+    def connect(self, player, conn):
+        """
+        Makes a player available for connection, conn being his new connection (not committed yet)
+        If a player of the same bucket is waiting, both players are connected in the same transaction
+        Returns the connection of the connected player, or None if the player has been queued
+        """
+        self.load()
+        bucket = (player.session_nr, player.pair)
+        with self.locks[bucket]:
+            db_session.add(conn)
+            db_session.flush()
+            return self._match(bucket, player.id, conn)
+
+    def disconnect(self, player):
+        """
+        Disconnects a player, his key can be used again
+        If the player was connected, the other player (whose connection is back to status 0) is available again
+        Returns False if the player was not available for connection
+        """
+        bucket = (player.session_nr, player.pair)
+        with self.locks[bucket]:
+            conn = player.connection
+            player.in_use = 0
+            connected_player_conn = None
+            if conn is not None:
+                # We disconnect the player and the connected player
+                db_session.delete(conn)
+                connected_player_conn = player.connection_other
+                if connected_player_conn is not None:
+                    connected_player_conn.connected_player_id = None
+                    connected_player_conn.role = None
+                    connected_player_conn.status = 0
+            db_session.commit()
+
+            self._dequeue(player.id)
+            if connected_player_conn is not None and self.loaded:
+                self._dequeue(connected_player_conn.player_id)
+                self._match(bucket, connected_player_conn.player_id, connected_player_conn)
+        if connected_player_conn is not None:
+            self._notify(connected_player_conn.player_id)
+        self._notify(player.id)
+        self._forget(player.id)
+        return conn is not None
+
+
+class DatabaseMatchmaker(ConnectionEvents):
+    """Connects the players by pair using only the database, for several server processes"""
+
+    poll_interval = 0.5
+
+    def _claim(self, conn_id, player_id, role):
+        """Connects a waiting connection with player_id, returns False if it is not waiting anymore"""
+        claimed = db_session.query(Connection).filter(Connection.id == conn_id, Connection.status == 0).update(
+            {"status": 1, "connected_player_id": player_id, "role": role}, synchronize_session=False)
+        return claimed == 1
+
+    def _release(self, conn_id):
+        """Puts back a connection claimed in the current transaction"""
+        db_session.query(Connection).filter(Connection.id == conn_id).update(
+            {"status": 0, "connected_player_id": None, "role": None}, synchronize_session=False)
+
+    def _match(self, player_id, session_nr, pair, conn_id):
+        """
+        Connects a player with the first player waiting in his bucket, in the current transaction which is committed
+        Returns the connection of the connected player, or None if the player waits
+        """
+        q = db_session.query(Connection.id, Connection.player_id).join(Player, Connection.player_id == Player.id).filter(
+            Player.session_nr == session_nr, Player.pair == pair, Connection.status == 0, Connection.id != conn_id)
+        for (other_conn_id, other_id) in q.order_by(Connection.id).limit(MAX_CLAIMS).all():
+            # Both connections must still be waiting, they are claimed in the order of their ids
+            # so that two transactions claiming the same connections do not wait for each other
+            claims = sorted([(conn_id, other_id, 0), (other_conn_id, player_id, 1)])
+            if not self._claim(*claims[0]):
+                if claims[0][0] == conn_id:
+                    # The player has been connected by another process
+                    break
+                continue
+            if not self._claim(*claims[1]):
+                self._release(claims[0][0])
+                if claims[1][0] == conn_id:
+                    break
+                continue
+            db_session.commit()
+            self._notify(player_id, other_id)
+            return db_session.query(Connection).get(other_conn_id)
+        db_session.commit()
+        return None
+
+    def rematch(self, player_id):
+        """
+        Tries again to connect a waiting player, called at each poll of /connected_with/
+        Two players of a bucket connecting at the same time in different processes may each not see the connection
+        of the other (MVCC databases), both would then wait forever. Returns True if the player is connected
+        """
+        waiting = db_session.query(Connection.id, Player.session_nr, Player.pair).join(Player, Connection.player_id == Player.id).filter(
+            Connection.player_id == player_id, Connection.status == 0).first()
+        if waiting is None:
+            db_session.rollback()
+            return False
+        return self._match(player_id, waiting[1], waiting[2], waiting[0]) is not None
+
+    def connect(self, player, conn):
+        """
+        Makes a player available for connection, conn being his new connection (not committed yet)
+        If a player of the same bucket is waiting, both players are connected in the same transaction
+        Returns the connection of the connected player, or None if the player waits
+        """
+        db_session.add(conn)
+        db_session.flush()
+        return self._match(player.id, player.session_nr, player.pair, conn.id)
+
+    def disconnect(self, player):
+        """
+        Disconnects a player, his key can be used again
+        If the player was connected, the other player is available again and connected with a waiting player if any
+        Returns False if the player was not available for connection
+        """
+        db_session.query(Player).filter(Player.id == player.id).update({"in_use": 0}, synchronize_session=False)
+        deleted = db_session.query(Connection).filter(Connection.player_id == player.id).delete(synchronize_session=False)
+        other = db_session.query(Connection.id, Connection.player_id).filter(Connection.connected_player_id == player.id).first()
+        if other is not None:
+            # Only if the other player was not disconnected in the meantime
+            released = db_session.query(Connection).filter(Connection.id == other[0], Connection.connected_player_id == player.id).update(
+                {"status": 0, "connected_player_id": None, "role": None}, synchronize_session=False)
+            if not released:
+                other = None
+        db_session.commit()
+        if other is not None:
+            self._match(other[1], player.session_nr, player.pair, other[0])
+            self._notify(other[1])
+        self._notify(player.id)
+        self._forget(player.id)
+        return deleted == 1
@@ -0,0 +1,251 @@
+"""
+Metrics of the server, exposed at /metrics in the Prometheus text format
+
+    * idp_request_duration_seconds{route}: latency of the requests by route (endpoint of the view),
+      for streamed responses (CSV export) until the response starts
+    * idp_requests_total{route, status}: number of requests by route and status code
+    * idp_request_sql_statements{route}, idp_request_sql_seconds{route}: SQL statements executed by a request and their time
+    * idp_sql_statements_total, idp_sql_seconds_total: all the SQL statements, also the ones of the background threads
+    * idp_lock_wait_seconds{lock}, idp_lock_hold_seconds{lock}: time waiting for and holding the locks of the buckets
+      of the matchmaker (connections: connection and disconnection), only when the server runs in one process
+    * idp_ingest_payload_bytes{route}: size of the uploaded statistics (Content-Length, the requests without it are not counted)
+    * idp_unknown_stat_keys_total{key}: Minecraft statistics received but not stored, by key (at most 1000 keys,
+      the other ones under key="other", see ingest.StatKeyResolver)
+
+The histograms have fixed buckets: an observation is a bisect and a few additions under a lock,
+the metrics can be left on in production. With several processes (see serve.py), each process has its own
+metrics: /metrics gives the ones of the process answering the request.
+"""
+
+import time
+from bisect import bisect_left
+from threading import Lock, RLock, local
+
+from flask import request
+from sqlalchemy import event
+
+
+# Upper bounds of the buckets of the histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOCK_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Metrics in the order of the /metrics page
+registry = []
+
+# False until init_app is called, nothing is recorded
+enabled = False
+
+clock = time.perf_counter
+
+
+def format_labels(names, values, extra=()):
+    """Formats the labels of a sample: {name="value",...}"""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join("{}=\"{}\"".format(name, escape(value)) for (name, value) in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """Metric with one series per values of its labels"""
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # {label values: series}
+        self.series = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def render(self):
+        """Returns the lines of the metric in the Prometheus text format"""
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        with self.lock:
+            series = sorted((values, self.copy(s)) for (values, s) in self.series.items())
+        for (values, s) in series:
+            lines.extend(self.samples(values, s))
+        return lines
+
+
+class Counter(Metric):
+    """Counter, each series is a number"""
+
+    type = "counter"
+
+    def inc(self, labels=(), value=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + value
+
+    def copy(self, s):
+        return s
+
+    def samples(self, values, s):
+        yield "{}{} {}".format(self.name, format_labels(self.labels, values), format_value(s))
+
+
+class Histogram(Metric):
+    """Histogram, each series is [count of each bucket (not cumulated), sum of the values]"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0]
+            s[0][i] += 1
+            s[1] += value
+
+    def copy(self, s):
+        return [list(s[0]), s[1]]
+
+    def samples(self, values, s):
+        total = 0
+        for (bound, count) in zip(self.buckets + (float("inf"),), s[0]):
+            total += count
+            yield "{}_bucket{} {}".format(self.name, format_labels(self.labels, values, [("le", format_value(bound))]), total)
+        yield "{}_sum{} {}".format(self.name, format_labels(self.labels, values), format_value(s[1]))
+        yield "{}_count{} {}".format(self.name, format_labels(self.labels, values), total)
+
+
+request_duration = Histogram("idp_request_duration_seconds", "Latency of the requests by route", ("route",))
+requests_total = Counter("idp_requests_total", "Number of requests by route and status code", ("route", "status"))
+request_sql_statements = Histogram("idp_request_sql_statements", "SQL statements executed by a request", ("route",), COUNT_BUCKETS)
+request_sql_seconds = Histogram("idp_request_sql_seconds", "Time of the SQL statements of a request", ("route",))
+sql_statements = Counter("idp_sql_statements_total", "SQL statements executed")
+sql_seconds = Counter("idp_sql_seconds_total", "Time of the SQL statements")
+lock_wait = Histogram("idp_lock_wait_seconds", "Time waiting for a lock", ("lock",), LOCK_BUCKETS)
+lock_hold = Histogram("idp_lock_hold_seconds", "Time a lock is held", ("lock",), LOCK_BUCKETS)
+ingest_payload = Histogram("idp_ingest_payload_bytes", "Size of the uploaded statistics", ("route",), SIZE_BUCKETS)
+unknown_stat_keys = Counter("idp_unknown_stat_keys_total", "Minecraft statistics received but not stored, by key", ("key",))
+
+
+def render():
+    """Returns the /metrics page"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+#######################
+# Requests and locks  #
+#######################
+
+# State of the request handled by the thread
+state = local()
+
+
+def start_request():
+    if enabled:
+        state.start = clock()
+        state.statements = 0
+        state.sql_time = 0.0
+        state.active = True
+
+
+def end_request(response):
+    if enabled and getattr(state, "active", False):
+        state.active = False
+        route = (request.endpoint or "unknown",)
+        request_duration.observe(clock() - state.start, route)
+        requests_total.inc((route[0], response.status_code))
+        request_sql_statements.observe(state.statements, route)
+        request_sql_seconds.observe(state.sql_time, route)
+    return response
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # The statements of a thread are executed one after the other
+    state.statement_start = clock()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not enabled:
+        return
+    duration = clock() - state.statement_start
+    sql_statements.inc()
+    sql_seconds.inc(value=duration)
+    if getattr(state, "active", False):
+        state.statements += 1
+        state.sql_time += duration
+
+
+def listen(engine):
+    """Records the SQL statements executed on engine"""
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def observe_payload(route):
+    """Records the size of the statistics uploaded by the current request (not recorded without Content-Length)"""
+    # The body is not read here: a body without Content-Length (chunked) is read with the size limit of the route
+    if enabled and request.content_length is not None:
+        ingest_payload.observe(request.content_length, (route,))
+
+
+class TimedLock(object):
+    """Reentrant lock recording the time waiting for it and holding it, for the outermost acquisition only"""
+
+    def __init__(self, name):
+        self.lock = RLock()
+        self.labels = (name,)
+        # Only changed by the thread holding the lock
+        self.depth = 0
+        self.acquired = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = clock()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.depth += 1
+        if self.depth == 1:
+            self.acquired = clock()
+            lock_wait.observe(self.acquired - start, self.labels)
+        return True
+
+    def release(self):
+        if self.depth == 1:
+            lock_hold.observe(clock() - self.acquired, self.labels)
+        self.depth -= 1
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def lock_factory(name):
+    """Returns the function creating the locks of a BucketLocks (see matchmaking.py), timed if the metrics are enabled"""
+    if enabled:
+        return lambda: TimedLock(name)
+    return RLock
+
+
+def init_app(app, engine):
+    """Records the metrics of the requests of app and of the SQL statements of engine"""
+    global enabled
+    enabled = True
+    app.before_request(start_request)
+    app.after_request(end_request)
+    listen(engine)
@@ -0,0 +1,95 @@
+"""
+Script to upgrade the structure of an existing database (created by setup_db.py) to the current models
+No data is removed and the script can be run several times: only what is missing is added
+
+Unique indexes cannot be created while the table contains duplicates, in this case a non unique index
+is created instead and the duplicates are listed, the unique index is created once they are removed
+
+The scores of the players, now updated when the statistics are added, are recomputed
+
+The trajectories stored as JSON in stats.position_over_time are moved to the trajectories table
+"""
+import json
+
+from sqlalchemy import inspect, select, func
+from database import Base, engine, db_session
+from models import *
+import ingest
+import trajectory
+
+
+# Number of stats migrated in one transaction
+MIGRATION_CHUNK_SIZE = 500
+
+
+def duplicates(index):
+    """Returns the values appearing several times in the columns of a unique index"""
+    columns = list(index.columns)
+    q = select(columns + [func.count()]).group_by(*columns).having(func.count() > 1)
+    return engine.execute(q).fetchall()
+
+
+def create_indexes():
+    """Creates the indexes of the models missing in the database"""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = dict((index["name"], index) for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing:
+                if not index.unique or existing[index.name]["unique"]:
+                    continue
+                # A non unique index was created because of duplicates, we try again
+                index.drop(bind=engine)
+
+            if index.unique:
+                rows = duplicates(index)
+                if rows:
+                    print("[ {}: {} duplicates in {}, non unique index created ]".format(index.name, len(rows), table.name))
+                    for row in rows[:10]:
+                        print("    {} ({} rows)".format(", ".join("{}={}".format(c.name, v) for (c, v) in zip(index.columns, row)), row[-1]))
+                    index.unique = False
+                    index.create(bind=engine)
+                    index.unique = True
+                    continue
+            index.create(bind=engine)
+            print("[ {} created ]".format(index.name))
+
+
+def migrate_trajectories():
+    """Moves the trajectories stored as JSON in stats.position_over_time to the trajectories table, returns their number"""
+    stats = Stat.__table__
+    migrated = 0
+    last_id = 0
+    while True:
+        q = select([stats.c.id, stats.c.position_over_time]).where(stats.c.id > last_id).where(stats.c.position_over_time != None)
+        rows = db_session.execute(q.order_by(stats.c.id).limit(MIGRATION_CHUNK_SIZE)).fetchall()
+        if not rows:
+            return migrated
+        last_id = rows[-1][0]
+        trajectories = {}
+        for (stat_id, position_over_time) in rows:
+            try:
+                points = trajectory.parse(json.loads(position_over_time))
+            except ValueError:
+                points = None
+            if points is not None:
+                trajectories[stat_id] = trajectory.encode(*points)
+        ingest.save_trajectories(trajectories)
+        db_session.bulk_update_mappings(Stat, [{"id": stat_id, "position_over_time": None} for stat_id in trajectories])
+        db_session.commit()
+        migrated += len(trajectories)
+
+
+
+if __name__ == "__main__":
+    # Missing tables are created with their indexes
+    Base.metadata.create_all(bind=engine)
+    create_indexes()
+    print("[ scores of {} players recomputed ]".format(ingest.update_players_score()))
+    db_session.commit()
+    migrated = migrate_trajectories()
+    print("[ {} trajectories moved to the trajectories table ]".format(migrated))
+    if migrated and engine.name == "sqlite":
+        # The space freed in the stats table is given back
+        engine.execute("VACUUM")
+    print("Database is up to date.")
@@ -3,9 +3,9 @@ Models for SQLAlchemy ORM
 Please see http://docs.sqlalchemy.org/en/rel_1_0/orm/tutorial.html for more details on SQLAlchemy
 """
 
-from sqlalchemy import Column, Integer, Float, String, Boolean, DateTime, Text
-from sqlalchemy import ForeignKey
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy import Column, Integer, Float, String, Boolean, DateTime, Text, LargeBinary
+from sqlalchemy import ForeignKey, Index
+from sqlalchemy.orm import relationship, backref, deferred
 from datetime import datetime
 from database import Base
 
@@ -21,6 +21,10 @@ class Session(Base):
     # Reference to the tests of the session
     tests = relationship("Test", order_by="Test.timestamp", backref="session", cascade="all, delete, delete-orphan") 
 
+    __table_args__ = (
+        Index("ix_sessions_session_uuid", "session_uuid", unique=True),
+    )
+
     def __init__(self, session_uuid):
         self.session_uuid = session_uuid
         self.timestamp = datetime.now()
@@ -48,6 +52,10 @@ class Test(Base):
     # Reference to the items of the test
     items = relationship("Item", order_by="Item.player_id", backref="test", cascade="all, delete, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_tests_session_id_world_round", "session_id", "world", "round", unique=True),
+    )
+
     def __init__(self, session_id, world, round):
         self.session_id = session_id
         self.world = world
@@ -75,7 +83,9 @@ class Stat(Base):
     player_id = Column(Integer, ForeignKey("players.id")) # ID of the player
 
     checkpoints = Column(Text) # Checkpoints the player activated, generated by the Minecraft mod
-    position_over_time = Column(Text) # Position over time of the player, generated by the Minecraft mod
+    # Position over time of the player, generated by the Minecraft mod, when it is not a trajectory (see Trajectory)
+    # Loaded only when accessed
+    position_over_time = deferred(Column(Text))
     solution = Column(String(100)) # Solution chosen by the player, generated by the Minecraft mod
 
     score = Column(Integer, default=0) # Score earned by the player on the round
@@ -105,6 +115,10 @@ class Stat(Base):
     drop = Column(Integer, default=0)
     number_biomes = Column(Integer, default=0)
 
+    __table_args__ = (
+        Index("ix_stats_test_id_player_id", "test_id", "player_id", unique=True),
+    )
+
     def __init__(self, test_id, player_id):
         self.test_id = test_id
         self.player_id = player_id
@@ -119,6 +133,29 @@ class Stat(Base):
                 s += "\n            [ {} : {} ]".format(label, getattr(self, name))
         return s
         
+class Trajectory(Base):
+    """Trajectory of a player (position_over_time of his stat), compressed by trajectory.py"""
+    __tablename__ = "trajectories"
+
+    id = Column(Integer, primary_key=True)
+    stat_id = Column(Integer, ForeignKey("stats.id"), nullable=False) # ID of the stat
+    number_points = Column(Integer) # number of points of the trajectory
+    start_time = Column(Float) # time of the first point
+    end_time = Column(Float) # time of the last point
+    data = Column(LargeBinary) # times and positions, see trajectory.py
+
+    __table_args__ = (
+        Index("ix_trajectories_stat_id", "stat_id", unique=True),
+    )
+
+    def __init__(self, stat_id):
+        self.stat_id = stat_id
+
+    def __repr__(self):
+        s = "Trajectory of stat {}: {} points from {} to {}".format(self.stat_id, self.number_points, self.start_time, self.end_time)
+        return s
+
+
 class Item(Base):
     """Base model for all items stored in DB"""
     __tablename__ = "items"
@@ -135,12 +172,18 @@ class Item(Base):
     craft_item = Column(Integer, default=0)
     break_item = Column(Integer, default=0)
 
+    __table_args__ = (
+        Index("ix_items_test_id_player_id_item_item", "test_id", "player_id", "item_item", unique=True),
+    )
+
     def __init__(self, test_id, player_id):
         self.test_id = test_id
         self.player_id = player_id
     
     def __repr__(self):
-        s = "Item #{} ({}): used {}, mined {}, crafted {}, broken {}".format(self.item_item, self.item.name, self.use_item, self.mine_block, self.craft_item, self.break_item)
+        # The name is read from the catalog of the items (catalog imports the models)
+        from catalog import name
+        s = "Item #{} ({}): used {}, mined {}, crafted {}, broken {}".format(self.item_item, name(self.item_item), self.use_item, self.mine_block, self.craft_item, self.break_item)
         return s
     
 
@@ -155,6 +198,10 @@ class Connection(Base):
     role = Column(Integer) # role of the player in the connection (0 or 1)
     
     connected_player = relationship("Player", foreign_keys=[connected_player_id])
+
+    __table_args__ = (
+        Index("ix_connections_status", "status"),
+    )
     
     def __init__(self, player_id):
         self.player_id = player_id 
@@ -197,6 +244,10 @@ class Player(Base):
     # Reference to the connected player connection
     connection_other = relationship("Connection", foreign_keys=[Connection.connected_player_id], uselist=False, cascade="all, delete, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_players_session_nr_pair", "session_nr", "pair"),
+    )
+
     def __init__(self, key, name, session_nr, pair, condition=0, player_condition=0):
         self.key = key
         self.name = name
@@ -0,0 +1,153 @@
+"""
+Keyset pagination, sorting and filtering of the listings of the web interface (/view/*, /players/<session_nr>)
+
+Parameters of the query string:
+    * sort: column to sort by, prefixed with - for the descending order (default: id)
+    * limit: number of rows per page (default 100, at most 1000)
+    * after: id of the last row of the previous page, given by the link to the next page
+    * <column>=<value>: only the rows with this value, <column>__min=<value> and <column>__max=<value> for a range
+    * format=json: the page is sent as JSON {"status", "text", "data": rows, "next": link to the next page}
+
+The rows are sorted by (column, id) and a page starts right after the last row of the previous page:
+reading a page does not depend on the number of pages before it. NULL values come first in the ascending order.
+"""
+
+from datetime import datetime
+
+from flask import request, render_template, url_for, jsonify
+from sqlalchemy import and_, or_, Integer, Float, Boolean, DateTime
+
+from database import db_session
+
+
+# Number of rows per page
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+# Parameters of the query string which are not filters
+PARAMETERS = ("sort", "limit", "after", "format")
+
+DATETIME_FORMATS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d")
+
+
+class Page(object):
+    """Rows of a page of a listing"""
+
+    def __init__(self, rows, sortable, sort, next_args):
+        self.rows = rows
+        # Columns the rows can be sorted by
+        self.sortable = sortable
+        # Sort parameter (column, prefixed with - for the descending order)
+        self.sort = sort
+        # Query string of the next page, None for the last page
+        self.next_args = next_args
+
+
+def coerce(column, value):
+    """Converts a value of the query string to the type of the column, raises ValueError if it is not valid"""
+    if isinstance(column.type, Boolean):
+        return value.lower() in ("1", "true", "yes")
+    if isinstance(column.type, Integer):
+        return int(value)
+    if isinstance(column.type, Float):
+        return float(value)
+    if isinstance(column.type, DateTime):
+        for date_format in DATETIME_FORMATS:
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        raise ValueError("invalid date {}".format(value))
+    return value
+
+
+def after_clause(column, id_column, value, row_id, descending):
+    """Condition selecting the rows after the row (value, row_id) in the order (column, id)"""
+    if column is id_column:
+        return id_column < row_id if descending else id_column > row_id
+    if not descending:
+        if value is None:
+            return or_(and_(column.is_(None), id_column > row_id), column.isnot(None))
+        return or_(column > value, and_(column == value, id_column > row_id))
+    if value is None:
+        return and_(column.is_(None), id_column < row_id)
+    return or_(column < value, and_(column == value, id_column < row_id), column.is_(None))
+
+
+def paginate(query, model, args):
+    """
+    Filters, sorts and limits a query of model according to the query string args
+    Returns a Page, raises ValueError if a parameter is not valid
+    """
+    table = model.__table__
+    id_column = table.c.id
+
+    # Filters
+    for (name, value) in args.items():
+        if name in PARAMETERS:
+            continue
+        (column_name, operator) = name.rsplit("__", 1) if "__" in name else (name, None)
+        if column_name not in table.c or operator not in (None, "min", "max"):
+            raise ValueError("unknown parameter {}".format(name))
+        column = table.c[column_name]
+        try:
+            value = coerce(column, value)
+        except ValueError:
+            raise ValueError("invalid value for {}: {}".format(name, value))
+        if operator is None:
+            query = query.filter(column == value)
+        elif operator == "min":
+            query = query.filter(column >= value)
+        else:
+            query = query.filter(column <= value)
+
+    # Sort
+    sort = args.get("sort", "id")
+    descending = sort.startswith("-")
+    if sort.lstrip("-") not in table.c:
+        raise ValueError("unknown column {}".format(sort.lstrip("-")))
+    column = table.c[sort.lstrip("-")]
+
+    limit = args.get("limit", DEFAULT_LIMIT, type=int)
+    limit = min(max(limit, 1), MAX_LIMIT)
+
+    after = args.get("after", type=int)
+    if after is not None:
+        # Value of the sort column for the last row of the previous page
+        value = db_session.query(column).filter(id_column == after).scalar()
+        query = query.filter(after_clause(column, id_column, value, after, descending))
+
+    if column is id_column:
+        order = [id_column.desc() if descending else id_column]
+    elif descending:
+        order = [column.isnot(None).desc(), column.desc(), id_column.desc()]
+    else:
+        order = [column.isnot(None), column, id_column]
+
+    # One more row is read to know if there is a next page
+    rows = query.order_by(*order).limit(limit + 1).all()
+    next_args = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_args = dict(args.items())
+        next_args["after"] = rows[-1].id
+    return Page(rows, table.c.keys(), sort, next_args)
+
+
+def render_page(page, columns, **kwargs):
+    """Sends a page with the view_data.djhtml template, or as JSON if format=json is in the query string"""
+    next_url = None
+    if page.next_args is not None:
+        next_url = url_for(request.endpoint, **dict(request.view_args, **page.next_args))
+    if request.args.get("format") == "json":
+        data = [dict((column, getattr(row, column)) for column in columns) for row in page.rows]
+        return jsonify(status=1, text="{} rows".format(len(data)), data=data, next=next_url)
+
+    # Links sorting by each column (descending order if the page is already sorted by the column), from the first page
+    args = dict((name, value) for (name, value) in request.args.items() if name != "after")
+    sort_urls = {}
+    for column in columns:
+        if column in page.sortable:
+            args["sort"] = "-" + column if page.sort == column else column
+            sort_urls[column] = url_for(request.endpoint, **dict(request.view_args, **args))
+    return render_template("view_data.djhtml", columns=columns, data=page.rows, sort=page.sort, sort_urls=sort_urls, next=next_url, **kwargs)
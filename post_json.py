@@ -1,33 +1,336 @@
 """
-Simple script to simulate statistics sending of Minecraft mod
+Script to simulate the clients and the Minecraft mod
+
+Without arguments, sends one randomized upload of statistics (as the Minecraft mod does) and prints the answer:
+    python post_json.py
+
+The load command simulates concurrent clients running the whole lifecycle of client.py:
+    /identification/ -> /connect/ -> /connected_with/ (long polling) -> /upload_json/ (one per round) -> /disconnect/
+It reports the throughput, the latency percentiles of each endpoint, the time to pair and the errors,
+and saves them as JSON so that runs can be compared (compare command):
+    python post_json.py load --clients 40 --rounds 3 --output results.json
+    python post_json.py compare before.json after.json
+The player keys are read from a players CSV export (--keys), otherwise a new session of players is created
+(JSON API /players/create/sessions/).
+The uploads can be compressed with gzip (--gzip) and sent in chunks of a given size in KB to /upload_json/chunks/
+(--chunked), to compare the bytes sent and the latency of the uploads:
+    python post_json.py --gzip --chunked 256 load --clients 40 --points 100000 --output gzip.json
 """
-import requests
+import csv
+import gzip
 import json
-from random import randint
+import time
+import uuid
+import argparse
+from random import randint, uniform
+from threading import Thread, Lock
+
+import requests
+
 from utils import read_settings
 
 settings = read_settings()
 
-url = "http://{}:{}/upload_json/".format(settings["server"]["address"], settings["server"]["port"])
+server = "http://{}:{}/".format(settings["server"]["address"], settings["server"]["port"])
 
 headers = {"Content-type": "application/json", "Accept": "text/plain"}
 
-f = open("stats.json", 'r')
-stats = json.loads(f.read())
-
-data = {
-    "session_id": 1234,
-    "world": "Volcano_TEST",
-    "round": randint(1,10),
-    "player": randint(1,20),
-    "checkpoints": "test",
-    "position_over_time": "test",
-    "solution": "solution 1",
-    "score": 100,
-    "stats": json.dumps(stats)
-}
-
-r = requests.post(url, data=json.dumps(data), headers=headers)
-
-print(r.status_code)
-print(r.text)
+# Compression level of gzip, the default of gzip.compress (9) is ten times slower for a few % smaller uploads
+COMPRESS_LEVEL = 6
+
+# Attempts to send a chunk of an upload, the upload is resumed from the bytes received by the server
+CHUNK_ATTEMPTS = 3
+
+
+def make_payload(stats, session_id, player, round_number, score, points=0):
+    """Creates statistics like the ones sent by the Minecraft mod, points: number of points of the trajectory"""
+    position_over_time = "test"
+    if points:
+        (x, z) = (0.0, 0.0)
+        position_over_time = {}
+        for i in range(points):
+            x = round(x + uniform(-1, 1), 2)
+            z = round(z + uniform(-1, 1), 2)
+            position_over_time[str(50 * i)] = json.dumps({"x": x, "y": 64, "z": z})
+    return {
+        "session_id": session_id,
+        "world": "Volcano_TEST",
+        "round": round_number,
+        "player": player,
+        "checkpoints": "test",
+        "position_over_time": position_over_time,
+        "solution": "solution 1",
+        "score": score,
+        "stats": json.dumps(dict((k, v + randint(0, 10) if isinstance(v, int) else v) for (k, v) in stats.items()))
+    }
+
+
+def read_stats():
+    with open("stats.json", "r") as f:
+        return json.loads(f.read())
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of a list of values (nearest rank)"""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class Recorder(object):
+    """Latencies and errors of the requests, by endpoint"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.bytes_sent = {}
+        self.errors = {}
+        self.error_messages = {}
+        self.time_to_pair = []
+        self.lifecycles = 0
+        self.lock = Lock()
+
+    def request(self, session, endpoint, method, url, **kwargs):
+        """Sends a request and records its latency, returns the JSON answer or None if the request failed"""
+        start = time.time()
+        error = None
+        d = None
+        try:
+            r = session.request(method, server + url, **kwargs)
+            if r.status_code >= 400:
+                error = "HTTP {}".format(r.status_code)
+            else:
+                try:
+                    d = r.json()
+                except ValueError:
+                    # /upload_json/ answers with text
+                    d = {"status": 1, "text": r.text}
+                if d.get("status") == -1:
+                    error = d.get("text", "status -1")
+        except Exception as e:
+            error = type(e).__name__
+        latency = time.time() - start
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            if isinstance(kwargs.get("data"), (bytes, str)):
+                self.bytes_sent[endpoint] = self.bytes_sent.get(endpoint, 0) + len(kwargs["data"])
+            if error is not None:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+                self.error_messages[error] = self.error_messages.get(error, 0) + 1
+        return None if error is not None else d
+
+    def summary(self, duration):
+        """Returns the results of the run as a dictionary"""
+        def statistics(values):
+            if not values:
+                return {"count": 0}
+            return {
+                "count": len(values),
+                "mean_ms": 1000 * sum(values) / len(values),
+                "p50_ms": 1000 * percentile(values, 50),
+                "p95_ms": 1000 * percentile(values, 95),
+                "p99_ms": 1000 * percentile(values, 99),
+                "max_ms": 1000 * max(values),
+            }
+        requests_count = sum(len(values) for values in self.latencies.values())
+        endpoints = {}
+        for (endpoint, values) in self.latencies.items():
+            endpoints[endpoint] = dict(statistics(values), errors=self.errors.get(endpoint, 0), bytes_sent=self.bytes_sent.get(endpoint, 0))
+        return {
+            "duration_s": duration,
+            "requests": requests_count,
+            "throughput_rps": requests_count / duration if duration else 0,
+            "lifecycles": self.lifecycles,
+            "lifecycles_per_s": self.lifecycles / duration if duration else 0,
+            "errors": sum(self.errors.values()),
+            "error_messages": self.error_messages,
+            "endpoints": endpoints,
+            "time_to_pair": statistics(self.time_to_pair),
+        }
+
+
+def run_client(key, args, stats, run_id, recorder, delay):
+    """Lifecycle of one client: identification, connection, uploads of the rounds, disconnection"""
+    time.sleep(delay)
+    session = requests.Session()
+    long_poll = settings["server"].get("long_poll", 25)
+
+    d = recorder.request(session, "identification", "POST", "identification/", data={"key": key}, timeout=args.timeout)
+    if d is None or d["status"] != 1:
+        return
+    player_id = d["data"]["player_id"]
+    try:
+        start = time.time()
+        d = recorder.request(session, "connect", "POST", "connect/", data={"id": player_id}, timeout=args.timeout)
+        if d is None:
+            return
+        connected = False
+        while not connected and time.time() - start < args.pair_timeout:
+            d = recorder.request(session, "connected_with", "GET", "connected_with/{}".format(player_id), params={"wait": long_poll}, timeout=long_poll + args.timeout)
+            connected = d is not None and d["status"] == 1
+        if not connected:
+            with recorder.lock:
+                recorder.errors["pairing"] = recorder.errors.get("pairing", 0) + 1
+                recorder.error_messages["not paired"] = recorder.error_messages.get("not paired", 0) + 1
+            return
+        with recorder.lock:
+            recorder.time_to_pair.append(time.time() - start)
+
+        for round_number in range(1, args.rounds + 1):
+            payload = make_payload(stats, run_id, player_id, round_number, randint(0, 100), args.points)
+            send_upload(recorder, session, payload, args)
+    finally:
+        recorder.request(session, "disconnect", "GET", "disconnect/{}".format(player_id), timeout=args.timeout)
+    with recorder.lock:
+        recorder.lifecycles += 1
+
+
+def encode_upload(payload, compress=False):
+    """Returns the body and the headers of an upload, compressed with gzip if compress"""
+    body = json.dumps(payload).encode("utf-8")
+    if not compress:
+        return body, headers
+    return gzip.compress(body, COMPRESS_LEVEL), dict(headers, **{"Content-Encoding": "gzip"})
+
+
+def send_upload(recorder, session, payload, args):
+    """Sends an upload in one request or in chunks (args.chunked KB), returns the answer or None if it failed"""
+    (body, upload_headers) = encode_upload(payload, args.gzip)
+    if not args.chunked:
+        return recorder.request(session, "upload_json", "POST", "upload_json/", data=body, headers=upload_headers, timeout=args.timeout)
+
+    params = {"session_id": payload["session_id"], "world": payload["world"], "round": payload["round"], "player": payload["player"]}
+    size = args.chunked * 1024
+    # Offset of the last chunk, sent again if the payload was received but not added
+    last = max(0, (len(body) - 1) // size * size)
+    offset = 0
+    failures = 0
+    while True:
+        chunk = body[offset:offset + size]
+        d = recorder.request(session, "upload_chunk", "PUT", "upload_json/chunks/", params=dict(params, offset=offset, total=len(body)),
+                             data=chunk, headers=upload_headers, timeout=args.timeout)
+        if d is None:
+            failures += 1
+            if failures >= CHUNK_ATTEMPTS:
+                return None
+            # We resume from the bytes received by the server
+            d = recorder.request(session, "upload_chunk", "GET", "upload_json/chunks/", params=params, timeout=args.timeout)
+            if d is None:
+                continue
+        if d["data"].get("complete"):
+            return d
+        offset = min(d["data"]["received"], last)
+
+
+def create_session(number_players):
+    """Creates a session of players with the JSON API, returns its number and the keys of the players"""
+    r = requests.post(server + "players/create/sessions/", data=json.dumps({"sessions": [number_players]}), headers=headers)
+    d = r.json()
+    if d["status"] != 1:
+        raise RuntimeError("The players could not be created: {}".format(d["text"]))
+    return d["data"][0]["session_nr"], d["data"][0]["keys"]
+
+
+def read_keys(f):
+    """Reads the keys of a players CSV export"""
+    return [row["key"] for row in csv.DictReader(f)]
+
+
+def load(args):
+    """Runs the load test"""
+    if args.keys:
+        with open(args.keys, "r") as f:
+            keys = read_keys(f)
+    else:
+        (session_nr, keys) = create_session(args.clients + args.clients % 2)
+        print("[ session {} created ]".format(session_nr))
+    keys = keys[:args.clients]
+    print("[ {} clients, {} rounds, server {} ]".format(len(keys), args.rounds, server))
+
+    stats = read_stats()
+    run_id = "load-{}".format(uuid.uuid4().hex[:8])
+    recorder = Recorder()
+    threads = [Thread(target=run_client, args=(key, args, stats, run_id, recorder, args.ramp * i / max(len(keys), 1))) for (i, key) in enumerate(keys)]
+    start = time.time()
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    results = recorder.summary(time.time() - start)
+    results["run"] = {"id": run_id, "server": server, "clients": len(keys), "rounds": args.rounds, "points": args.points, "ramp": args.ramp,
+                      "gzip": args.gzip, "chunked": args.chunked, "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("[ results saved to {} ]".format(args.output))
+
+
+def print_results(results):
+    print("{} requests in {:.2f} s: {:.1f} requests/s, {} lifecycles ({:.2f}/s), {} errors".format(
+        results["requests"], results["duration_s"], results["throughput_rps"], results["lifecycles"], results["lifecycles_per_s"], results["errors"]))
+    print("{:<16} {:>7} {:>7} {:>10} {:>10} {:>10} {:>10}".format("endpoint", "count", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    rows = sorted(results["endpoints"].items()) + [("time to pair", dict(results["time_to_pair"], errors=""))]
+    for (endpoint, s) in rows:
+        if s["count"]:
+            print("{:<16} {:>7} {:>7} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(endpoint, s["count"], s["errors"], s["p50_ms"], s["p95_ms"], s["p99_ms"], s["max_ms"]))
+    sent = sum(s.get("bytes_sent", 0) for (endpoint, s) in results["endpoints"].items() if endpoint.startswith("upload"))
+    print("{:.2f} MB of uploads sent".format(sent / 1024.0 / 1024.0))
+    for (message, count) in sorted(results["error_messages"].items()):
+        print("    error {}: {}".format(message, count))
+
+
+def compare(args):
+    """Compares the results of two runs"""
+    with open(args.before, "r") as f:
+        before = json.load(f)
+    with open(args.after, "r") as f:
+        after = json.load(f)
+    print("{:<16} {:<8} {:>10} {:>10} {:>8}".format("endpoint", "", "before", "after", "change"))
+    rows = [("throughput", "req/s", before["throughput_rps"], after["throughput_rps"])]
+    uploads_sent = lambda results: sum(s.get("bytes_sent", 0) for (endpoint, s) in results["endpoints"].items() if endpoint.startswith("upload")) / 1024.0 / 1024.0
+    rows.append(("uploads", "MB sent", uploads_sent(before), uploads_sent(after)))
+    for endpoint in sorted(set(before["endpoints"]) | set(after["endpoints"])) + ["time to pair"]:
+        b = before["time_to_pair"] if endpoint == "time to pair" else before["endpoints"].get(endpoint, {})
+        a = after["time_to_pair"] if endpoint == "time to pair" else after["endpoints"].get(endpoint, {})
+        for p in ("p50_ms", "p95_ms", "p99_ms"):
+            rows.append((endpoint, p, b.get(p), a.get(p)))
+    for (endpoint, name, b, a) in rows:
+        change = "{:+.0f}%".format(100.0 * (a - b) / b) if a is not None and b else ""
+        print("{:<16} {:<8} {:>10} {:>10} {:>8}".format(endpoint, name, "-" if b is None else "{:.1f}".format(b), "-" if a is None else "{:.1f}".format(a), change))
+
+
+def upload(args):
+    """Sends one randomized upload"""
+    data = make_payload(read_stats(), 1234, randint(1, 20), randint(1, 10), 100)
+    args.timeout = 30
+    recorder = Recorder()
+    d = send_upload(recorder, requests.Session(), data, args)
+    print(d["text"] if d is not None else recorder.error_messages)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulation of the clients and the Minecraft mod")
+    parser.add_argument("--server", help="root URL of the server (default: from settings.yml)")
+    parser.add_argument("--gzip", action="store_true", help="compresses the uploads with gzip")
+    parser.add_argument("--chunked", type=int, default=0, help="sends the uploads in chunks of this size in KB to /upload_json/chunks/")
+    commands = parser.add_subparsers(dest="command")
+    parser_load = commands.add_parser("load", help="load test with concurrent clients")
+    parser_load.add_argument("--clients", type=int, default=20, help="number of concurrent clients")
+    parser_load.add_argument("--rounds", type=int, default=1, help="uploads of statistics per client")
+    parser_load.add_argument("--points", type=int, default=0, help="number of points of the trajectories sent")
+    parser_load.add_argument("--ramp", type=float, default=0, help="time in seconds over which the clients start")
+    parser_load.add_argument("--keys", help="players CSV export giving the keys (default: a new session is created)")
+    parser_load.add_argument("--timeout", type=float, default=30, help="timeout of the requests in seconds")
+    parser_load.add_argument("--pair-timeout", type=float, default=120, help="maximum time in seconds to wait for the other player")
+    parser_load.add_argument("--output", help="file where the results are saved as JSON")
+    parser_compare = commands.add_parser("compare", help="compares the results of two load tests")
+    parser_compare.add_argument("before")
+    parser_compare.add_argument("after")
+    args = parser.parse_args()
+
+    if args.server:
+        server = args.server.rstrip("/") + "/"
+    if args.command == "load":
+        load(args)
+    elif args.command == "compare":
+        compare(args)
+    else:
+        upload(args)
@@ -0,0 +1,90 @@
+"""
+Creation of the sessions of players
+
+The keys are drawn by batch: distinct random keys are drawn at once, the ones already used by a player
+are found with one query and replaced (drawn again only if some were used). The players of all the sessions
+are added with one bulk insert and one commit.
+"""
+
+from random import sample
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from database import db_session
+from models import Player
+import ingest
+
+
+# The keys are the numbers 1 to KEY_SPACE written with 6 digits
+KEY_SPACE = 1000000
+
+# Maximum number of players created by one request
+MAX_PLAYERS = 20000
+
+# Attempts when a key is taken by players created at the same time
+ATTEMPTS = 3
+
+
+def format_key(number):
+    return "{0:06}".format(number)
+
+
+def draw_keys(number):
+    """Returns number distinct keys not used by any player, raises ValueError if there are not enough keys left"""
+    keys = []
+    excluded = set()
+    while len(keys) < number:
+        missing = number - len(keys)
+        if KEY_SPACE - len(excluded) < missing:
+            raise ValueError("Not enough keys left")
+        candidates = set(format_key(n) for n in sample(range(1, KEY_SPACE + 1), min(KEY_SPACE, missing + len(excluded)))) - excluded
+        candidates = list(candidates)[:missing]
+        used = set()
+        for chunk in ingest.chunks(candidates):
+            used.update(key for (key,) in db_session.query(Player.key).filter(Player.key.in_(chunk)))
+        excluded.update(candidates)
+        keys.extend(key for key in candidates if key not in used)
+    return keys
+
+
+def check_sizes(sizes):
+    """Checks the numbers of players of the sessions to create, raises ValueError if one is not valid"""
+    if not sizes:
+        raise ValueError("No session to create!")
+    for size in sizes:
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise ValueError("Invalid number of players: {}".format(size))
+        if size % 2 != 0:
+            raise ValueError("Odd number of players!")
+    if sum(sizes) > MAX_PLAYERS:
+        raise ValueError("At most {} players can be created at once".format(MAX_PLAYERS))
+
+
+def create_sessions(sizes):
+    """
+    Creates sessions of players, sizes being the number of players of each session (even numbers)
+    The players of a session are paired in order, the two players of a pair have the player conditions 1 and 2
+    Returns [(session_nr, keys of the players)], raises ValueError if a number of players is not valid
+    """
+    check_sizes(sizes)
+    for attempt in range(ATTEMPTS):
+        keys = draw_keys(sum(sizes))
+        last_session_nr = db_session.query(func.max(Player.session_nr)).scalar() or 0
+        sessions = []
+        rows = []
+        for (n, size) in enumerate(sizes):
+            session_nr = last_session_nr + n + 1
+            session_keys = keys[len(rows):len(rows) + size]
+            for (i, key) in enumerate(session_keys):
+                rows.append({"key": key, "name": key, "session_nr": session_nr, "pair": i // 2 + 1, "condition": 0,
+                             "player_condition": i % 2 + 1, "in_use": 0, "score": 0, "team_score_avg": 0.0, "team_score_max": 0.0})
+            sessions.append((session_nr, session_keys))
+        try:
+            db_session.bulk_insert_mappings(Player, rows)
+            db_session.commit()
+            return sessions
+        except IntegrityError:
+            # A key was taken by players created in the meantime
+            db_session.rollback()
+    raise ValueError("The keys could not be created, try again")
@@ -0,0 +1,100 @@
+"""
+Production serving mode: several worker processes accepting the requests on the same socket
+
+    python serve.py [workers]
+
+The number of workers is read from settings.yml (server/workers) when it is not given.
+The socket is opened once, then the workers are forked: each one imports the application and handles its requests
+with threads. With several workers:
+    * identification and pairing rely on conditional updates of the database (see matchmaking.DatabaseMatchmaker)
+    * the requests waiting for a connection (long polling) poll the database
+    * the response cache and the analytics cache are disabled
+    * in write-behind mode, each worker has its own journal (journal path followed by the number of the worker)
+A worker which exits is started again. Requires fork (Linux, macOS), on Windows the server runs in one process.
+"""
+
+import os
+import sys
+import time
+import signal
+
+from werkzeug.serving import make_server
+
+from utils import read_settings
+
+
+def load_app(worker):
+    """Imports the application in a worker process"""
+    os.environ["IDP_WORKER"] = str(worker)
+    from app import app
+    return app
+
+
+def start_worker(server, worker, load):
+    """Forks a worker process serving the requests of server, returns its pid"""
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    status = 0
+    try:
+        server.app = load(worker)
+        print(" * Worker {} started (pid {})".format(worker, os.getpid()))
+        server.serve_forever()
+    except Exception as e:
+        print(" * Worker {} stopped: {}".format(worker, e))
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def serve(server, workers, load=load_app):
+    """
+    Runs workers processes serving the requests of server (werkzeug server whose socket is already listening),
+    until SIGINT or SIGTERM. Each worker gets its application from load(number of the worker)
+    """
+    os.environ["IDP_WORKERS"] = str(workers)
+    pids = dict((start_worker(server, worker, load), worker) for worker in range(workers))
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while pids:
+            try:
+                (pid, status) = os.wait()
+            except ChildProcessError:
+                break
+            worker = pids.pop(pid, None)
+            if worker is not None and not stopping:
+                print(" * Worker {} exited (status {}), restarting it".format(worker, status))
+                # A worker failing at start is not restarted in a loop
+                time.sleep(1)
+                pids[start_worker(server, worker, load)] = worker
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    settings = read_settings()
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else settings["server"].get("workers", 1)
+    host = "0.0.0.0" if settings["flask"]["ext"] else "127.0.0.1"
+    port = settings["server"]["port"]
+
+    if workers <= 1 or not hasattr(os, "fork"):
+        if workers > 1:
+            print(" * fork is not available, the server runs in one process")
+        os.environ["IDP_WORKERS"] = "1"
+        from app import app
+        app.run(host=host, port=port, threaded=True)
+    else:
+        # The application is imported by the workers, the socket is shared by all of them
+        server = make_server(host, port, None, threaded=True)
+        print(" * Running on http://{}:{}/ with {} workers".format(host, port, workers))
+        serve(server, workers)
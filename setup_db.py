@@ -1,13 +1,12 @@
-"""Script to generate the database structure"""
-from bs4 import BeautifulSoup
-from database import Base, engine, db_session
+"""
+Script to generate the database structure and fill the names of the items from the catalog file (see catalog.py)
+It can be run again on an existing database: the new items are added and the names which changed are updated
+"""
+from database import Base, engine
 from models import *
+import catalog
 
 Base.metadata.create_all(bind=engine)
 
-with open("items_list.html", "r") as f:
-    soup = BeautifulSoup(f.read(), "html.parser")
-    for item in soup.find_all("tr"):
-        id_, img, name = item.find_all("td")
-        db_session.add(ItemName(id_.string, name.a.string))
-    db_session.commit()
+(added, updated) = catalog.upsert(catalog.read_file())
+print("Items: {} added, {} updated".format(added, updated))
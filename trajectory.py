@@ -0,0 +1,165 @@
+"""
+Compact storage of the trajectories of the players (position_over_time sent by the Minecraft mod)
+
+A trajectory is a list of points (time, x, y, z...) sorted by time, it is read from position_over_time given as:
+    * a dictionary {time: position}
+    * a list of [time, x, y, z...] or of {"time": time, "x": x, "y": y, "z": z}
+where a position is a list of coordinates, a dictionary {"x": x, "y": y, "z": z} or one of them encoded in JSON.
+
+Each dimension (time, x, y, z...) is stored as a column of the blob, compressed with zlib:
+    * values that are decimal numbers with at most 6 decimals are multiplied by 10^decimals and delta encoded
+      as 64 bits integers (consecutive positions are close, most deltas are small and compress well)
+    * other values are stored as 64 bits floats
+The encoding is lossless: decode(encode(times, positions)) gives back the same numbers.
+"""
+
+import json
+import zlib
+import struct
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+
+# Version of the format of the blob, stored in its header
+FORMAT_VERSION = 1
+
+# Decimals tried to store a column as integers, -1 means stored as floats
+MAX_DECIMALS = 6
+FLOAT_COLUMN = -1
+
+# Integers must fit in 64 bits
+MAX_INTEGER = 2 ** 62
+
+COORDINATES = ("x", "y", "z")
+
+
+def number(value):
+    """Converts a time or a coordinate to a number, raises ValueError if it is not one"""
+    if isinstance(value, bool):
+        raise ValueError("{!r} is not a number".format(value))
+    if isinstance(value, (int, float)):
+        return value
+    return float(value)
+
+
+def parse_position(position):
+    """Returns the coordinates of a position, raises ValueError if it is not a position"""
+    if isinstance(position, str):
+        position = json.loads(position)
+    if isinstance(position, dict):
+        if set(position.keys()) != set(COORDINATES):
+            raise ValueError("{!r} is not a position".format(position))
+        return [number(position[c]) for c in COORDINATES]
+    if isinstance(position, (list, tuple)) and position:
+        return [number(c) for c in position]
+    raise ValueError("{!r} is not a position".format(position))
+
+
+def parse(position_over_time):
+    """
+    Reads a trajectory from position_over_time (decoded from JSON)
+    Returns (times, positions) sorted by time, or None if it is not a trajectory
+    """
+    try:
+        if isinstance(position_over_time, str):
+            position_over_time = json.loads(position_over_time)
+        points = []
+        if isinstance(position_over_time, dict):
+            for (time, position) in position_over_time.items():
+                points.append((number(time), parse_position(position)))
+        elif isinstance(position_over_time, list):
+            for point in position_over_time:
+                if isinstance(point, dict):
+                    point = dict(point)
+                    time = point.pop("time", point.pop("t", None))
+                    points.append((number(time), parse_position(point)))
+                else:
+                    points.append((number(point[0]), parse_position(list(point[1:]))))
+        else:
+            return None
+    except (ValueError, TypeError, IndexError, KeyError):
+        return None
+
+    if not points or len(set(len(position) for (time, position) in points)) != 1:
+        return None
+    points.sort(key=lambda point: point[0])
+    return [time for (time, position) in points], [position for (time, position) in points]
+
+
+def decimals(values):
+    """Returns the number of decimals needed to store the values as integers, FLOAT_COLUMN if they cannot be"""
+    for n in range(MAX_DECIMALS + 1):
+        scale = 10 ** n
+        try:
+            if all(round(v * scale) / scale == v and abs(v * scale) < MAX_INTEGER for v in values):
+                return n
+        except (OverflowError, ValueError):
+            # infinite or NaN values
+            return FLOAT_COLUMN
+    return FLOAT_COLUMN
+
+
+def encode_column(values):
+    """Encodes a column of numbers, returns (decimals, bytes)"""
+    n = decimals(values)
+    if n == FLOAT_COLUMN:
+        return n, struct.pack("<{}d".format(len(values)), *values)
+    scale = 10 ** n
+    integers = [int(round(v * scale)) for v in values]
+    deltas = [integers[0]] + [b - a for (a, b) in zip(integers, integers[1:])]
+    return n, struct.pack("<{}q".format(len(deltas)), *deltas)
+
+
+def decode_column(n, data, length):
+    """Decodes a column encoded by encode_column"""
+    if n == FLOAT_COLUMN:
+        return list(struct.unpack("<{}d".format(length), data))
+    integers = accumulate(struct.unpack("<{}q".format(length), data))
+    if n == 0:
+        return list(integers)
+    scale = 10 ** n
+    return [i / scale for i in integers]
+
+
+def encode(times, positions):
+    """
+    Encodes a trajectory, returns the values of a Trajectory row:
+    number_points, start_time, end_time and data (compressed blob)
+    """
+    columns = [times] + [list(c) for c in zip(*positions)]
+    encoded = [encode_column(column) for column in columns]
+    header = struct.pack("<BII", FORMAT_VERSION, len(times), len(columns)) + struct.pack("<{}b".format(len(columns)), *[n for (n, data) in encoded])
+    return {
+        "number_points": len(times),
+        "start_time": times[0],
+        "end_time": times[-1],
+        "data": zlib.compress(header + b"".join(data for (n, data) in encoded)),
+    }
+
+
+def read_blob(data):
+    """Decompresses the blob of a trajectory, returns (uncompressed data, number of points, decimals of each column, offset of the first column)"""
+    data = zlib.decompress(data)
+    (version, length, number_columns) = struct.unpack_from("<BII", data)
+    if version != FORMAT_VERSION:
+        raise ValueError("Unknown trajectory format {}".format(version))
+    offset = struct.calcsize("<BII")
+    column_decimals = struct.unpack_from("<{}b".format(number_columns), data, offset)
+    return data, length, column_decimals, offset + number_columns
+
+
+def decode(data):
+    """Decodes the blob of a trajectory, returns (times, positions)"""
+    (data, length, column_decimals, offset) = read_blob(data)
+    columns = []
+    for n in column_decimals:
+        columns.append(decode_column(n, data[offset:offset + 8 * length], length))
+        offset += 8 * length
+    return columns[0], [list(position) for position in zip(*columns[1:])]
+
+
+def time_slice(times, positions, start=None, end=None):
+    """Returns the points of a trajectory with start <= time <= end"""
+    i = 0 if start is None else bisect_left(times, start)
+    j = len(times) if end is None else bisect_right(times, end)
+    return times[i:j], positions[i:j]
@@ -0,0 +1,246 @@
+"""
+Compressed and chunked uploads of the statistics
+
+A payload sent to /upload_json/ or /upload_json/batch may be compressed, with the Content-Encoding header:
+    * gzip
+    * deflate (zlib stream, raw deflate is also accepted)
+The decompressed payload is limited to max_size bytes: a payload larger than that is refused without
+being decompressed entirely.
+
+A large payload (long trajectories) can also be uploaded in chunks to /upload_json/chunks/, the chunks being
+consecutive parts of the body of the payload (compressed or not). The chunks of a payload are identified by its key
+(session_id, world, round, player) and kept in files until the payload is complete. The upload is resumable:
+the server answers the number of bytes received so far, a client sends again from there after an error.
+Once its last byte is received, the payload is taken by one request (.part renamed to .ready) while it is added
+to the database. It is marked as complete (.done, with the size of the payload and the hash of its last chunk) only
+once it is written: the last chunk sent again afterwards is then answered as complete. If the payload cannot be
+added, it is put back (.part) to be completed again, or removed if it is not valid.
+"""
+
+import os
+import time
+import hashlib
+import zlib
+from threading import Lock
+
+from flask import json
+
+
+# Maximum size of a payload once decompressed, and of the body of a payload sent in chunks
+MAX_SIZE = 64 * 1024 * 1024
+
+# A payload whose upload was not completed is removed after EXPIRY seconds
+EXPIRY = 24 * 3600
+
+# A payload taken for more than PROCESSING_TIME seconds was abandoned (server stopped), it is put back
+PROCESSING_TIME = 600
+
+# Accepted values of Content-Encoding, with the window bits of zlib
+ENCODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "x-gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+class PayloadTooLarge(ValueError):
+    """The payload is larger than the maximum size"""
+
+
+class OffsetMismatch(ValueError):
+    """A chunk does not follow the bytes received, received is the number of bytes received"""
+
+    def __init__(self, received):
+        ValueError.__init__(self, "{} bytes received, the chunk must start there".format(received))
+        self.received = received
+
+
+class UploadInProgress(ValueError):
+    """The payload is being added to the database by another request"""
+
+    def __init__(self, received):
+        ValueError.__init__(self, "The payload is being added, try again later")
+        self.received = received
+
+
+def decompress(data, wbits, max_size):
+    """Decompresses data, raises PayloadTooLarge if it is larger than max_size once decompressed"""
+    decompressor = zlib.decompressobj(wbits)
+    body = decompressor.decompress(data, max_size + 1)
+    if len(body) > max_size:
+        raise PayloadTooLarge("The payload is larger than {} bytes once decompressed".format(max_size))
+    if not decompressor.eof:
+        raise ValueError("The compressed payload is truncated")
+    return body
+
+
+def decode_body(data, encoding=None, max_size=MAX_SIZE):
+    """
+    Returns the body of a request decoded according to its Content-Encoding
+    Raises PayloadTooLarge if it is larger than max_size once decoded, ValueError if it cannot be decoded
+    """
+    encoding = (encoding or "identity").strip().lower()
+    if encoding == "identity":
+        if len(data) > max_size:
+            raise PayloadTooLarge("The payload is larger than {} bytes".format(max_size))
+        return data
+    if encoding not in ENCODINGS:
+        raise ValueError("Unsupported Content-Encoding: {}".format(encoding))
+    try:
+        return decompress(data, ENCODINGS[encoding], max_size)
+    except zlib.error as e:
+        if encoding != "deflate":
+            raise ValueError("Invalid {} payload: {}".format(encoding, e))
+    # Some clients send deflate without the zlib header
+    try:
+        return decompress(data, -zlib.MAX_WBITS, max_size)
+    except zlib.error as e:
+        raise ValueError("Invalid deflate payload: {}".format(e))
+
+
+def read_json(data, encoding=None, max_size=MAX_SIZE):
+    """Returns the JSON of a request body, raises PayloadTooLarge or ValueError (see decode_body)"""
+    return json.loads(decode_body(data, encoding, max_size).decode("utf-8"))
+
+
+def payload_key(session_id, world, round, player):
+    """Key of a payload, with the types of ingest.parse_payload"""
+    return (str(session_id), str(world), str(round), int(player))
+
+
+class ChunkStore(object):
+    """
+    Payloads uploaded in chunks, each one written in a file of directory until it is complete
+    The files are shared by the processes of the server (see serve.py), the chunks of a payload are sent one after the other
+    """
+
+    def __init__(self, directory, max_size=MAX_SIZE, expiry=EXPIRY):
+        self.directory = directory
+        self.max_size = max_size
+        self.expiry = expiry
+        self.lock = Lock()
+
+    def path(self, key, extension=".part"):
+        name = hashlib.sha1(json.dumps(list(key)).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + extension)
+
+    def received(self, key):
+        """Returns the number of bytes of the payload received so far (its size if its upload is complete)"""
+        for extension in (".part", ".ready"):
+            try:
+                return os.path.getsize(self.path(key, extension))
+            except OSError:
+                pass
+        marker = self.marker(key)
+        return marker["size"] if marker is not None else 0
+
+    def is_complete(self, key):
+        """Returns True if the payload was added to the database"""
+        return not os.path.exists(self.path(key)) and self.marker(key) is not None
+
+    def marker(self, key):
+        """Returns the marker of the payload if it was added to the database (see finish), None otherwise"""
+        try:
+            with open(self.path(key, ".done"), "r") as f:
+                marker = json.loads(f.read())
+            return marker if isinstance(marker, dict) and isinstance(marker.get("size"), int) else None
+        except (OSError, ValueError):
+            return None
+
+    def append(self, key, offset, data, total):
+        """
+        Adds the chunk data starting at byte offset of the payload of total bytes
+        Returns (number of bytes received, the payload if this chunk completed it, None otherwise)
+        The request given the payload must then call finish once it is added to the database, or release.
+        A chunk already received is ignored (sent again after a lost response), the last chunk of a payload already
+        added is answered as complete (None). A payload can be sent again from the start (offset 0)
+        Raises OffsetMismatch if bytes are missing before the chunk, UploadInProgress if the payload was taken by
+        another request, PayloadTooLarge or ValueError if it is not valid
+        """
+        if total > self.max_size:
+            raise PayloadTooLarge("The payload is larger than {} bytes".format(self.max_size))
+        if offset < 0 or offset + len(data) > total:
+            raise ValueError("The chunk is outside of the payload")
+        with self.lock:
+            path = self.path(key)
+            ready = self.path(key, ".ready")
+            done = self.path(key, ".done")
+            marker = self.marker(key)
+            if marker is not None:
+                if marker == self.last_chunk(offset, data, total):
+                    # The last chunk sent again once the payload was added (the response was lost)
+                    return total, None
+                # Another payload is sent
+                self.remove(done)
+            elif os.path.exists(done):
+                # The marker was not written entirely
+                self.remove(done)
+            try:
+                if time.time() - os.path.getmtime(ready) < PROCESSING_TIME:
+                    raise UploadInProgress(os.path.getsize(ready))
+                os.rename(ready, path)
+            except OSError:
+                pass
+            received = self.received(key)
+            if received > total:
+                # The payload is sent again with another size
+                os.remove(path)
+                received = 0
+            if offset > received:
+                raise OffsetMismatch(received)
+            if offset + len(data) > received:
+                if received == 0:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self.remove_expired()
+                with open(path, "ab") as f:
+                    f.write(data[received - offset:])
+                received = offset + len(data)
+            if received < total:
+                return received, None
+            # The payload is complete: the first request renaming the file takes it (renaming is atomic, also between processes)
+            try:
+                os.rename(path, ready)
+            except OSError:
+                raise UploadInProgress(total)
+            with open(ready, "rb") as f:
+                return total, f.read()
+
+    def last_chunk(self, offset, data, total):
+        """Marker of a payload of total bytes completed by the chunk data starting at offset"""
+        return {"size": total, "offset": offset, "sha1": hashlib.sha1(data).hexdigest()}
+
+    def finish(self, key, offset, data, total):
+        """Marks the payload taken by append as added to the database, data being the chunk which completed it"""
+        done = self.path(key, ".done")
+        # The marker is written entirely before it replaces the payload
+        with open(done + ".tmp", "w") as f:
+            f.write(json.dumps(self.last_chunk(offset, data, total)))
+        os.replace(done + ".tmp", done)
+        self.remove(self.path(key, ".ready"))
+
+    def release(self, key, keep=True):
+        """Puts back the payload taken by append when it could not be added to the database (removes it if not keep)"""
+        ready = self.path(key, ".ready")
+        if keep:
+            os.rename(ready, self.path(key))
+        else:
+            self.remove(ready)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # Removed by another process
+            pass
+
+    def remove_expired(self):
+        """Removes the payloads whose upload was not completed, and the markers of the payloads completed"""
+        limit = time.time() - self.expiry
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith((".part", ".ready", ".done", ".tmp")) and os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:
+                # Removed by another process
+                pass
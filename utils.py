@@ -7,6 +7,9 @@ import settings
 import csv
 from io import StringIO
 
+# Size of the blocks of CSV sent while exporting the statistics
+CSV_BLOCK_SIZE = 64 * 1024
+
 
 def read_settings():
     """Read the settings.yml file and returns a dictionnary"""
@@ -20,41 +23,55 @@ def read_settings():
 
 
 def stats_to_csv():
-    """Write the statistics to a CSV file"""
+    """
+    Generates the statistics as CSV, by blocks of lines
+    All the data is read with one query, ordered so that the items of a stat follow each other:
+    only one line is built at a time, whatever the size of the database
+    """
+    from sqlalchemy import select, and_
     from database import db_session
-    from models import Session, Test, Stat, Item, Player
-    session_columns = [c.name for c in Session.__table__.columns]
-    test_columns = [c.name for c in Test.__table__.columns]
-    stat_columns = [c.name for c in Stat.__table__.columns]
-
-    session_columns.remove("id")
-    test_columns.remove("id")
-    test_columns.remove("session_id")
-    stat_columns.remove("id")
-    stat_columns.remove("test_id")
-    stat_columns.remove("position_over_time")
+    from models import Session, Test, Stat, Item
+    import catalog
+    sessions, tests, stats, items = Session.__table__, Test.__table__, Stat.__table__, Item.__table__
+    session_columns = [c for c in sessions.columns if c.name != "id"]
+    test_columns = [c for c in tests.columns if c.name not in ("id", "session_id")]
+    stat_columns = [c for c in stats.columns if c.name not in ("id", "test_id", "position_over_time")]
+    columns = session_columns + test_columns + stat_columns
+    n = len(columns)
 
     output = StringIO()
     csvwriter = csv.writer(output, delimiter=',')
-    csvwriter.writerow([c.replace("_", " ") for c in (session_columns + test_columns + stat_columns)])
-
-    # We get all the data using references in transversal way
-    sessions = db_session.query(Session).all()
-    for session in sessions:
-        session_out = [getattr(session, c) for c in session_columns]
-        tests = session.tests
-        for test in tests:
-            test_out = [getattr(test, c) for c in test_columns]
-            stats = test.stats
-            items = test.items
-            for stat in stats:
-                stat_out = [getattr(stat, c) for c in stat_columns]
-                for item in items:
-                    if item.player_id == stat.player_id:
-                        stat_out += ["Item #{} ({})".format(item.item_item, item.item.name), "used: {}".format(item.use_item), "mined: {}".format(item.mine_block), "crafted: {}".format(item.craft_item), "broken: {}".format(item.break_item)]
-                csvwriter.writerow(session_out + test_out + stat_out)
-
-    return output
+    csvwriter.writerow([c.name.replace("_", " ") for c in columns])
+
+    # The names of the items are read from the catalog
+    item_names = catalog.names()
+
+    # One line per stat, followed by the items of the player in the test
+    q = select(columns + [stats.c.id, items.c.item_item, items.c.use_item, items.c.mine_block, items.c.craft_item, items.c.break_item]) \
+        .select_from(stats.join(tests).join(sessions)
+                     .outerjoin(items, and_(items.c.test_id == stats.c.test_id, items.c.player_id == stats.c.player_id))) \
+        .order_by(sessions.c.id, tests.c.timestamp, tests.c.id, stats.c.player_id, stats.c.id, items.c.id)
+    result = db_session.connection().execution_options(stream_results=True).execute(q)
+
+    stat_id = None
+    stat_out = None
+    for row in result:
+        if row[n] != stat_id:
+            if stat_out is not None:
+                csvwriter.writerow(stat_out)
+            stat_id = row[n]
+            stat_out = list(row[:n])
+        (item_item, use_item, mine_block, craft_item, break_item) = row[n + 1:]
+        if item_item is not None:
+            stat_out += ["Item #{} ({})".format(item_item, item_names.get(item_item)), "used: {}".format(use_item), "mined: {}".format(mine_block), "crafted: {}".format(craft_item), "broken: {}".format(break_item)]
+        if output.tell() > CSV_BLOCK_SIZE:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+
+    if stat_out is not None:
+        csvwriter.writerow(stat_out)
+    yield output.getvalue()
 
 
 def session_to_csv(session_nr):